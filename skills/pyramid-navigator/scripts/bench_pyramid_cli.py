@@ -0,0 +1,541 @@
+#!/usr/bin/env python3
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "click>=8.0",
+#   "anthropic>=0.40",
+# ]
+# [tool.uv]
+# exclude-newer = "2026-02-12T00:00:00Z"
+# ///
+"""bench_pyramid_cli.py — Reproducible benchmarks for pyramid_cli.py.
+
+Generates a synthetic repository, points pyramid_cli.py at a local fake
+Anthropic API with injected latency, jitter and errors, and times each
+scenario as a fresh subprocess (startup included, like a real invocation).
+
+Usage:
+    uv run bench_pyramid_cli.py                                 # 1k, 10k and 100k elements
+    uv run bench_pyramid_cli.py --sizes 1000 --latency 0.05 --jitter 0.02 --error-rate 0.01
+    uv run bench_pyramid_cli.py --output base.json              # on the base commit
+    uv run bench_pyramid_cli.py --output head.json --compare base.json --fail-above 1.2
+
+Scenarios (per size):
+    cold_analyze   init + analyze into an empty .pyramid/
+    noop_analyze   analyze again with nothing changed
+    query          `query` for a few generated terms, --repeat times each
+    list           `list --level 4`, --repeat times
+
+Results are written as JSON (commit, interpreter, platform, settings and
+per-scenario timings); --compare prints the median ratio against an earlier
+results file.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import click
+
+_CLI = Path(__file__).resolve().with_name("pyramid_cli.py")
+_RESULTS_VERSION = 1
+SCENARIOS = ("cold_analyze", "noop_analyze", "query", "list")
+
+
+# ─────────────────────────────────────────────
+# SECTION: Synthetic repository
+# ─────────────────────────────────────────────
+
+_VERBS = (
+    "load", "parse", "render", "validate", "fetch", "store", "merge", "encode",
+    "decode", "resolve", "schedule", "refresh", "compute", "export", "import", "sync",
+)
+_NOUNS = (
+    "account", "invoice", "session", "token", "cache", "router", "payload", "schema",
+    "queue", "ledger", "widget", "report", "socket", "buffer", "config", "profile",
+)
+QUERIES = ("invoice ledger", "session token", "parse schema", "refresh cache")
+
+_PY_CLASS = '''\
+class {cls}:
+    """{doc}."""
+
+    def __init__(self, {noun}):
+        self.{noun} = {noun}
+'''
+_PY_FUNC = '''\
+def {verb}_{noun}_{i}({noun}, limit=10):
+    """{doc}."""
+    total = 0
+    for item in {noun}[:limit]:
+        total += len(str(item))
+    return total
+'''
+_JS_CLASS = """\
+class {cls} {{
+  constructor({noun}) {{
+    this.{noun} = {noun};
+  }}
+}}
+"""
+_JS_FUNC = """\
+function {verb}{Noun}{i}({noun}, limit = 10) {{
+  // {doc}
+  return {noun}.slice(0, limit).reduce((total, item) => total + String(item).length, 0);
+}}
+"""
+_GO_CLASS = """\
+type {cls} struct {{
+\t{Noun} []string
+}}
+"""
+_GO_FUNC = """\
+func {verb}{Noun}{i}({noun} []string, limit int) int {{
+\t// {doc}
+\ttotal := 0
+\tfor _, item := range {noun}[:limit] {{
+\t\ttotal += len(item)
+\t}}
+\treturn total
+}}
+"""
+_LANGUAGES: dict[str, tuple[str, str, str, str]] = {
+    # language: (extension, header, class template, function template)
+    "python": (".py", "", _PY_CLASS, _PY_FUNC),
+    "javascript": (".js", "", _JS_CLASS, _JS_FUNC),
+    "go": (".go", "package bench\n", _GO_CLASS, _GO_FUNC),
+}
+
+
+def elements_per_file(functions: int) -> int:
+    """Elements a generated file yields: the file, one class and *functions* functions."""
+    return functions + 2
+
+
+def generate_repo(
+    root: Path,
+    files: int,
+    languages: tuple[str, ...] = ("python",),
+    depth: int = 2,
+    fanout: int = 8,
+    functions: int = 8,
+    seed: int = 0,
+) -> int:
+    """Write *files* source files under *root*; return the number written.
+
+    Files cycle through *languages* and are spread over a tree *depth*
+    directories deep with *fanout* subdirectories per level. The same
+    arguments always produce byte-identical trees.
+    """
+    rng = random.Random(seed)
+    for i in range(files):
+        language = languages[i % len(languages)]
+        ext, header, class_tpl, func_tpl = _LANGUAGES[language]
+        parts = [f"pkg{(i // fanout**level) % fanout}" for level in range(depth)]
+        noun = rng.choice(_NOUNS)
+        chunks = [header] if header else []
+        chunks.append(class_tpl.format(
+            cls=f"{noun.title()}Service{i}",
+            noun=noun,
+            Noun=noun.title(),
+            doc=f"{rng.choice(_VERBS)}s {noun} records for module {i}",
+        ))
+        for j in range(functions):
+            verb, noun = rng.choice(_VERBS), rng.choice(_NOUNS)
+            chunks.append(func_tpl.format(
+                verb=verb,
+                noun=noun,
+                Noun=noun.title(),
+                i=f"{i}_{j}",
+                doc=f"{verb} {noun} entries with {rng.choice(_NOUNS)} {rng.choice(_NOUNS)} lookup",
+            ))
+        target = root.joinpath(*parts, f"{noun}_{i}{ext}")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text("\n\n".join(chunks))
+    return files
+
+
+# ─────────────────────────────────────────────
+# SECTION: Fake provider
+# ─────────────────────────────────────────────
+
+
+def _summary_words(name: str) -> list[str]:
+    """Words for a deterministic summary of *name*, long enough for level 64."""
+    words = [w.lower() for w in re.findall(r"[A-Z]?[a-z]+|\d+", name)] or ["element"]
+    filler = [*_VERBS, *_NOUNS]
+    return (words + filler * 5)[:64]
+
+
+def _levels_for(name: str, levels: list[int]) -> dict[str, str]:
+    words = _summary_words(name)
+    return {str(n): " ".join(words[:n]) for n in levels}
+
+
+class _FakeProviderHandler(BaseHTTPRequestHandler):
+    """POST /v1/messages with configurable latency, jitter and error rate.
+
+    Answers are prefix-consistent summaries of exactly the requested word
+    counts, so single, packed (``--batch-tokens``) and extend prompts all
+    validate the way real answers would.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def _reply(self, status: int, obj: object, retry_after: bool = False) -> None:
+        payload = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        if retry_after:
+            self.send_header("retry-after", "0")
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self) -> None:  # noqa: N802
+        server: FakeProvider = self.server  # type: ignore[assignment]
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests += 1
+            delay = max(0.0, server.latency + server.rng.uniform(-server.jitter, server.jitter))
+            fail = server.rng.random() < server.error_rate
+            if fail:
+                server.errors += 1
+        time.sleep(delay)
+        if fail:
+            error = {"type": "error", "error": {"type": "rate_limit_error", "message": "injected"}}
+            self._reply(429, error, retry_after=True)
+            return
+        prompt = body["messages"][0]["content"]
+        levels = [int(n) for n in re.findall(r"\d+", (re.findall(r"ascending order: \[(.*?)\]", prompt) or [""])[0])]
+        extend = re.search(r"to exactly (\d+) words.*summary:\n  (.*?)\n\nReturn", prompt, re.DOTALL)
+        if extend:
+            target, seed = int(extend.group(1)), extend.group(2).split()
+            answer: dict[str, object] = {
+                str(target): " ".join(seed + _summary_words(seed[-1] if seed else "")[: target - len(seed)])
+            }
+        elif "\n### e" in prompt:  # packed request: one answer per element id
+            blocks = re.findall(r"^### (e\d+)\n.*?^Element name: ([^\n]*)", prompt, re.MULTILINE | re.DOTALL)
+            answer = {key: _levels_for(name, levels) for key, name in blocks}
+        else:
+            name = (re.findall(r"^Element name: (.*)$", prompt, re.MULTILINE) or ["element"])[0]
+            answer = _levels_for(name, levels)
+        self._reply(200, {
+            "id": "msg_bench",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model", "fake"),
+            "content": [{"type": "text", "text": json.dumps(answer)}],
+            "stop_reason": "end_turn",
+            "usage": {"input_tokens": len(prompt) // 4, "output_tokens": 64},
+        })
+
+    def log_message(self, *_args: object) -> None:
+        pass
+
+
+class FakeProvider(ThreadingHTTPServer):
+    """A local Anthropic Messages API stand-in; counts requests and injected errors."""
+
+    daemon_threads = True
+    request_queue_size = 1024  # the default of 5 drops connects from a concurrent analyze
+
+    def __init__(self, latency: float, jitter: float, error_rate: float, seed: int = 0) -> None:
+        super().__init__(("127.0.0.1", 0), _FakeProviderHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def take_counts(self) -> tuple[int, int]:
+        """Return (requests, injected errors) since the last call and reset them."""
+        with self.lock:
+            counts = (self.requests, self.errors)
+            self.requests = self.errors = 0
+        return counts
+
+
+@contextmanager
+def running(provider: FakeProvider) -> Iterator[FakeProvider]:
+    """Serve *provider* on a background thread for the duration of the block."""
+    thread = threading.Thread(target=provider.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield provider
+    finally:
+        provider.shutdown()
+        provider.server_close()
+
+
+# ─────────────────────────────────────────────
+# SECTION: Scenarios
+# ─────────────────────────────────────────────
+
+
+def _run_cli(args: list[str], cwd: Path, env: dict[str, str]) -> float:
+    """Run pyramid_cli.py with *args*; return wall-clock seconds or raise on failure."""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, str(_CLI), *args],
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise click.ClickException(
+            f"pyramid_cli.py {' '.join(args)} exited {result.returncode}:\n{result.stderr[-2000:]}"
+        )
+    return elapsed
+
+
+def _record(
+    scenario: str, size: int, files: int, elements: int, seconds: list[float], counts: tuple[int, int]
+) -> dict[str, object]:
+    return {
+        "scenario": scenario,
+        "size": size,
+        "files": files,
+        "elements": elements,
+        "seconds": [round(s, 4) for s in seconds],
+        "median": round(statistics.median(seconds), 4),
+        "min": round(min(seconds), 4),
+        "requests": counts[0],
+        "injected_errors": counts[1],
+    }
+
+
+def _count_elements(db: Path) -> int:
+    sys.path.insert(0, str(_CLI.parent))
+    from pyramid_cli import open_storage  # noqa: PLC0415 — heavy, and only needed after analyze
+
+    return open_storage(db).count()
+
+
+def run_size(
+    size: int,
+    workdir: Path,
+    provider: FakeProvider,
+    scenarios: tuple[str, ...],
+    languages: tuple[str, ...],
+    depth: int,
+    fanout: int,
+    functions: int,
+    repeat: int,
+    analyze_args: list[str],
+    backend: str,
+    seed: int,
+) -> list[dict[str, object]]:
+    """Generate a repository of about *size* elements and time *scenarios* against it."""
+    root = workdir / f"repo-{size}"
+    files = max(1, -(-size // elements_per_file(functions)))
+    generate_repo(root, files, languages, depth, fanout, functions, seed)
+    db = root / ".pyramid"
+    env = {
+        **os.environ,
+        "ANTHROPIC_API_KEY": "bench",
+        "ANTHROPIC_BASE_URL": provider.base_url,
+        "PYRAMID_NO_SERVER": "1",
+    }
+    env.pop("PYRAMID_DB", None)
+    analyze = ["analyze", str(root), "--db-path", str(db), *analyze_args]
+
+    provider.take_counts()
+    cold = _run_cli(["init", "--db-path", str(db), "--backend", backend], root, env)
+    cold += _run_cli(analyze, root, env)
+    cold_counts = provider.take_counts()
+    elements = _count_elements(db)
+    results: list[dict[str, object]] = []
+    if "cold_analyze" in scenarios:
+        results.append(_record("cold_analyze", size, files, elements, [cold], cold_counts))
+    if "noop_analyze" in scenarios:
+        seconds = [_run_cli(analyze, root, env) for _ in range(repeat)]
+        results.append(_record("noop_analyze", size, files, elements, seconds, provider.take_counts()))
+    if "query" in scenarios:
+        seconds = [
+            _run_cli(["query", q, "--db-path", str(db)], root, env)
+            for _ in range(repeat)
+            for q in QUERIES
+        ]
+        results.append(_record("query", size, files, elements, seconds, provider.take_counts()))
+    if "list" in scenarios:
+        seconds = [_run_cli(["list", "--level", "4", "--db-path", str(db)], root, env) for _ in range(repeat)]
+        results.append(_record("list", size, files, elements, seconds, provider.take_counts()))
+    return results
+
+
+def _git_commit() -> dict[str, object]:
+    def git(*args: str) -> str:
+        result = subprocess.run(
+            ["git", *args], cwd=_CLI.parent, capture_output=True, text=True
+        )
+        return result.stdout.strip() if result.returncode == 0 else ""
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--", "."))}
+
+
+def compare(current: dict[str, object], baseline: dict[str, object]) -> list[tuple[str, int, float, float, float]]:
+    """(scenario, size, baseline median, current median, ratio) for each shared measurement."""
+    before = {
+        (r["scenario"], r["size"]): float(r["median"])  # type: ignore[index]
+        for r in baseline.get("results", [])  # type: ignore[union-attr]
+    }
+    rows = []
+    for r in current["results"]:  # type: ignore[union-attr]
+        key = (r["scenario"], r["size"])  # type: ignore[index]
+        if key in before:
+            old, new = before[key], float(r["median"])  # type: ignore[index]
+            rows.append((key[0], key[1], old, new, new / old if old else float("inf")))
+    return rows
+
+
+# ─────────────────────────────────────────────
+# SECTION: CLI
+# ─────────────────────────────────────────────
+
+
+def _csv(ctx: click.Context, param: click.Parameter, value: str) -> tuple[str, ...]:
+    return tuple(v.strip() for v in value.split(",") if v.strip())
+
+
+@click.command()
+@click.option("--sizes", default="1000,10000,100000", show_default=True, help="Element counts, comma-separated.")
+@click.option(
+    "--scenarios",
+    default=",".join(SCENARIOS),
+    show_default=True,
+    callback=_csv,
+    help="Scenarios to run, comma-separated.",
+)
+@click.option("--languages", default="python,javascript,go", show_default=True, callback=_csv)
+@click.option("--depth", default=2, show_default=True, type=click.IntRange(min=0), help="Directory nesting.")
+@click.option("--fanout", default=8, show_default=True, type=click.IntRange(min=1), help="Subdirectories per level.")
+@click.option("--functions", default=8, show_default=True, type=click.IntRange(min=0), help="Functions per file.")
+@click.option("--latency", default=0.02, show_default=True, type=float, help="Fake provider latency (s).")
+@click.option("--jitter", default=0.01, show_default=True, type=float, help="Uniform ± jitter on latency (s).")
+@click.option(
+    "--error-rate",
+    default=0.0,
+    show_default=True,
+    type=click.FloatRange(0, 1),
+    help="Fraction of requests answered with 429 (retry-after 0).",
+)
+@click.option("--repeat", default=3, show_default=True, type=click.IntRange(min=1), help="Runs per timed read scenario.")
+@click.option("--backend", default="json", type=click.Choice(["json", "sqlite", "pack"]), show_default=True)
+@click.option(
+    "--analyze-args",
+    default="--concurrency 64",
+    show_default=True,
+    help="Extra arguments for every analyze run.",
+)
+@click.option("--seed", default=0, show_default=True, help="Seed for the generator and the fake provider.")
+@click.option("--workdir", default=None, type=click.Path(file_okay=False), help="Keep generated repos here.")
+@click.option("--output", default="bench-results.json", show_default=True, type=click.Path(dir_okay=False))
+@click.option("--compare", "baseline_path", default=None, type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--fail-above",
+    default=None,
+    type=float,
+    help="With --compare: exit 1 if any median is more than this many times the baseline.",
+)
+def main(
+    sizes: str,
+    scenarios: tuple[str, ...],
+    languages: tuple[str, ...],
+    depth: int,
+    fanout: int,
+    functions: int,
+    latency: float,
+    jitter: float,
+    error_rate: float,
+    repeat: int,
+    backend: str,
+    analyze_args: str,
+    seed: int,
+    workdir: str | None,
+    output: str,
+    baseline_path: str | None,
+    fail_above: float | None,
+) -> None:
+    """Time pyramid_cli.py on synthetic repositories against a fake provider."""
+    unknown = set(scenarios) - set(SCENARIOS) or set(languages) - set(_LANGUAGES)
+    if unknown:
+        raise click.BadParameter(f"unknown: {', '.join(sorted(unknown))}")
+    size_list = [int(s) for s in _csv(None, None, sizes)]  # type: ignore[arg-type]
+    root = Path(workdir) if workdir else Path(tempfile.mkdtemp(prefix="pyramid-bench-"))
+    root.mkdir(parents=True, exist_ok=True)
+    settings = {
+        "sizes": size_list, "scenarios": list(scenarios), "languages": list(languages),
+        "depth": depth, "fanout": fanout, "functions": functions, "latency": latency,
+        "jitter": jitter, "error_rate": error_rate, "repeat": repeat, "backend": backend,
+        "analyze_args": analyze_args, "seed": seed,
+    }
+    report: dict[str, object] = {
+        "version": _RESULTS_VERSION,
+        **_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "started": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "settings": settings,
+        "results": [],
+    }
+    try:
+        with running(FakeProvider(latency, jitter, error_rate, seed)) as provider:
+            for size in size_list:
+                for row in run_size(
+                    size, root, provider, scenarios, languages, depth, fanout, functions,
+                    repeat, analyze_args.split(), backend, seed,
+                ):
+                    report["results"].append(row)  # type: ignore[union-attr]
+                    click.echo(
+                        f"{row['scenario']:<14} {row['elements']:>7} elements  "
+                        f"median {row['median']:>8.3f}s  min {row['min']:>8.3f}s  "
+                        f"requests {row['requests']} ({row['injected_errors']} injected errors)"
+                    )
+    finally:
+        if not workdir:
+            shutil.rmtree(root, ignore_errors=True)
+    Path(output).write_text(json.dumps(report, indent=2) + "\n")
+    click.echo(f"Results written to {output}")
+
+    if baseline_path:
+        rows = compare(report, json.loads(Path(baseline_path).read_text()))
+        regressed = False
+        for scenario, size, old, new, ratio in rows:
+            flag = ""
+            if fail_above is not None and ratio > fail_above:
+                flag, regressed = "  REGRESSION", True
+            click.echo(f"{scenario:<14} {size:>7}  {old:>8.3f}s → {new:>8.3f}s  ×{ratio:.2f}{flag}")
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
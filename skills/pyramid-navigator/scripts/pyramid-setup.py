@@ -28,6 +28,7 @@ _REQUIRED: list[tuple[str, str]] = [
 _OPTIONAL: list[tuple[str, str, str]] = [
     # (import_name, pip_name, reason)
     ("tree_sitter_language_pack", "tree-sitter-language-pack", "multi-language parsing (165+ langs incl. PowerShell)"),
+    ("numpy", "numpy", "offline semantic search (query --semantic)"),
 ]
 
 
@@ -11,72 +11,129 @@
 # Optional extras (install separately if needed):
 #   uv add tree-sitter-language-pack   # multi-language parsing, 165+ langs incl. PowerShell (recommended)
 #   uv add openai                      # OpenAI provider alternative
+#   uv add numpy                       # offline semantic search (query --semantic)
 """pyramid_cli.py — Pyramid Summary Generator CLI.
 
 Indexes a codebase with multi-level LLM summaries for progressive navigation.
 
 Usage:
     uv run pyramid_cli.py init
-    uv run pyramid_cli.py analyze [PATH]
-    uv run pyramid_cli.py query QUERY [--level N]
+    uv run pyramid_cli.py analyze [PATH] [--dry-run] [--profile]
+    uv run pyramid_cli.py query QUERY [--level N] [--semantic]
     uv run pyramid_cli.py get ELEMENT_PATH [--level N] [--show-code]
+    uv run pyramid_cli.py expand [PREFIX...] [--level 32|64] [--workers N]
     uv run pyramid_cli.py list [--level N] [--type file|function|class]
+    uv run pyramid_cli.py migrate --to sqlite|json|pack
+    uv run pyramid_cli.py gc [--dry-run]
+    uv run pyramid_cli.py serve [--socket PATH | --stdio]
+    uv run pyramid_cli.py watch [PATH] [--poll] [--debounce S]
 
 Storage layout (.pyramid/):
-    config.json         Project configuration
-    index.json          Fast search index (levels 4, 8, 16 only)
-    data/<sha256>.json  Full element data (all levels + source code)
+    config.json         Project configuration (incl. "backend": json | sqlite | pack, "code_refs")
+    manifest.json       Per-file (size, mtime_ns, inode, element keys) and summarizer version for incremental analyze
+    retry.json          Elements whose LLM calls failed after retries (re-tried by next analyze)
+    batch.json          In-flight provider batch job(s) for analyze --batch-api (resumable)
+    index.json          Fast search index (levels 4, 8, 16 only)    [json, pack backends]
+    paths.idx           Sorted, normalized element paths for get/list [json, pack backends]
+    journal.jsonl       Index entries written since the last compaction [json, pack backends]
+    data/<key>.json     Full element data (all levels + source code) [json backend]
+                        (with code_refs: byte range + sha into the working tree, and
+                        one zlib copy per file for when it has changed since indexing)
+    pack/elements.{pack,idx,lock}  Append-only element records + sorted offset index (mmap), writer lock [pack backend]
+    pyramid.db          Single-file SQLite store in WAL mode        [sqlite backend]
+    summaries.db        Summary cache: levels per (code sha, model, prompt version), shared by duplicates
+    search.db           Inverted index (BM25) over names, paths and all stored levels
+    vectors.{f32,ids,json}  Hashed TF-IDF matrix (memory-mapped) for query --semantic
+    serve.sock          Unix socket of a running `serve` (list/query/get are routed to it)
+    runs/<time>.json    Run report per analyze: phase times, counters, LLM latency/tokens/cost
+                        (plus <time>.prof with --profile); the newest 50 are kept
 
 Environment variables:
     ANTHROPIC_API_KEY   Anthropic provider (default)
     OPENAI_API_KEY      OpenAI provider (use --api openai)
     PYRAMID_DB          Override .pyramid/ directory location
+    PYRAMID_SOCKET      Override the serve socket location
+    PYRAMID_NO_SERVER   Set to run list/query/get locally even if a server is up
 """
 
 from __future__ import annotations
 
+# asyncio, email.utils and ProcessPoolExecutor are imported where they are
+# used: only analyze needs them, and read-only commands should start fast.
+import base64
+import bisect
+import contextlib
 import hashlib
+import importlib
+import importlib.util
+import io
 import json
 import logging
+import math
+import mmap
 import os
+import queue
+import random
 import re
 import shutil
+import socket
+import socketserver
+import sqlite3
+import struct
 import subprocess
 import sys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
+import zlib
+from collections.abc import Callable, Coroutine, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
+from types import ModuleType
+from typing import TextIO, TypeVar
 
 import click
 
 logger = logging.getLogger(__name__)
 
+_T = TypeVar("_T")
+
 # ── Optional dependencies (fail gracefully if absent) ──────────────────────
+# Provider SDKs, tree-sitter and numpy take up to a second to import, and
+# list/query/get normally need none of them.  Availability is decided from
+# import specs (no import); each module is imported by the first code path
+# that actually uses it.
+
+
+def _installed(name: str) -> bool:
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
 
-try:
-    import anthropic as _anthropic
 
-    _ANTHROPIC_AVAILABLE = True
-except ImportError:
-    _anthropic = None  # type: ignore[assignment]
-    _ANTHROPIC_AVAILABLE = False
+_ANTHROPIC_AVAILABLE = _installed("anthropic")
+_OPENAI_AVAILABLE = _installed("openai")
+_TREE_SITTER_AVAILABLE = _installed("tree_sitter_language_pack")
+_NUMPY_AVAILABLE = _installed("numpy")
 
-try:
-    import openai as _openai
+_np: ModuleType | None = None  # numpy, bound by _load_numpy()
 
-    _OPENAI_AVAILABLE = True
-except ImportError:
-    _openai = None  # type: ignore[assignment]
-    _OPENAI_AVAILABLE = False
 
-try:
-    import tree_sitter_language_pack as _ts_languages
+def _optional_import(name: str) -> ModuleType | None:
+    """Import an optional dependency on first use; None if it is missing."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
+
 
-    _TREE_SITTER_AVAILABLE = True
-except ImportError:
-    _ts_languages = None  # type: ignore[assignment]
-    _TREE_SITTER_AVAILABLE = False
+def _load_numpy() -> ModuleType | None:
+    global _np
+    if _np is None and _NUMPY_AVAILABLE:
+        _np = _optional_import("numpy")
+    return _np
 
 
 # ─────────────────────────────────────────────
@@ -94,12 +151,227 @@ class Element:
     code: str
     start_line: int
     end_line: int
+    start_byte: int = 0  # byte range of the code in the file (for code references)
+    end_byte: int = 0
 
     def content_hash(self) -> str:
         """SHA-256 of the element's source code."""
         return hashlib.sha256(self.code.encode()).hexdigest()
 
 
+def location_key(path: str, sha: str, ordinal: int = 0) -> str:
+    """Storage key of one occurrence of code *sha* in *path*.
+
+    *ordinal* counts earlier elements of the same file with identical code,
+    so every copy of duplicated code keeps its own entry.  Line numbers are
+    left out: code shifted by an edit above it keeps its key.
+    """
+    return hashlib.sha256(f"{path}\0{sha}\0{ordinal}".encode()).hexdigest()
+
+
+def element_keys(elements: list[Element]) -> list[tuple[Element, str]]:
+    """Pair each of one file's *elements* with its location key."""
+    seen: dict[str, int] = {}
+    keyed = []
+    for element in elements:
+        sha = element.content_hash()
+        keyed.append((element, location_key(element.path, sha, seen.get(sha, 0))))
+        seen[sha] = seen.get(sha, 0) + 1
+    return keyed
+
+
+# ─────────────────────────────────────────────
+# SECTION: Telemetry
+# ─────────────────────────────────────────────
+
+_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # seconds, upper bounds
+# USD per million (input, output) tokens, matched by longest model-name
+# prefix; config.json "prices" ({prefix: [input, output]}) adds or overrides.
+_PRICES: dict[str, tuple[float, float]] = {
+    "claude-haiku-4-5": (1.0, 5.0),
+    "claude-3-5-haiku": (0.8, 4.0),
+    "claude-sonnet-4": (3.0, 15.0),
+    "claude-opus-4-5": (5.0, 25.0),
+    "claude-opus-4": (15.0, 75.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-4o": (2.5, 10.0),
+}
+_RUN_REPORT_VERSION = 1
+
+
+def _price(model: str, prices: dict[str, tuple[float, float]]) -> tuple[float, float] | None:
+    matches = [prefix for prefix in prices if model.startswith(prefix)]
+    return prices[max(matches, key=len)] if matches else None
+
+
+class Telemetry:
+    """Phase timers, counters and per-provider LLM statistics for one run.
+
+    CodeParser, Summarizer and StorageManager each carry a ``telemetry``
+    attribute (a private instance by default); analyze points them at one
+    shared instance and writes its ``report`` to ``.pyramid/runs/``.
+
+    ``phase`` adds the wall and CPU time of the calling thread to a named
+    total; phases may nest, and totals fed by parse workers through ``add``
+    are summed across processes.  With ``profile=True`` a cProfile profiler
+    runs inside every ``cpu_bound`` phase (on the thread that enters it).
+    """
+
+    def __init__(self, profile: bool = False) -> None:
+        self.started = datetime.now(timezone.utc)
+        self._wall0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+        self._lock = threading.Lock()
+        self.phases: dict[str, list[float]] = {}  # name -> [wall, cpu, entries]
+        self.counters: dict[str, int] = {}
+        self._latencies: dict[str, list[float]] = {}  # provider -> call seconds
+        self._llm: dict[str, dict[str, int]] = {}  # provider -> errors/tokens
+        self.profiler: object | None = None
+        if profile:
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+        self._profiling = 0
+
+    def add(self, name: str, wall: float, cpu: float, entries: int = 1) -> None:
+        """Add measured time to phase *name*."""
+        with self._lock:
+            total = self.phases.setdefault(name, [0.0, 0.0, 0])
+            total[0] += wall
+            total[1] += cpu
+            total[2] += entries
+
+    @contextlib.contextmanager
+    def phase(self, name: str, cpu_bound: bool = False) -> Iterator[None]:
+        """Time the enclosed block as part of phase *name*."""
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            if cpu_bound:
+                with self.profiled():
+                    yield
+            else:
+                yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    @contextlib.contextmanager
+    def profiled(self) -> Iterator[None]:
+        """Run the enclosed block under the profiler, if profiling."""
+        if self.profiler is None or threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        if not self._profiling:
+            self.profiler.enable()  # type: ignore[attr-defined]
+        self._profiling += 1
+        try:
+            yield
+        finally:
+            self._profiling -= 1
+            if not self._profiling:
+                self.profiler.disable()  # type: ignore[attr-defined]
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def llm_call(self, provider: str, seconds: float, ok: bool) -> None:
+        """Record one provider request and its latency."""
+        with self._lock:
+            self._latencies.setdefault(provider, []).append(seconds)
+            if not ok:
+                stats = self._llm.setdefault(provider, {})
+                stats["errors"] = stats.get("errors", 0) + 1
+
+    def llm_tokens(self, provider: str, input_tokens: int, output_tokens: int, estimated: bool = False) -> None:
+        """Record token usage; *estimated* when the provider reports none."""
+        with self._lock:
+            stats = self._llm.setdefault(provider, {})
+            stats["input_tokens"] = stats.get("input_tokens", 0) + input_tokens
+            stats["output_tokens"] = stats.get("output_tokens", 0) + output_tokens
+            if estimated:
+                stats["estimated"] = 1
+
+    def tokens(self) -> tuple[int, int]:
+        """Total (input, output) tokens over all providers."""
+        with self._lock:
+            return (
+                sum(s.get("input_tokens", 0) for s in self._llm.values()),
+                sum(s.get("output_tokens", 0) for s in self._llm.values()),
+            )
+
+    @staticmethod
+    def _latency_summary(samples: list[float]) -> dict[str, object]:
+        ordered = sorted(samples)
+
+        def pct(p: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 4)
+
+        histogram: dict[str, int] = {}
+        low = 0
+        for bound in _LATENCY_BUCKETS:
+            high = bisect.bisect_right(ordered, bound)
+            histogram[f"<={bound:g}"] = high - low
+            low = high
+        histogram[f">{_LATENCY_BUCKETS[-1]:g}"] = len(ordered) - low
+        return {
+            "mean": round(sum(ordered) / len(ordered), 4),
+            "p50": pct(0.5),
+            "p90": pct(0.9),
+            "p99": pct(0.99),
+            "max": round(ordered[-1], 4),
+            "histogram": histogram,
+        }
+
+    def report(self, model: str, prices: dict[str, tuple[float, float]] | None = None) -> dict[str, object]:
+        """The run as a JSON-ready dict; cost is None for models without a price."""
+        price = _price(model, {**_PRICES, **(prices or {})})
+        with self._lock:
+            providers: dict[str, object] = {}
+            total_cost: float | None = 0.0
+            for provider in sorted(set(self._latencies) | set(self._llm)):
+                stats = self._llm.get(provider, {})
+                samples = self._latencies.get(provider, [])
+                tokens_in, tokens_out = stats.get("input_tokens", 0), stats.get("output_tokens", 0)
+                cost = None
+                if price is not None and provider != "claude-cli":
+                    cost = round((tokens_in * price[0] + tokens_out * price[1]) / 1e6, 6)
+                total_cost = None if cost is None or total_cost is None else total_cost + cost
+                providers[provider] = {
+                    "requests": len(samples),
+                    "errors": stats.get("errors", 0),
+                    "latency": self._latency_summary(samples) if samples else None,
+                    "input_tokens": tokens_in,
+                    "output_tokens": tokens_out,
+                    "tokens_estimated": bool(stats.get("estimated")),
+                    "cost_usd": cost,
+                }
+            counters = dict(self.counters)
+            phases = {
+                name: {"wall": round(wall, 4), "cpu": round(cpu, 4), "entries": entries}
+                for name, (wall, cpu, entries) in sorted(self.phases.items())
+            }
+
+        def rate(part: str, whole: str) -> float | None:
+            return round(counters.get(part, 0) / counters[whole], 4) if counters.get(whole) else None
+
+        return {
+            "version": _RUN_REPORT_VERSION,
+            "started": self.started.isoformat(timespec="seconds"),
+            "wall_seconds": round(time.perf_counter() - self._wall0, 4),
+            "cpu_seconds": round(time.process_time() - self._cpu0, 4),
+            "phases": phases,
+            "counters": counters,
+            "rates": {
+                "files_unchanged": rate("files_unchanged", "files_found"),
+                "elements_cached": rate("elements_cached", "elements_parsed"),
+                "placeholders": rate("placeholder_summaries", "elements_summarized"),
+            },
+            "model": model,
+            "providers": providers,
+            "cost_usd": round(total_cost, 6) if total_cost is not None and providers else None,
+        }
+
+
 # ─────────────────────────────────────────────
 # SECTION: Storage
 # ─────────────────────────────────────────────
@@ -107,16 +379,96 @@ class Element:
 _INDEX_LEVELS = (4, 8, 16)  # Levels stored in index.json (hot path)
 
 
+def _index_entry(data: dict[str, object]) -> dict[str, object]:
+    """Project a full data record down to its hot-path index entry."""
+    levels = data.get("levels") or {}
+    return {
+        "path": data.get("path", ""),
+        "element_type": data.get("element_type", "file"),
+        "name": data.get("name", ""),
+        "levels": {
+            k: v for k, v in levels.items()  # type: ignore[union-attr]
+            if k in {str(lvl) for lvl in _INDEX_LEVELS}
+        },
+    }
+
+
+def _stat_fingerprint(st: os.stat_result) -> dict[str, int]:
+    """Return the manifest fields that identify an unchanged file without reading it."""
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "inode": st.st_ino}
+
+
+def _normalize_path(path: str) -> str:
+    """Case-fold and slash-normalize a path for prefix matching."""
+    return path.lower().replace("\\", "/")
+
+
+PathKey = tuple[str, int, str, str]
+_PATHS_HEADER = "#pyramid-paths 1 {} {}\n"  # index.json (mtime_ns, size) it was built from
+
+
+def _path_key(sha: str, entry: dict[str, object]) -> PathKey:
+    """Sort key of an element in the path index: file first, then its members by name."""
+    return (
+        _normalize_path(str(entry.get("path", ""))),
+        0 if entry.get("element_type") == "file" else 1,
+        str(entry.get("name", "")).lower(),
+        sha,
+    )
+
+
+class ReadOnlyStoreError(RuntimeError):
+    """A write was attempted on a passive store."""
+
+
 class StorageManager:
-    """Read and write the .pyramid/ directory."""
+    """Read and write the .pyramid/ directory (JSON backend).
+
+    Layout: ``index.json`` holds the hot levels of every element and
+    ``data/<sha>.json`` holds the full record.  The point-query methods
+    (``get_entry``, ``iter_entries``, ``find_by_path``, ``put_element``) are
+    the interface shared with the other backends; commands use only those.
+
+    ``put_element`` writes the data file, then appends the index entry to
+    ``journal.jsonl``; ``commit`` (and every ``COMPACT_EVERY`` writes)
+    atomically rewrites index.json and removes the journal.  A journal left
+    behind means an interrupted run: loading the index replays it and adopts
+    any ``data/`` file the index does not know, so no stored summary is lost.
+
+    A *passive* instance (``serve``) shares the directory with a writer that
+    may still be running: it replays the journal in memory but never
+    compacts it, and ``refresh`` picks up the writer's progress.  Its
+    writes raise ``ReadOnlyStoreError``: a stale copy of the index must
+    never be committed over the writer's.
+    """
 
     VERSION = 1
+    BACKEND = "json"
+    COMPACT_EVERY = 2000
+    RUNS_KEPT = 50  # run reports (and profiles) kept in runs/
 
     def __init__(self, pyramid_dir: Path) -> None:
         self.pyramid_dir = pyramid_dir
         self.data_dir = pyramid_dir / "data"
         self.index_path = pyramid_dir / "index.json"
         self.config_path = pyramid_dir / "config.json"
+        self.manifest_path = pyramid_dir / "manifest.json"
+        self.retry_path = pyramid_dir / "retry.json"
+        self.batch_path = pyramid_dir / "batch.json"
+        self.journal_path = pyramid_dir / "journal.jsonl"
+        self.paths_path = pyramid_dir / "paths.idx"
+        self.runs_dir = pyramid_dir / "runs"
+        self.telemetry = Telemetry()
+        self._index: dict[str, dict[str, object]] | None = None
+        # Sorted path keys of the cached index, built on first use and kept
+        # in step by put/delete, so prefix lookups are a bisect.
+        self._paths: list[PathKey] | None = None
+        self._journal: TextIO | None = None
+        self._journal_writes = 0
+        self._index_stamp: tuple[int, int] | None = None
+        self._journal_offset = 0  # bytes of journal.jsonl already applied (passive)
+        self.recovered = 0  # entries restored from an interrupted run
+        self.passive = False
 
     def init(self, api: str = "anthropic") -> None:
         """Create .pyramid/ directory structure."""
@@ -128,7 +480,8 @@ class StorageManager:
                 "version": self.VERSION,
                 "created": datetime.now(timezone.utc).isoformat(),
                 "api": api,
-            })
+                "backend": self.BACKEND,
+            }, pretty=True)
 
         if not self.index_path.exists():
             _write_json(self.index_path, {})
@@ -143,6 +496,10 @@ class StorageManager:
             return {}
         return _read_json(self.config_path)
 
+    def save_config(self, config: dict[str, object]) -> None:
+        """Persist config.json."""
+        _write_json(self.config_path, config, pretty=True)
+
     def load_index(self) -> dict[str, dict[str, object]]:
         """Load index.json, returning empty dict if missing."""
         if not self.index_path.exists():
@@ -152,6 +509,8 @@ class StorageManager:
     def save_index(self, index: dict[str, dict[str, object]]) -> None:
         """Persist index.json."""
         _write_json(self.index_path, index)
+        self._index = index
+        self._paths = None
 
     def load_data(self, sha: str) -> dict[str, object] | None:
         """Load data/<sha>.json, returning None if missing."""
@@ -160,19 +519,1709 @@ class StorageManager:
             return None
         return _read_json(path)
 
+    def _check_writable(self) -> None:
+        if self.passive:
+            raise ReadOnlyStoreError(f"{self.pyramid_dir} is open read-only")
+
     def save_data(self, sha: str, data: dict[str, object]) -> None:
         """Persist data/<sha>.json."""
+        self._check_writable()
         _write_json(self.data_dir / f"{sha}.json", data)
 
+    def load_manifest(self) -> dict[str, object]:
+        """Load manifest.json (per-file stat fingerprints), or an empty manifest."""
+        if not self.manifest_path.exists():
+            return {"root": None, "files": {}}
+        return _read_json(self.manifest_path)
+
+    def save_manifest(self, manifest: dict[str, object]) -> None:
+        """Persist manifest.json."""
+        _write_json(self.manifest_path, manifest)
+
+    def load_retry_queue(self) -> dict[str, dict[str, object]]:
+        """Load retry.json: {sha: {path, name, error, attempts, failed_at}}."""
+        if not self.retry_path.exists():
+            return {}
+        return _read_json(self.retry_path)  # type: ignore[return-value]
+
+    def save_retry_queue(self, queue_: dict[str, dict[str, object]]) -> None:
+        """Persist retry.json, removing it once the queue is empty."""
+        if queue_:
+            _write_json(self.retry_path, queue_)  # type: ignore[arg-type]
+        else:
+            self.retry_path.unlink(missing_ok=True)
+
+    def load_batch_job(self) -> dict[str, object] | None:
+        """Load batch.json (the in-flight --batch-api job), or None."""
+        if not self.batch_path.exists():
+            return None
+        return _read_json(self.batch_path)
+
+    def save_batch_job(self, job: dict[str, object] | None) -> None:
+        """Persist batch.json, removing it when *job* is None."""
+        if job is not None:
+            _write_json(self.batch_path, job)
+        else:
+            self.batch_path.unlink(missing_ok=True)
+
+    def save_run_report(self, report: dict[str, object]) -> Path:
+        """Write *report* to runs/<start time>.json and drop all but the newest RUNS_KEPT runs."""
+        self.runs_dir.mkdir(exist_ok=True)
+        stem = f"{datetime.fromisoformat(str(report['started'])):%Y%m%dT%H%M%SZ}"
+        path = self.runs_dir / f"{stem}.json"
+        suffix = 0
+        while path.exists():  # several runs within one second
+            suffix += 1
+            path = self.runs_dir / f"{stem}.{suffix}.json"
+        _write_json(path, report)
+        runs = sorted(self.runs_dir.glob("*.json"), key=lambda p: p.stat().st_mtime_ns)
+        for old in runs[: max(0, len(runs) - self.RUNS_KEPT)]:
+            old.unlink(missing_ok=True)
+            old.with_suffix(".prof").unlink(missing_ok=True)
+        return path
+
+    # ── Point-query interface (shared by all backends) ──
+
+    def _cached_index(self) -> dict[str, dict[str, object]]:
+        if self._index is None:
+            self._index_stamp = self._stamp(self.index_path)
+            self._index = self.load_index()
+            self._journal_offset = 0
+            if self.journal_path.exists():
+                if self.passive:
+                    self._replay_journal(self._index)
+                else:
+                    self._recover(self._index)
+        return self._index
+
+    @staticmethod
+    def _stamp(path: Path) -> tuple[int, int] | None:
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _replay_journal(self, index: dict[str, dict[str, object]]) -> set[str]:
+        """Apply complete journal records past ``_journal_offset``; return deleted shas."""
+        deleted: set[str] = set()
+        try:
+            journal = self.journal_path.open("rb")
+        except OSError:
+            return deleted
+        with journal:
+            journal.seek(self._journal_offset)
+            for line in journal:
+                if not line.endswith(b"\n"):
+                    break  # still being written, or torn by a crash
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self._journal_offset += len(line)
+                sha, entry = record["sha"], record["entry"]
+                if entry is None:  # delete_element
+                    index.pop(sha, None)
+                    deleted.add(sha)
+                    continue
+                deleted.discard(sha)
+                if sha not in index:
+                    self.recovered += 1
+                index[sha] = entry
+        return deleted
+
+    def refresh(self) -> bool:
+        """Pick up writes another process made since the index was loaded.
+
+        Journal records appended since the last look are applied in place; a
+        rewritten index.json (compaction) drops the cache for a lazy reload.
+        Returns True when anything changed.
+        """
+        if self._index is None:
+            return False
+        if self._stamp(self.index_path) != self._index_stamp:
+            self._index = None
+            self._paths = None
+            return True
+        before = self._journal_offset
+        self._replay_journal(self._index)
+        if self._journal_offset == before:
+            return False
+        self._paths = None
+        return True
+
+    def _recover(self, index: dict[str, dict[str, object]]) -> None:
+        """Fold journal entries and orphaned data files into *index*, then compact."""
+        deleted = self._replay_journal(index)
+        self._adopt_orphans(index, deleted)
+        _write_json(self.index_path, index, durable=True)
+        self.journal_path.unlink(missing_ok=True)
+
+    def _adopt_orphans(self, index: dict[str, dict[str, object]], deleted: set[str]) -> None:
+        """Index data written by an interrupted run but never journalled."""
+        # A data file is written before its journal line, so the crash may
+        # have landed in between.  Deletions are journalled first instead.
+        if self.data_dir.exists():
+            for item in os.scandir(self.data_dir):
+                if item.name.endswith(".tmp"):
+                    Path(item.path).unlink(missing_ok=True)
+                    continue
+                sha = item.name.removesuffix(".json")
+                if sha in deleted:
+                    Path(item.path).unlink(missing_ok=True)
+                    continue
+                if sha == item.name or sha in index:
+                    continue
+                try:
+                    data = _read_json(Path(item.path))
+                except (OSError, ValueError):
+                    logger.warning("Skipping unreadable data file %s", item.path)
+                    continue
+                index[sha] = _index_entry(data)
+                self.recovered += 1
+
+    def recover(self) -> int:
+        """Load the index (recovering an interrupted run); return entries restored."""
+        self._cached_index()
+        return self.recovered
+
+    def count(self) -> int:
+        """Return the number of indexed elements."""
+        return len(self._cached_index())
+
+    def has_entry(self, sha: str) -> bool:
+        """Return True if *sha* is indexed."""
+        return sha in self._cached_index()
+
+    def get_entry(self, sha: str) -> dict[str, object] | None:
+        """Return the hot-path index entry for *sha*, or None."""
+        return self._cached_index().get(sha)
+
+    def iter_entries(
+        self, element_type: str | None = None
+    ) -> Iterator[tuple[str, dict[str, object]]]:
+        """Yield (sha, entry) pairs, optionally restricted to one element type."""
+        for sha, entry in self._cached_index().items():
+            if element_type and entry.get("element_type") != element_type:
+                continue
+            yield sha, entry
+
+    def _path_index(self) -> list[PathKey]:
+        index = self._cached_index()
+        if self._paths is None:
+            self._paths = sorted(_path_key(sha, entry) for sha, entry in index.items())
+        return self._paths
+
+    def _unlist_path(self, sha: str, entry: dict[str, object] | None) -> None:
+        if self._paths is None or entry is None:
+            return
+        key = _path_key(sha, entry)
+        i = bisect.bisect_left(self._paths, key)
+        if i < len(self._paths) and self._paths[i] == key:
+            del self._paths[i]
+
+    def _path_file(self) -> mmap.mmap | None:
+        """paths.idx mapped read-only, if it matches index.json and no journal is pending.
+
+        ``commit`` writes index.json in ``_path_key`` order and then
+        paths.idx: one line per element, ``path_norm NUL kind NUL name NUL
+        sha``, whose byte order is that same order -- so it can be bisected
+        in place without loading the index.
+        """
+        stamp = self._stamp(self.index_path)
+        if stamp is None or self.journal_path.exists():
+            return None
+        try:
+            f = self.paths_path.open("rb")
+        except OSError:
+            return None
+        with f:
+            if f.readline() != _PATHS_HEADER.format(*stamp).encode():
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _index_in_path_order(self) -> bool:
+        """True when the loaded index is exactly what ``commit`` last wrote, in path order."""
+        buf = self._path_file()
+        if buf is None:
+            return False
+        buf.close()
+        return True
+
+    def _write_path_index(self) -> None:
+        stamp = self._stamp(self.index_path)
+        keys = self._path_index()
+        if stamp is None or any("\n" in path or "\n" in name for path, _kind, name, _sha in keys):
+            self.paths_path.unlink(missing_ok=True)  # lookups fall back to the loaded index
+            return
+        tmp = self.paths_path.with_name(f"{self.paths_path.name}.{os.getpid()}.tmp")
+        with tmp.open("w", encoding="utf-8", newline="\n") as f:
+            f.write(_PATHS_HEADER.format(*stamp))
+            f.writelines(f"{path}\0{kind}\0{name}\0{sha}\n" for path, kind, name, sha in keys)
+        os.replace(tmp, self.paths_path)
+
+    def iter_sorted(
+        self, element_type: str | None = None
+    ) -> Iterator[tuple[str, dict[str, object]]]:
+        """Like ``iter_entries``, in path order (each file before its members)."""
+        index = self._cached_index()
+        if self._paths is None and self._index_in_path_order():
+            ordered = index.items()
+        else:
+            ordered = ((key[3], index[key[3]]) for key in self._path_index())  # type: ignore[assignment]
+        for sha, entry in ordered:
+            if element_type and entry.get("element_type") != element_type:
+                continue
+            yield sha, entry
+
+    def find_by_path(self, prefix: str) -> list[tuple[str, dict[str, object]]]:
+        """Return (sha, entry) pairs whose path starts with *prefix* (case-insensitive).
+
+        A bisect into the sorted path index plus a scan of the matches, so
+        the cost does not grow with the size of the repo.  Before the index
+        is loaded this runs on paths.idx and reads only the matching data
+        files.
+        """
+        needle = _normalize_path(prefix)
+        if self._index is None and (buf := self._path_file()) is not None:
+            with buf:
+                lines = _prefix_lines(buf, needle.encode())
+            matches: list[tuple[str, dict[str, object]]] = []
+            for line in lines:
+                sha = line.rpartition(b"\0")[2].decode()
+                data = self.load_data(sha)
+                if data is not None:
+                    matches.append((sha, _index_entry(data)))
+            return matches
+        index = self._cached_index()
+        paths = self._path_index()
+        matches = []
+        for i in range(bisect.bisect_left(paths, (needle,)), len(paths)):
+            if not paths[i][0].startswith(needle):
+                break
+            matches.append((paths[i][3], index[paths[i][3]]))
+        return matches
+
+    def _open_journal(self) -> TextIO:
+        if self._journal is None:
+            # Opened before the first data file so recovery knows to look.
+            self._journal = self.journal_path.open("a", encoding="utf-8")
+        return self._journal
+
+    def _journal_append(self, sha: str, entry: dict[str, object] | None) -> None:
+        journal = self._open_journal()
+        journal.write(json.dumps({"sha": sha, "entry": entry}, ensure_ascii=False) + "\n")
+        journal.flush()
+        self._journal_writes += 1
+        if self._journal_writes >= self.COMPACT_EVERY:
+            self.commit()
+
+    def put_element(self, sha: str, data: dict[str, object]) -> None:
+        """Store a full element record and journal its index entry."""
+        self._check_writable()
+        with self.telemetry.phase("store", cpu_bound=True):
+            index = self._cached_index()
+            self._open_journal()
+            self.save_data(sha, data)
+            entry = _index_entry(data)
+            self._unlist_path(sha, index.get(sha))
+            index[sha] = entry
+            if self._paths is not None:
+                bisect.insort(self._paths, _path_key(sha, entry))
+            self._journal_append(sha, entry)
+
+    def delete_element(self, sha: str) -> None:
+        """Remove *sha* from the index and delete its data file."""
+        self._check_writable()
+        index = self._cached_index()
+        self._journal_append(sha, None)
+        self._unlist_path(sha, index.pop(sha, None))
+        self._delete_data(sha)
+
+    def _delete_data(self, sha: str) -> None:
+        (self.data_dir / f"{sha}.json").unlink(missing_ok=True)
+
+    def _data_bytes(self, sha: str) -> int:
+        try:
+            return (self.data_dir / f"{sha}.json").stat().st_size
+        except OSError:
+            return 0
+
+    def element_bytes(self, sha: str) -> int:
+        """Approximate on-disk bytes held by *sha* (data file plus index entry)."""
+        entry = self._cached_index().get(sha)
+        return self._data_bytes(sha) + (len(json.dumps(entry, ensure_ascii=False)) if entry else 0)
+
+    def repack(self) -> int:
+        """Reclaim space held by overwritten or deleted records; return bytes freed.
+
+        Only the pack backend keeps such records; elsewhere this is a no-op.
+        """
+        return 0
+
+    def commit(self) -> None:
+        """Atomically rewrite index.json with all entries and drop the journal."""
+        self._check_writable()
+        if self._index is None:
+            return
+        with self.telemetry.phase("commit", cpu_bound=True):
+            self._index = {key[3]: self._index[key[3]] for key in self._path_index()}
+            _write_json(self.index_path, self._index, durable=True)
+            self._write_path_index()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self.journal_path.unlink(missing_ok=True)
+        self._journal_writes = 0
+
+    def close(self) -> None:
+        """Release the journal handle; uncommitted entries stay recoverable."""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+def _prefix_lines(buf: mmap.mmap, prefix: bytes) -> list[bytes]:
+    """Lines of the sorted *buf* (after its header line) that start with *prefix*."""
+    start = buf.find(b"\n") + 1
+    lo, hi = start, len(buf)
+    while lo < hi:  # lo ends on the first line >= prefix
+        mid = (lo + hi) // 2
+        line_start = buf.rfind(b"\n", start - 1, mid) + 1
+        line_end = buf.find(b"\n", line_start)
+        if buf[line_start:line_end] < prefix:
+            lo = line_end + 1
+        else:
+            hi = line_start
+    lines: list[bytes] = []
+    buf.seek(lo)
+    for line in iter(buf.readline, b""):
+        if not line.startswith(prefix):
+            break
+        lines.append(line.rstrip(b"\n"))
+    return lines
+
 
 def _read_json(path: Path) -> dict[str, object]:
     with path.open(encoding="utf-8") as f:
         return json.load(f)  # type: ignore[no-any-return]
 
 
-def _write_json(path: Path, data: dict[str, object]) -> None:
-    with path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+def _write_json(path: Path, data: dict[str, object], durable: bool = False, pretty: bool = False) -> None:
+    """Write *data* atomically (temp file + rename); *durable* also fsyncs it.
+
+    Only hand-edited files (config.json) are *pretty*: indentation forces the
+    pure-Python encoder, several times slower on a large index.json.
+    """
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        if pretty:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        else:
+            f.write(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+_SQLITE_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS elements (
+    sha          TEXT PRIMARY KEY,
+    path         TEXT NOT NULL,
+    path_norm    TEXT NOT NULL,
+    element_type TEXT NOT NULL,
+    name         TEXT NOT NULL,
+    start_line   INTEGER NOT NULL DEFAULT 1,
+    end_line     INTEGER NOT NULL DEFAULT 1,
+    code         TEXT NOT NULL DEFAULT '',
+    levels       TEXT NOT NULL DEFAULT '{}',
+    code_ref     TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_elements_path_norm ON elements(path_norm);
+CREATE INDEX IF NOT EXISTS idx_elements_type ON elements(element_type, path_norm);
+"""
+
+
+class SQLiteStorage(StorageManager):
+    """Single-file SQLite backend (``pyramid.db``, WAL mode).
+
+    Every element is one row holding all levels and the source code, with
+    indexes on sha, normalized path and element type so ``get``/``list``/
+    ``query`` become point or range queries.  Writes from ``put_element`` are
+    grouped into transactions of up to ``BATCH_SIZE`` rows, committed at
+    least every ``COMMIT_INTERVAL`` seconds so a killed run loses no more.
+    """
+
+    BACKEND = "sqlite"
+    BATCH_SIZE = 500
+    COMMIT_INTERVAL = 2.0
+
+    def __init__(self, pyramid_dir: Path) -> None:
+        super().__init__(pyramid_dir)
+        self.db_path = pyramid_dir / "pyramid.db"
+        self._conn: sqlite3.Connection | None = None
+        self._pending_writes = 0
+        self._last_commit = time.monotonic()
+        self._lock = threading.Lock()
+
+    def init(self, api: str = "anthropic") -> None:
+        """Create .pyramid/ and the database schema."""
+        self.pyramid_dir.mkdir(exist_ok=True)
+        if not self.config_path.exists():
+            _write_json(self.config_path, {
+                "version": self.VERSION,
+                "created": datetime.now(timezone.utc).isoformat(),
+                "api": api,
+                "backend": self.BACKEND,
+            }, pretty=True)
+        self._connect()
+
+    def is_initialized(self) -> bool:
+        """Return True if the database file exists."""
+        return self.db_path.exists()
+
+    def recover(self) -> int:
+        """Nothing to replay: rows are durable once their transaction commits."""
+        return 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SQLITE_SCHEMA)
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(elements)")}
+            if "code_ref" not in columns:  # databases from before code references
+                self._conn.execute("ALTER TABLE elements ADD COLUMN code_ref TEXT NOT NULL DEFAULT ''")
+        return self._conn
+
+    @staticmethod
+    def _row_to_data(row: sqlite3.Row) -> dict[str, object]:
+        data: dict[str, object] = {
+            "path": row["path"],
+            "element_type": row["element_type"],
+            "name": row["name"],
+            "start_line": row["start_line"],
+            "end_line": row["end_line"],
+        }
+        if row["code_ref"]:
+            data["code_ref"] = json.loads(row["code_ref"])
+        else:
+            data["code"] = row["code"]
+        data["levels"] = json.loads(row["levels"])
+        return data
+
+    def load_index(self) -> dict[str, dict[str, object]]:
+        """Materialize every row as an index entry (migration and compatibility only)."""
+        return dict(self.iter_entries())
+
+    def save_index(self, index: dict[str, dict[str, object]]) -> None:
+        """Upsert index entries, merging their levels into existing rows."""
+        for sha, entry in index.items():
+            current = self.load_data(sha) or {}
+            levels = {**dict(current.get("levels") or {}), **dict(entry.get("levels") or {})}  # type: ignore[arg-type]
+            self.put_element(sha, {**current, **entry, "levels": levels})
+        self.commit()
+
+    def load_data(self, sha: str) -> dict[str, object] | None:
+        """Return the full record for *sha*, or None."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT * FROM elements WHERE sha = ?", (sha,)
+            ).fetchone()
+        return self._row_to_data(row) if row else None
+
+    def save_data(self, sha: str, data: dict[str, object]) -> None:
+        """Upsert the full record for *sha* and commit immediately."""
+        self.put_element(sha, data)
+        self.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return int(self._connect().execute("SELECT COUNT(*) FROM elements").fetchone()[0])
+
+    def has_entry(self, sha: str) -> bool:
+        with self._lock:
+            return self._connect().execute(
+                "SELECT 1 FROM elements WHERE sha = ?", (sha,)
+            ).fetchone() is not None
+
+    def get_entry(self, sha: str) -> dict[str, object] | None:
+        data = self.load_data(sha)
+        return _index_entry(data) if data else None
+
+    def iter_entries(
+        self, element_type: str | None = None
+    ) -> Iterator[tuple[str, dict[str, object]]]:
+        sql = "SELECT sha, path, element_type, name, levels FROM elements"
+        params: tuple[str, ...] = ()
+        if element_type:
+            sql += " WHERE element_type = ?"
+            params = (element_type,)
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        for row in rows:
+            yield row["sha"], _index_entry({
+                "path": row["path"],
+                "element_type": row["element_type"],
+                "name": row["name"],
+                "levels": json.loads(row["levels"]),
+            })
+
+    def iter_sorted(
+        self, element_type: str | None = None
+    ) -> Iterator[tuple[str, dict[str, object]]]:
+        # idx_elements_path_norm supplies the order; only each file's members are sorted.
+        sql = "SELECT sha, path, element_type, name, levels FROM elements"
+        params: tuple[str, ...] = ()
+        if element_type:
+            sql += " WHERE element_type = ?"
+            params = (element_type,)
+        sql += " ORDER BY path_norm, element_type <> 'file', lower(name), sha"
+        with self._lock:
+            rows = self._connect().execute(sql, params).fetchall()
+        for row in rows:
+            yield row["sha"], _index_entry({
+                "path": row["path"],
+                "element_type": row["element_type"],
+                "name": row["name"],
+                "levels": json.loads(row["levels"]),
+            })
+
+    def find_by_path(self, prefix: str) -> list[tuple[str, dict[str, object]]]:
+        needle = _normalize_path(prefix)
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT * FROM elements WHERE path_norm >= ? AND path_norm < ? "
+                "ORDER BY path_norm, start_line",
+                (needle, needle + "\U0010ffff"),
+            ).fetchall()
+        return [(row["sha"], _index_entry(self._row_to_data(row))) for row in rows]
+
+    def put_element(self, sha: str, data: dict[str, object]) -> None:
+        self._check_writable()
+        path = str(data.get("path", ""))
+        with self._lock, self.telemetry.phase("store", cpu_bound=True):
+            self._connect().execute(
+                "INSERT INTO elements "
+                "(sha, path, path_norm, element_type, name, start_line, end_line, code, levels, code_ref) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(sha) DO UPDATE SET "
+                "path = excluded.path, path_norm = excluded.path_norm, "
+                "element_type = excluded.element_type, name = excluded.name, "
+                "start_line = excluded.start_line, end_line = excluded.end_line, "
+                "code = excluded.code, levels = excluded.levels, code_ref = excluded.code_ref",
+                (
+                    sha,
+                    path,
+                    _normalize_path(path),
+                    str(data.get("element_type", "file")),
+                    str(data.get("name", "")),
+                    int(data.get("start_line", 1)),  # type: ignore[arg-type]
+                    int(data.get("end_line", 1)),  # type: ignore[arg-type]
+                    str(data.get("code", "")),
+                    json.dumps(data.get("levels") or {}, ensure_ascii=False),
+                    json.dumps(data["code_ref"]) if data.get("code_ref") else "",
+                ),
+            )
+            self._count_write()
+
+    def delete_element(self, sha: str) -> None:
+        self._check_writable()
+        with self._lock:
+            self._connect().execute("DELETE FROM elements WHERE sha = ?", (sha,))
+            self._count_write()
+
+    def _count_write(self) -> None:
+        """Commit once the transaction is full or old enough (caller holds _lock)."""
+        self._pending_writes += 1
+        now = time.monotonic()
+        if self._pending_writes >= self.BATCH_SIZE or now - self._last_commit >= self.COMMIT_INTERVAL:
+            self._conn.commit()  # type: ignore[union-attr]
+            self._pending_writes = 0
+            self._last_commit = now
+
+    def element_bytes(self, sha: str) -> int:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT length(path) + length(name) + length(code) + length(levels) + length(code_ref) "
+                "FROM elements WHERE sha = ?",
+                (sha,),
+            ).fetchone()
+        return int(row[0]) if row else 0
+
+    def commit(self) -> None:
+        self._check_writable()
+        with self._lock, self.telemetry.phase("commit"):
+            if self._conn is not None:
+                self._conn.commit()
+            self._pending_writes = 0
+            self._last_commit = time.monotonic()
+
+    def close(self) -> None:
+        if not self.passive:
+            self.commit()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+_PACK_HEADER = struct.Struct("<8s8s")  # magic, pack id (new on every repack)
+_PACK_RECORD = struct.Struct("<IH")  # body bytes (0 = key deleted), key bytes
+_PACK_INDEX_HEADER = struct.Struct("<8s8sQ")  # magic, id of the pack it indexes, pack bytes covered
+_PACK_INDEX_ENTRY = struct.Struct("<16sQI")  # key digest, record offset, record bytes
+_PACK_MAGIC = b"PYRPACK1"
+_PACK_INDEX_MAGIC = b"PYRPIDX1"
+
+
+def _pack_digest(key: str) -> bytes:
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+class PackStorage(StorageManager):
+    """Packfile backend: full records in one append-only ``pack/elements.pack``.
+
+    ``index.json``, ``journal.jsonl`` and ``paths.idx`` work as in the JSON
+    backend; only the per-element data files are replaced.  Each record is
+    a ``_PACK_RECORD`` header, the key and the compact JSON body; a record
+    with an empty body deletes its key.  ``commit`` writes
+    ``pack/elements.idx``, fixed-size entries sorted by key digest, so
+    ``load_data`` is a bisect of the memory-mapped index and one slice of
+    the memory-mapped pack.  Records appended after the index was written
+    (the tail) are found by scanning from the offset it covers.
+
+    Overwritten and deleted records stay in the pack until ``repack``
+    copies the live ones into a new pack; ``commit`` does that once dead
+    records make up ``REPACK_RATIO`` of the file.  A crash between the two
+    renames leaves an index naming the old pack id, which is then ignored
+    and the whole pack scanned instead.
+
+    Appends, commits and repacks hold an exclusive ``flock`` on
+    ``pack/elements.lock`` (POSIX only), so a second writer such as
+    ``get --level`` next to a running ``watch`` takes each record's offset
+    from the real end of the pack and merges, rather than replaces, the
+    index the other one wrote.
+    """
+
+    BACKEND = "pack"
+    REPACK_RATIO = 0.5
+    REPACK_MIN_BYTES = 1 << 20  # never rewrite the pack to free less than this
+
+    def __init__(self, pyramid_dir: Path) -> None:
+        super().__init__(pyramid_dir)
+        self.pack_dir = pyramid_dir / "pack"
+        self.pack_path = self.pack_dir / "elements.pack"
+        self.pack_index_path = self.pack_dir / "elements.idx"
+        self._pack_lock = threading.RLock()
+        self._pack_map: mmap.mmap | None = None
+        self._pack_index_map: mmap.mmap | None = None
+        self._pack_id = b""
+        self._scanned = 0  # end of the last complete record seen
+        self._tail: dict[str, tuple[int, int] | None] = {}  # key -> (offset, bytes); None = deleted
+        self._pack_writer: io.BufferedWriter | None = None
+        self._pack_ino = 0
+        self._lock_file: io.BufferedWriter | None = None
+        self._locked = False
+
+    def init(self, api: str = "anthropic") -> None:
+        """Create .pyramid/, an empty pack and an empty index.json."""
+        self.pyramid_dir.mkdir(exist_ok=True)
+        self.pack_dir.mkdir(exist_ok=True)
+        if not self.config_path.exists():
+            _write_json(self.config_path, {
+                "version": self.VERSION,
+                "created": datetime.now(timezone.utc).isoformat(),
+                "api": api,
+                "backend": self.BACKEND,
+            }, pretty=True)
+        if not self.index_path.exists():
+            _write_json(self.index_path, {})
+        if not self.pack_path.exists():
+            with self.pack_path.open("wb") as f:
+                f.write(_PACK_HEADER.pack(_PACK_MAGIC, os.urandom(8)))
+
+    # ── Pack access (callers hold _pack_lock) ──
+
+    @contextlib.contextmanager
+    def _writer_lock(self) -> Iterator[None]:
+        """Hold the cross-process writer lock; re-entrant within one instance."""
+        if self._locked:
+            yield
+            return
+        if self._lock_file is None:
+            self._lock_file = (self.pack_dir / "elements.lock").open("ab")
+        fcntl = _optional_import("fcntl")  # not on Windows: writers are unguarded there
+        if fcntl is not None:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        self._locked = True
+        try:
+            yield
+        finally:
+            self._locked = False
+            if fcntl is not None:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _reopen_pack(self) -> None:
+        """Drop the cached maps and tail and load the pack and index as on disk."""
+        if self._pack_writer is not None:
+            os.fsync(self._pack_writer.fileno())
+        self._close_pack()
+        self._open_pack()
+
+    def _close_pack(self) -> None:
+        for view in (self._pack_map, self._pack_index_map):
+            if view is not None:
+                view.close()
+        if self._pack_writer is not None:
+            self._pack_writer.close()
+        self._pack_map = self._pack_index_map = self._pack_writer = None
+        self._pack_id = b""
+        self._tail = {}
+
+    def _open_pack(self) -> bool:
+        """Map the pack and its index and scan the tail; False if there is no pack."""
+        if self._pack_map is not None:
+            return True
+        try:
+            f = self.pack_path.open("rb")
+        except OSError:
+            return False
+        with f:
+            magic, self._pack_id = _PACK_HEADER.unpack(f.read(_PACK_HEADER.size))
+            if magic != _PACK_MAGIC:
+                raise ValueError(f"Not a pyramid pack: {self.pack_path}")
+            self._pack_ino = os.fstat(f.fileno()).st_ino
+            self._pack_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._scanned = _PACK_HEADER.size
+        try:
+            with self.pack_index_path.open("rb") as f:
+                magic, pack_id, covered = _PACK_INDEX_HEADER.unpack(f.read(_PACK_INDEX_HEADER.size))
+                if magic == _PACK_INDEX_MAGIC and pack_id == self._pack_id and covered <= len(self._pack_map):
+                    self._pack_index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._scanned = covered
+        except (OSError, struct.error):
+            pass
+        self._scan_tail()
+        return True
+
+    def _pack_view(self, end: int) -> mmap.mmap:
+        """The pack mapping, re-mapped if *end* lies past it (the pack grew)."""
+        assert self._pack_map is not None
+        if end > len(self._pack_map):
+            self._pack_map.close()
+            with self.pack_path.open("rb") as f:
+                self._pack_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._pack_map
+
+    def _scan_tail(self) -> int:
+        """Add the records past ``_scanned`` to the tail, stopping at a torn one.
+
+        Returns the size of the pack file.
+        """
+        size = self.pack_path.stat().st_size
+        view = self._pack_view(size)
+        offset = self._scanned
+        while offset + _PACK_RECORD.size <= size:
+            body_len, key_len = _PACK_RECORD.unpack_from(view, offset)
+            end = offset + _PACK_RECORD.size + key_len + body_len
+            if end > size:
+                break
+            key = view[offset + _PACK_RECORD.size : offset + _PACK_RECORD.size + key_len].decode()
+            self._tail[key] = (offset, end - offset) if body_len else None
+            offset = end
+        self._scanned = offset
+        return size
+
+    def _index_entries(self) -> Iterator[tuple[bytes, int, int]]:
+        view = self._pack_index_map
+        if view is not None:
+            yield from _PACK_INDEX_ENTRY.iter_unpack(view[_PACK_INDEX_HEADER.size :])
+
+    def _locate(self, key: str) -> tuple[int, int] | None:
+        """(offset, bytes) of *key*'s live record, or None."""
+        if key in self._tail:
+            return self._tail[key]
+        view = self._pack_index_map
+        if view is None:
+            return None
+        digest = _pack_digest(key)
+        size, base = _PACK_INDEX_ENTRY.size, _PACK_INDEX_HEADER.size
+        lo, hi = 0, (len(view) - base) // size
+        count = hi
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if view[base + mid * size : base + mid * size + 16] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo, count):  # more than one only on a digest collision
+            found, offset, length = _PACK_INDEX_ENTRY.unpack_from(view, base + i * size)
+            if found != digest:
+                break
+            if self._read_record(offset, length)[0] == key:
+                return offset, length
+        return None
+
+    def _read_record(self, offset: int, length: int) -> tuple[str, bytes]:
+        view = self._pack_view(offset + length)
+        _body_len, key_len = _PACK_RECORD.unpack_from(view, offset)
+        start = offset + _PACK_RECORD.size
+        return view[start : start + key_len].decode(), view[start + key_len : offset + length]
+
+    def _append(self, key: str, body: bytes) -> None:
+        with self._writer_lock():
+            if not self._open_pack():
+                raise FileNotFoundError(self.pack_path)
+            if self.pack_path.stat().st_ino != self._pack_ino:
+                self._reopen_pack()  # repacked by another writer
+            if self._scan_tail() > self._scanned:
+                # A record torn by a crash: cut it off, or every later record
+                # would sit behind it where no scan can reach.
+                end = self._scanned
+                self._close_pack()
+                os.truncate(self.pack_path, end)
+                self._open_pack()
+            if self._pack_writer is None:
+                self._pack_writer = self.pack_path.open("ab")
+            encoded = key.encode()
+            record = _PACK_RECORD.pack(len(body), len(encoded)) + encoded + body
+            offset = self._pack_writer.seek(0, os.SEEK_END)
+            self._pack_writer.write(record)
+            self._pack_writer.flush()
+            self._tail[key] = (offset, len(record)) if body else None
+            self._scanned = offset + len(record)
+
+    def _write_pack_index(self) -> int:
+        """Fold the tail into elements.idx; return the live record bytes.
+
+        Called under the writer lock.  The index and tail are reloaded
+        first, so entries another writer committed, and its records past
+        them, are kept.
+        """
+        self._reopen_pack()
+        tail = {_pack_digest(key): loc for key, loc in self._tail.items()}
+        entries = [entry for entry in self._index_entries() if entry[0] not in tail]
+        entries += [(digest, *loc) for digest, loc in tail.items() if loc is not None]
+        entries.sort()
+        tmp = self.pack_index_path.with_name(f"{self.pack_index_path.name}.{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            f.write(_PACK_INDEX_HEADER.pack(_PACK_INDEX_MAGIC, self._pack_id, self._scanned))
+            f.writelines(_PACK_INDEX_ENTRY.pack(*entry) for entry in entries)
+            f.flush()
+            os.fsync(f.fileno())
+        if self._pack_index_map is not None:
+            self._pack_index_map.close()
+        os.replace(tmp, self.pack_index_path)
+        with self.pack_index_path.open("rb") as f:
+            self._pack_index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._tail = {}
+        return sum(length for _digest, _offset, length in entries)
+
+    # ── Storage interface ──
+
+    def load_data(self, sha: str) -> dict[str, object] | None:
+        """Return the full record for *sha* from the pack, or None."""
+        with self._pack_lock:
+            if not self._open_pack():
+                return None
+            location = self._locate(sha)
+            if location is None and self.passive:
+                self._scan_tail()  # the writer may have appended it since
+                location = self._locate(sha)
+            if location is None:
+                return None
+            body = self._read_record(*location)[1]
+        return json.loads(body)
+
+    def save_data(self, sha: str, data: dict[str, object]) -> None:
+        """Append the full record for *sha* to the pack."""
+        self._check_writable()
+        body = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+        with self._pack_lock:
+            self._append(sha, body)
+
+    def _delete_data(self, sha: str) -> None:
+        with self._pack_lock:
+            self._append(sha, b"")
+
+    def _data_bytes(self, sha: str) -> int:
+        with self._pack_lock:
+            location = self._locate(sha) if self._open_pack() else None
+        return location[1] if location else 0
+
+    def _adopt_orphans(self, index: dict[str, dict[str, object]], deleted: set[str]) -> None:
+        # A record is appended before its journal line; adopt the tail's
+        # records the journal never mentioned.
+        with self._pack_lock, self._writer_lock():
+            if not self._open_pack():
+                return
+            for key, location in list(self._tail.items()):
+                if location is None or key in deleted or key in index:
+                    continue
+                index[key] = _index_entry(json.loads(self._read_record(*location)[1]))
+                self.recovered += 1
+            self._write_pack_index()
+
+    def refresh(self) -> bool:
+        changed = super().refresh()
+        if changed:
+            with self._pack_lock:
+                self._close_pack()  # possibly repacked; remap lazily
+        return changed
+
+    def commit(self) -> None:
+        """Compact index.json, then fold the pack's tail into elements.idx."""
+        super().commit()
+        with self._pack_lock, self._writer_lock():
+            if not self._tail or not self._open_pack():
+                return
+            with self.telemetry.phase("commit", cpu_bound=True):
+                live = self._write_pack_index()
+            dead = self._scanned - _PACK_HEADER.size - live
+            if dead >= self.REPACK_MIN_BYTES and dead >= self.REPACK_RATIO * self._scanned:
+                self.repack()
+
+    def repack(self) -> int:
+        """Copy the live records into a new pack and index; return bytes freed."""
+        with self._pack_lock, self._writer_lock():
+            if not self._open_pack():
+                return 0
+            self._write_pack_index()
+            before = self._scanned
+            pack_id = os.urandom(8)
+            entries = []
+            pack_tmp = self.pack_path.with_name(f"{self.pack_path.name}.{os.getpid()}.tmp")
+            with pack_tmp.open("wb") as f:
+                f.write(_PACK_HEADER.pack(_PACK_MAGIC, pack_id))
+                offset = _PACK_HEADER.size
+                # Offset order keeps records written together next to each other.
+                for digest, old, length in sorted(self._index_entries(), key=lambda entry: entry[1]):
+                    f.write(self._pack_view(old + length)[old : old + length])
+                    entries.append((digest, offset, length))
+                    offset += length
+                f.flush()
+                os.fsync(f.fileno())
+            entries.sort()
+            index_tmp = self.pack_index_path.with_name(f"{self.pack_index_path.name}.{os.getpid()}.tmp")
+            with index_tmp.open("wb") as f:
+                f.write(_PACK_INDEX_HEADER.pack(_PACK_INDEX_MAGIC, pack_id, offset))
+                f.writelines(_PACK_INDEX_ENTRY.pack(*entry) for entry in entries)
+                f.flush()
+                os.fsync(f.fileno())
+            self._close_pack()
+            os.replace(pack_tmp, self.pack_path)
+            os.replace(index_tmp, self.pack_index_path)
+        return before - offset
+
+    def close(self) -> None:
+        super().close()
+        with self._pack_lock:
+            self._close_pack()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+
+_BACKENDS: dict[str, type[StorageManager]] = {
+    StorageManager.BACKEND: StorageManager,
+    SQLiteStorage.BACKEND: SQLiteStorage,
+    PackStorage.BACKEND: PackStorage,
+}
+
+
+def open_storage(pyramid_dir: Path, backend: str | None = None) -> StorageManager:
+    """Return the storage backend for *pyramid_dir*.
+
+    *backend* overrides the ``backend`` recorded in config.json; without
+    either, the JSON backend is used.
+    """
+    if backend is None:
+        config_path = pyramid_dir / "config.json"
+        config = _read_json(config_path) if config_path.exists() else {}
+        backend = str(config.get("backend", StorageManager.BACKEND))
+    try:
+        return _BACKENDS[backend](pyramid_dir)
+    except KeyError:
+        raise ValueError(f"Unknown storage backend: {backend}") from None
+
+
+def migrate_storage(source: StorageManager, dest: StorageManager) -> int:
+    """Copy every element from *source* into *dest*. Returns the element count."""
+    copied = 0
+    for sha, entry in source.iter_entries():
+        data = source.load_data(sha) or dict(entry)
+        levels = {**dict(data.get("levels") or {}), **dict(entry.get("levels") or {})}  # type: ignore[arg-type]
+        dest.put_element(sha, {**data, "levels": levels})
+        copied += 1
+    dest.commit()
+    return copied
+
+
+def summary_key(sha: str, version: str) -> str:
+    """Cache key of the summaries of code *sha* made by summarizer *version*."""
+    return hashlib.sha256(f"{sha}\0{version}".encode()).hexdigest()
+
+
+_CACHE_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS summaries (
+    key    TEXT PRIMARY KEY,
+    levels TEXT NOT NULL
+);
+"""
+
+
+class SummaryCache:
+    """Content-addressed summaries (``.pyramid/summaries.db``).
+
+    The element store is keyed by location (path, code, ordinal); this maps
+    ``summary_key(code sha, summarizer version)`` to levels, so identical
+    code anywhere in the tree is summarized once, and a new model or prompt
+    misses the cache instead of reusing stale summaries.  Kept in its own
+    SQLite file so it works with every storage backend and survives ``gc``.
+    Puts are committed at least every ``COMMIT_INTERVAL`` seconds.
+    """
+
+    COMMIT_INTERVAL = 2.0
+
+    def __init__(self, pyramid_dir: Path) -> None:
+        self.path = pyramid_dir / "summaries.db"
+        self._conn: sqlite3.Connection | None = None
+        self._last_commit = time.monotonic()
+        self._lock = threading.Lock()
+
+    def exists(self) -> bool:
+        """Return True if the cache file has been created."""
+        return self.path.exists()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_CACHE_SCHEMA)
+        return self._conn
+
+    def count(self) -> int:
+        with self._lock:
+            return int(self._connect().execute("SELECT COUNT(*) FROM summaries").fetchone()[0])
+
+    def get(self, key: str, levels: tuple[int, ...] = ()) -> dict[str, str] | None:
+        """Return the cached levels for *key*, or None if any of *levels* is missing."""
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT levels FROM summaries WHERE key = ?", (key,)
+            ).fetchone()
+        cached: dict[str, str] | None = json.loads(row[0]) if row else None
+        if cached is None or any(str(lv) not in cached for lv in levels):
+            return None
+        return cached
+
+    def put(self, key: str, levels: dict[str, str]) -> None:
+        """Merge *levels* into the entry for *key*; ``commit`` persists it at once."""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT levels FROM summaries WHERE key = ?", (key,)).fetchone()
+            merged = {**json.loads(row[0]), **levels} if row else levels
+            conn.execute(
+                "INSERT OR REPLACE INTO summaries (key, levels) VALUES (?, ?)",
+                (key, json.dumps(merged, ensure_ascii=False)),
+            )
+            if time.monotonic() - self._last_commit >= self.COMMIT_INTERVAL:
+                conn.commit()
+                self._last_commit = time.monotonic()
+
+    def commit(self) -> None:
+        """Persist pending changes."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+            self._last_commit = time.monotonic()
+
+    def close(self) -> None:
+        """Commit and close the connection."""
+        self.commit()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def seed_summary_cache(storage: StorageManager, cache: SummaryCache, version: str) -> int:
+    """Copy the summaries of a store from before the cache existed into *cache*.
+
+    Such stores were keyed by code sha and made by an unrecorded summarizer;
+    their levels are credited to *version* so re-keying them costs no LLM
+    call.  Returns the number of elements copied.
+    """
+    seeded = 0
+    for sha, entry in storage.iter_entries():
+        data = storage.load_data(sha) or dict(entry)
+        levels: dict[str, str] = dict(data.get("levels") or {})  # type: ignore[call-overload]
+        if not levels or ("code" not in data and "code_ref" not in data):
+            continue
+        cache.put(summary_key(_code_sha(data), version), levels)
+        seeded += 1
+    cache.commit()
+    return seeded
+
+
+# ─────────────────────────────────────────────
+# SECTION: Search index
+# ─────────────────────────────────────────────
+
+_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+# Splits one alphanumeric run at camelCase / digit boundaries:
+# "parseHTTPResponse2" -> parse, HTTP, Response, 2
+_SUBWORD_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+_STOPWORDS = frozenset({
+    "a", "an", "and", "as", "at", "by", "for", "from", "in", "into", "is", "it",
+    "of", "on", "or", "the", "to", "with",
+})
+
+# Field weights: a hit in an element's name outranks one in its path, which
+# outranks one in its summaries.
+_NAME_WEIGHT = 3
+_PATH_WEIGHT = 2
+_PREFIX_MATCH_WEIGHT = 0.5  # "auth" matching "authentication" counts for half
+_MAX_PREFIX_EXPANSIONS = 32
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower-cased identifier-aware tokens: snake_case and camelCase are split."""
+    tokens: list[str] = []
+    for word in _WORD_RE.findall(text):
+        for part in _SUBWORD_RE.findall(word):
+            token = part.lower()
+            if len(token) > 1 and token not in _STOPWORDS:
+                tokens.append(token)
+    return tokens
+
+
+def _document_terms(data: dict[str, object]) -> dict[str, int]:
+    """Weighted term frequencies for one element (name, path, every stored level)."""
+    counts: dict[str, int] = {}
+    levels = dict(data.get("levels") or {})  # type: ignore[arg-type]
+    fields = [
+        (str(data.get("name", "")), _NAME_WEIGHT),
+        (str(data.get("path", "")), _PATH_WEIGHT),
+        *((str(text), 1) for text in levels.values()),
+    ]
+    for text, weight in fields:
+        for token in tokenize(text):
+            counts[token] = counts.get(token, 0) + weight
+    return counts
+
+
+_SEARCH_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS docs (
+    sha          TEXT PRIMARY KEY,
+    element_type TEXT NOT NULL,
+    length       INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+    term TEXT PRIMARY KEY,
+    df   INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    sha  TEXT NOT NULL,
+    tf   INTEGER NOT NULL,
+    PRIMARY KEY (term, sha)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS stats (
+    key   TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class SearchIndex:
+    """Persisted inverted index with BM25 ranking (``.pyramid/search.db``).
+
+    Kept in its own SQLite file so it works with every storage backend.
+    Terms are looked up through the ``terms``/``postings`` primary keys, so a
+    query touches only the postings of its own terms: the rarest term is
+    read in full and the others are probed for its candidates only.
+    """
+
+    def __init__(self, pyramid_dir: Path) -> None:
+        self.path = pyramid_dir / "search.db"
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def exists(self) -> bool:
+        """Return True if the index file has been built."""
+        return self.path.exists()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SEARCH_SCHEMA)
+        return self._conn
+
+    def _stat(self, key: str) -> int:
+        row = self._connect().execute("SELECT value FROM stats WHERE key = ?", (key,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def _bump_stat(self, key: str, delta: int) -> None:
+        self._connect().execute(
+            "INSERT INTO stats (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+            (key, delta),
+        )
+
+    def count(self) -> int:
+        """Return the number of indexed documents."""
+        with self._lock:
+            return self._stat("doc_count")
+
+    def add(self, sha: str, data: dict[str, object]) -> None:
+        """Index (or re-index) one element. Call ``commit`` to persist."""
+        terms = _document_terms(data)
+        with self._lock:
+            self._remove_locked(sha)
+            conn = self._connect()
+            length = sum(terms.values())
+            conn.execute(
+                "INSERT INTO docs (sha, element_type, length) VALUES (?, ?, ?)",
+                (sha, str(data.get("element_type", "file")), length),
+            )
+            conn.executemany(
+                "INSERT INTO postings (term, sha, tf) VALUES (?, ?, ?)",
+                [(term, sha, tf) for term, tf in terms.items()],
+            )
+            conn.executemany(
+                "INSERT INTO terms (term, df) VALUES (?, 1) "
+                "ON CONFLICT(term) DO UPDATE SET df = df + 1",
+                [(term,) for term in terms],
+            )
+            self._bump_stat("doc_count", 1)
+            self._bump_stat("total_length", length)
+
+    def remove(self, sha: str) -> None:
+        """Drop one element from the index. Call ``commit`` to persist."""
+        with self._lock:
+            self._remove_locked(sha)
+
+    def _remove_locked(self, sha: str) -> None:
+        conn = self._connect()
+        row = conn.execute("SELECT length FROM docs WHERE sha = ?", (sha,)).fetchone()
+        if row is None:
+            return
+        terms = [t for (t,) in conn.execute("SELECT term FROM postings WHERE sha = ?", (sha,))]
+        conn.executemany("UPDATE terms SET df = df - 1 WHERE term = ?", [(t,) for t in terms])
+        conn.executemany("DELETE FROM postings WHERE term = ? AND sha = ?", [(t, sha) for t in terms])
+        conn.execute("DELETE FROM terms WHERE df <= 0")
+        conn.execute("DELETE FROM docs WHERE sha = ?", (sha,))
+        self._bump_stat("doc_count", -1)
+        self._bump_stat("total_length", -int(row[0]))
+
+    def rebuild(self, storage: StorageManager) -> int:
+        """Re-create the index from every element in *storage*. Returns the doc count."""
+        self.close()
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{self.path}{suffix}").unlink(missing_ok=True)
+        count = 0
+        for sha, entry in storage.iter_entries():
+            self.add(sha, storage.load_data(sha) or entry)
+            count += 1
+        self.commit()
+        return count
+
+    def commit(self) -> None:
+        """Persist pending changes."""
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+
+    def close(self) -> None:
+        """Commit and close the connection."""
+        self.commit()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _expand(self, token: str) -> list[tuple[str, int, float]]:
+        """Return (term, df, weight) for *token* and up to N indexed terms it prefixes."""
+        rows = self._connect().execute(
+            "SELECT term, df FROM terms WHERE term >= ? AND term < ? ORDER BY term LIMIT ?",
+            (token, token + "\U0010ffff", _MAX_PREFIX_EXPANSIONS),
+        ).fetchall()
+        return [
+            (term, int(df), 1.0 if term == token else _PREFIX_MATCH_WEIGHT)
+            for term, df in rows
+        ]
+
+    def search(
+        self,
+        query_text: str,
+        match: str = "all",
+        element_type: str | None = None,
+    ) -> list[tuple[str, float]]:
+        """Return (sha, score) pairs ranked by BM25, best first.
+
+        *match* is ``"all"`` (every query term must match, AND) or ``"any"``
+        (OR).  Each query token also matches indexed terms it is a prefix of.
+        """
+        tokens = list(dict.fromkeys(tokenize(query_text)))
+        if not tokens:
+            return []
+        with self._lock:
+            conn = self._connect()
+            n_docs = self._stat("doc_count")
+            if not n_docs:
+                return []
+            avg_len = self._stat("total_length") / n_docs
+
+            expansions = [self._expand(token) for token in tokens]
+            if match == "all" and not all(expansions):
+                return []
+            expansions = [e for e in expansions if e]
+            if not expansions:
+                return []
+
+            # Rarest token first: its postings bound the AND candidate set.
+            expansions.sort(key=lambda exp: sum(df for _t, df, _w in exp))
+            hits: dict[str, list[tuple[float, int]]] = {}  # sha -> [(weight * idf, tf)]
+            candidates: set[str] | None = None
+            for expansion in expansions:
+                matched: set[str] = set()
+                for term, df, weight in expansion:
+                    idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                    if candidates is not None:
+                        rows = _chunked_postings(conn, term, candidates)
+                    else:
+                        rows = conn.execute(
+                            "SELECT sha, tf FROM postings WHERE term = ?", (term,)
+                        ).fetchall()
+                    for sha, tf in rows:
+                        hits.setdefault(sha, []).append((weight * idf, int(tf)))
+                        matched.add(sha)
+                if match == "all":
+                    candidates = matched if candidates is None else candidates & matched
+                    if not candidates:
+                        return []
+            if candidates is not None:
+                hits = {sha: h for sha, h in hits.items() if sha in candidates}
+
+            # Length normalization and type filtering need the docs rows.
+            ranked: list[tuple[str, float]] = []
+            shas = list(hits)
+            for start in range(0, len(shas), 500):
+                chunk = shas[start : start + 500]
+                marks = ",".join("?" * len(chunk))
+                for sha, etype, length in conn.execute(
+                    f"SELECT sha, element_type, length FROM docs WHERE sha IN ({marks})", chunk
+                ):
+                    if element_type and etype != element_type:
+                        continue
+                    norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * length / avg_len)
+                    score = sum(w * tf * (_BM25_K1 + 1) / (tf + norm) for w, tf in hits[sha])
+                    ranked.append((sha, score))
+        ranked.sort(key=lambda item: (-item[1], item[0]))
+        return ranked
+
+
+def _chunked_postings(
+    conn: sqlite3.Connection, term: str, shas: set[str]
+) -> list[tuple[str, int]]:
+    """Fetch (sha, tf) postings of *term* restricted to *shas* via primary-key probes."""
+    rows: list[tuple[str, int]] = []
+    ordered = sorted(shas)
+    for start in range(0, len(ordered), 500):
+        chunk = ordered[start : start + 500]
+        marks = ",".join("?" * len(chunk))
+        rows.extend(conn.execute(
+            f"SELECT sha, tf FROM postings WHERE term = ? AND sha IN ({marks})",
+            (term, *chunk),
+        ).fetchall())
+    return rows
+
+
+_VECTOR_DIM = 512
+_VECTOR_CHUNK_ROWS = 65536  # rows scored per batched matrix product
+_MIN_SIMILARITY = 0.05
+_VECTOR_TYPES = ("file", "class", "function")
+_VECTOR_COMPACT_RATIO = 0.25  # rewrite the matrix once this share of rows is dead
+
+# Small offline thesaurus: words in one group share an extra hashed feature,
+# so "authentication" and "login" land near each other without a model.
+_CONCEPT_GROUPS: tuple[frozenset[str], ...] = (
+    frozenset({"auth", "authentication", "authenticate", "authorization", "authorize",
+               "login", "logout", "signin", "signup", "credential", "credentials",
+               "password", "session", "token", "oauth", "jwt", "permission"}),
+    frozenset({"db", "database", "sql", "sqlite", "postgres", "mysql", "query", "table",
+               "schema", "orm", "migration", "record", "row"}),
+    frozenset({"http", "request", "response", "api", "endpoint", "route", "router",
+               "handler", "url", "rest", "client", "server"}),
+    frozenset({"config", "configuration", "settings", "setting", "options", "env",
+               "environment", "preferences"}),
+    frozenset({"error", "errors", "exception", "fail", "failure", "raise", "retry",
+               "fallback", "invalid"}),
+    frozenset({"test", "tests", "testing", "assert", "fixture", "mock", "stub", "spec"}),
+    frozenset({"file", "files", "path", "directory", "dir", "folder", "read", "write",
+               "disk", "io"}),
+    frozenset({"parse", "parser", "parsing", "tokenize", "tokenizer", "lexer", "ast",
+               "grammar", "syntax"}),
+    frozenset({"cache", "cached", "caching", "memo", "memoize", "lru", "ttl"}),
+    frozenset({"log", "logs", "logger", "logging", "trace", "tracing", "telemetry",
+               "metrics"}),
+    frozenset({"cli", "command", "commands", "argv", "argument", "arguments", "option",
+               "flag", "subcommand"}),
+    frozenset({"async", "await", "thread", "threads", "concurrent", "concurrency",
+               "parallel", "worker", "workers", "pool", "queue"}),
+    frozenset({"encrypt", "decrypt", "hash", "hashing", "crypto", "cipher", "signature",
+               "sign", "secret", "key"}),
+    frozenset({"render", "view", "template", "html", "css", "ui", "component", "widget",
+               "display"}),
+    frozenset({"serialize", "deserialize", "json", "yaml", "xml", "encode", "decode",
+               "marshal", "dump", "load"}),
+)
+_CONCEPT_OF: dict[str, int] = {
+    term: i for i, group in enumerate(_CONCEPT_GROUPS) for term in group
+}
+
+
+def _vector_features(text: str) -> dict[str, float]:
+    """Hashing-trick features for *text*: tokens, 5-char stems and concept ids."""
+    features: dict[str, float] = {}
+    for token in tokenize(text):
+        features[token] = features.get(token, 0.0) + 1.0
+        if len(token) > 5:
+            stem = "~" + token[:5]
+            features[stem] = features.get(stem, 0.0) + 0.5
+        concept = _CONCEPT_OF.get(token)
+        if concept is not None:
+            key = f"#{concept}"
+            features[key] = features.get(key, 0.0) + 1.0
+    return features
+
+
+def _hash_vector(features: dict[str, float], dim: int) -> object:
+    """Fold *features* into a signed, sublinear-TF vector of width *dim*."""
+    vec = _np.zeros(dim, dtype=_np.float32)
+    for feature, count in features.items():
+        h = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+        sign = -1.0 if h >> 63 else 1.0
+        vec[h % dim] += sign * (1.0 + math.log(count)) if count >= 1 else sign * count
+    return vec
+
+
+def _vector_text(data: dict[str, object]) -> str:
+    levels = dict(data.get("levels") or {})  # type: ignore[arg-type]
+    return " ".join([str(data.get("name", "")), str(data.get("path", "")), *map(str, levels.values())])
+
+
+class VectorIndex:
+    """Offline semantic search: hashed TF-IDF vectors in a memory-mapped matrix.
+
+    Files (next to the index):
+      vectors.f32   rows x dim float32 term-frequency vectors
+      vectors.ids   one (sha, element type) record per row; empty sha = deleted
+      vectors.json  dim, row/live counts and per-bucket document frequencies
+
+    Rows store raw TF so IDF can change as elements come and go; IDF is
+    applied at query time while scoring the matrix in batches of
+    ``_VECTOR_CHUNK_ROWS``.  Adds are appended, removals zero their row, and
+    the files are compacted once a quarter of the rows are dead.
+
+    vectors.json is the commit point: rows past its ``rows`` count are an
+    interrupted append and are cut off before the next one.  A compaction
+    records its new row count (flagged ``compacting``) before swapping in the
+    rewritten files, and an interrupted swap is finished on the next open.
+    """
+
+    def __init__(self, pyramid_dir: Path, dim: int = _VECTOR_DIM) -> None:
+        if _load_numpy() is None:
+            raise RuntimeError("numpy package not installed: uv add numpy")
+        self.matrix_path = pyramid_dir / "vectors.f32"
+        self.ids_path = pyramid_dir / "vectors.ids"
+        self.meta_path = pyramid_dir / "vectors.json"
+        self._dim = dim
+        self._id_dtype = _np.dtype([("sha", "S64"), ("etype", "u1")])
+        self._meta: dict[str, object] | None = None
+        self._row_of: dict[str, int] | None = None  # sha -> on-disk row
+        self._pending: dict[str, tuple[object, int]] = {}  # sha -> (vector, type code)
+        self._dirty = False
+
+    def exists(self) -> bool:
+        """Return True if the vector files have been built."""
+        return self.meta_path.exists()
+
+    def _load_meta(self) -> dict[str, object]:
+        if self._meta is None:
+            if self.meta_path.exists():
+                self._meta = _read_json(self.meta_path)
+                self._dim = int(self._meta["dim"])  # type: ignore[arg-type]
+                if self._meta.pop("compacting", False):
+                    self._swap_compacted()
+                    _write_json(self.meta_path, self._meta)
+            else:
+                self._meta = {"dim": self._dim, "rows": 0, "live": 0, "df": [0] * self._dim}
+            # Kept as an array while open; serialized back to a list on close.
+            self._meta["df"] = _np.asarray(self._meta["df"], dtype=_np.int64)
+        return self._meta
+
+    def _df(self) -> object:
+        return self._load_meta()["df"]
+
+    def _open_matrix(self, mode: str = "r") -> tuple[object, object]:
+        rows = int(self._load_meta()["rows"])  # type: ignore[arg-type]
+        matrix = _np.memmap(self.matrix_path, dtype=_np.float32, mode=mode, shape=(rows, self._dim))
+        ids = _np.memmap(self.ids_path, dtype=self._id_dtype, mode=mode, shape=(rows,))
+        return matrix, ids
+
+    def _rows(self) -> dict[str, int]:
+        if self._row_of is None:
+            self._row_of = {}
+            if int(self._load_meta()["rows"]):  # type: ignore[arg-type]
+                _matrix, ids = self._open_matrix()
+                for row, sha in enumerate(ids["sha"]):  # type: ignore[index]
+                    if sha:
+                        self._row_of[sha.decode()] = row
+        return self._row_of
+
+    def count(self) -> int:
+        """Return the number of live vectors."""
+        return int(self._load_meta()["live"])  # type: ignore[arg-type]
+
+    def add(self, sha: str, data: dict[str, object]) -> None:
+        """Stage a vector for *sha*, replacing any existing one. Call ``close`` to persist."""
+        self.remove(sha)
+        meta = self._load_meta()
+        vec = _hash_vector(_vector_features(_vector_text(data)), self._dim)
+        etype = str(data.get("element_type", "file"))
+        code = _VECTOR_TYPES.index(etype) if etype in _VECTOR_TYPES else 0
+        self._pending[sha] = (vec, code)
+        meta["df"] = self._df() + (vec != 0)  # type: ignore[operator]
+        meta["live"] = int(meta["live"]) + 1  # type: ignore[arg-type]
+        self._dirty = True
+
+    def remove(self, sha: str) -> None:
+        """Drop the vector for *sha*, if any. Call ``close`` to persist."""
+        meta = self._load_meta()
+        staged = self._pending.pop(sha, None)
+        if staged is not None:
+            vec = staged[0]
+        else:
+            row = self._rows().pop(sha, None)
+            if row is None:
+                return
+            matrix, ids = self._open_matrix("r+")
+            vec = _np.array(matrix[row])  # type: ignore[index]
+            matrix[row] = 0  # type: ignore[index]
+            ids[row] = (b"", 0)  # type: ignore[index]
+            matrix.flush()  # type: ignore[attr-defined]
+            ids.flush()  # type: ignore[attr-defined]
+        meta["df"] = self._df() - (vec != 0)  # type: ignore[operator]
+        meta["live"] = int(meta["live"]) - 1  # type: ignore[arg-type]
+        self._dirty = True
+
+    def close(self) -> None:
+        """Append staged vectors, compact if needed, and write the metadata."""
+        if not self._dirty:
+            return
+        meta = self._load_meta()
+        if self._pending:
+            rows = int(meta["rows"])  # type: ignore[arg-type]
+            block = _np.stack([vec for vec, _code in self._pending.values()]).astype(_np.float32)
+            records = _np.array(
+                [(sha.encode(), code) for sha, (_vec, code) in self._pending.items()],
+                dtype=self._id_dtype,
+            )
+            self._truncate(rows)
+            with self.matrix_path.open("ab") as fh:
+                fh.write(block.tobytes())
+            with self.ids_path.open("ab") as fh:
+                fh.write(records.tobytes())
+            for offset, sha in enumerate(self._pending):
+                self._rows()[sha] = rows + offset
+            meta["rows"] = rows + len(self._pending)
+            self._pending.clear()
+        rows = int(meta["rows"])  # type: ignore[arg-type]
+        if rows and rows - int(meta["live"]) > rows * _VECTOR_COMPACT_RATIO:  # type: ignore[arg-type]
+            self._compact()
+        _write_json(self.meta_path, {**meta, "df": self._df().tolist()})  # type: ignore[attr-defined]
+        self._dirty = False
+
+    def _compact(self) -> None:
+        meta = self._load_meta()
+        matrix, ids = self._open_matrix()
+        keep = _np.nonzero(ids["sha"] != b"")[0]  # type: ignore[index]
+        live_matrix = _np.array(matrix[keep])  # type: ignore[index]
+        live_ids = _np.array(ids[keep])  # type: ignore[index]
+        del matrix, ids
+        for path, payload in ((self.matrix_path, live_matrix), (self.ids_path, live_ids)):
+            self._compacted(path).write_bytes(payload.tobytes())
+        meta["rows"] = len(keep)
+        _write_json(self.meta_path, {**meta, "df": self._df().tolist(), "compacting": True})  # type: ignore[attr-defined]
+        self._swap_compacted()
+        self._row_of = None
+
+    @staticmethod
+    def _compacted(path: Path) -> Path:
+        return path.with_suffix(path.suffix + ".tmp")
+
+    def _swap_compacted(self) -> None:
+        """Move compacted files over the live ones; those already moved are skipped."""
+        for path in (self.matrix_path, self.ids_path):
+            tmp = self._compacted(path)
+            if tmp.exists():
+                os.replace(tmp, path)
+
+    def _truncate(self, rows: int) -> None:
+        """Cut off rows past *rows* left by an append that never reached vectors.json."""
+        for path, width in ((self.matrix_path, 4 * self._dim), (self.ids_path, self._id_dtype.itemsize)):
+            if path.exists() and path.stat().st_size > rows * width:
+                os.truncate(path, rows * width)
+
+    def rebuild(self, storage: StorageManager) -> int:
+        """Re-create the vectors from every element in *storage*. Returns the row count."""
+        for path in (self.matrix_path, self.ids_path, self.meta_path):
+            path.unlink(missing_ok=True)
+        self._meta = None
+        self._row_of = {}
+        self._pending.clear()
+        for sha, entry in storage.iter_entries():
+            self.add(sha, storage.load_data(sha) or entry)
+        self._dirty = True
+        self.close()
+        return self.count()
+
+    def search(self, query_text: str, element_type: str | None = None) -> list[tuple[str, float]]:
+        """Return (sha, cosine similarity) pairs above a small threshold, best first."""
+        meta = self._load_meta()
+        rows = int(meta["rows"])  # type: ignore[arg-type]
+        live = int(meta["live"])  # type: ignore[arg-type]
+        if not rows or not live:
+            return []
+        idf = (_np.log((1 + live) / (1 + self._df())) + 1.0).astype(_np.float32)
+        q = _hash_vector(_vector_features(query_text), self._dim) * idf  # type: ignore[operator]
+        q_norm = float(_np.linalg.norm(q))
+        if not q_norm:
+            return []
+        q /= q_norm
+        type_code = _VECTOR_TYPES.index(element_type) if element_type in _VECTOR_TYPES else None
+
+        matrix, ids = self._open_matrix()
+        results: list[tuple[str, float]] = []
+        for start in range(0, rows, _VECTOR_CHUNK_ROWS):
+            block = _np.asarray(matrix[start : start + _VECTOR_CHUNK_ROWS]) * idf  # type: ignore[index]
+            norms = _np.linalg.norm(block, axis=1)
+            sims = _np.divide(block @ q, norms, out=_np.zeros(len(block), _np.float32), where=norms > 0)
+            chunk_ids = ids[start : start + _VECTOR_CHUNK_ROWS]  # type: ignore[index]
+            mask = sims >= _MIN_SIMILARITY
+            if type_code is not None:
+                mask &= chunk_ids["etype"] == type_code
+            for row in _np.nonzero(mask)[0]:
+                results.append((chunk_ids["sha"][row].decode(), float(sims[row])))
+        results.sort(key=lambda item: (-item[1], item[0]))
+        return results
 
 
 # ─────────────────────────────────────────────
@@ -233,25 +2282,174 @@ _CLASS_TYPES: dict[str, list[str]] = {
 }
 
 
-def _should_ignore(path: Path) -> bool:
-    return (
-        path.name in _IGNORE_NAMES
-        or path.suffix.lower() in _IGNORE_SUFFIXES
-        or any(part in _IGNORE_DIRS for part in path.parts)
-    )
+def _should_ignore(name: str) -> bool:
+    """Built-in exclusions for a single file name (directories use _IGNORE_DIRS)."""
+    return name in _IGNORE_NAMES or any(name.lower().endswith(s) for s in _IGNORE_SUFFIXES)
+
+
+def _glob_to_regex(glob: str) -> str:
+    """Translate one gitignore glob (no leading ``!`` or trailing ``/``) to a regex.
+
+    ``*`` and ``?`` never cross ``/``; ``**`` does, as a whole segment.
+    """
+    out: list[str] = []
+    i, n = 0, len(glob)
+    while i < n:
+        c = glob[i]
+        if glob.startswith("**/", i) and (i == 0 or glob[i - 1] == "/"):
+            out.append("(?:.*/)?")
+            i += 3
+        elif glob.startswith("**", i) and i + 2 == n and (i == 0 or glob[i - 1] == "/"):
+            out.append(".*")
+            i += 2
+        elif c == "*":
+            out.append("[^/]*")
+            i += 1
+        elif c == "?":
+            out.append("[^/]")
+            i += 1
+        elif c == "[" and (end := glob.find("]", i + 2)) != -1:
+            body = glob[i + 1:end]
+            if body[0] == "!":
+                body = "^" + body[1:]
+            out.append("[" + body.replace("\\", "\\\\") + "]")
+            i = end + 1
+        elif c == "\\" and i + 1 < n:
+            out.append(re.escape(glob[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return "".join(out)
+
+
+class IgnoreRules:
+    """The gitignore patterns of one directory, compiled into a single regex.
+
+    Patterns are joined as one alternation in *reverse* order, each in a named
+    group recording whether it negates, so the first alternative that matches
+    is the last matching line of the file — the one gitignore says wins.
+    ``match`` returns True (ignored), False (re-included by ``!``) or None
+    (no pattern applies; defer to the enclosing directory's rules).
+    """
+
+    def __init__(self, lines: list[str]) -> None:
+        file_alts: list[str] = []
+        dir_alts: list[str] = []
+        for number, raw in enumerate(lines):
+            line = raw.rstrip("\n\r")
+            if not line.endswith("\\ "):
+                line = line.rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            elif line.startswith(("\\#", "\\!")):
+                line = line[1:]
+            dir_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            # A slash anywhere but the end anchors the pattern to this directory.
+            anchored = "/" in line
+            regex = _glob_to_regex(line.lstrip("/"))
+            if not anchored:
+                regex = "(?:.*/)?" + regex
+            alt = f"(?P<{'n' if negate else 'i'}{number}>{regex})"
+            dir_alts.append(alt)
+            if not dir_only:
+                file_alts.append(alt)
+        self._files = re.compile("|".join(reversed(file_alts))) if file_alts else None
+        self._dirs = re.compile("|".join(reversed(dir_alts))) if dir_alts else None
+
+    def __bool__(self) -> bool:
+        return self._dirs is not None
+
+    def match(self, rel: str, is_dir: bool) -> bool | None:
+        """Decision for *rel*, a ``/``-separated path relative to this directory."""
+        pattern = self._dirs if is_dir else self._files
+        m = pattern.fullmatch(rel) if pattern is not None else None
+        if m is None:
+            return None
+        return m.lastgroup[0] == "i"  # type: ignore[index]
+
+    @classmethod
+    def from_files(cls, *paths: Path | None) -> IgnoreRules:
+        """Rules from the given ignore files, later files overriding earlier ones."""
+        lines: list[str] = []
+        for path in paths:
+            if path is not None and path.is_file():
+                lines.extend(path.read_text(errors="replace").splitlines())
+        return cls(lines)
+
+
+class PathFilter:
+    """Answer ``walk_directory``'s include/ignore decision for single paths.
+
+    Used where paths arrive one at a time (``watch`` events) rather than
+    from a walk.  Each directory's ``.gitignore`` is read once and cached;
+    call ``reset`` after an ignore file changes.
+    """
+
+    def __init__(self, root: Path, ignore_file: Path | None = None) -> None:
+        self.root = root
+        self._ignore_file = ignore_file
+        self._rules: dict[str, IgnoreRules] = {}
+
+    def reset(self) -> None:
+        self._rules.clear()
+
+    def _rules_for(self, dir_rel: str) -> IgnoreRules:
+        if dir_rel not in self._rules:
+            if dir_rel:
+                self._rules[dir_rel] = IgnoreRules.from_files(self.root / dir_rel / ".gitignore")
+            else:
+                self._rules[dir_rel] = IgnoreRules.from_files(self.root / ".gitignore", self._ignore_file)
+        return self._rules[dir_rel]
+
+    def ignored(self, rel: str, is_dir: bool = False) -> bool:
+        """Whether the ``/``-separated *rel* (or any directory above it) is excluded."""
+        parts = rel.split("/")
+        name = parts[-1]
+        if any(part in _IGNORE_DIRS for part in parts[:-1]) or (is_dir and name in _IGNORE_DIRS):
+            return True
+        if not is_dir and (
+            _should_ignore(name) or os.path.splitext(name)[1].lower() not in SUPPORTED_EXTENSIONS
+        ):
+            return True
+        for depth in range(1, len(parts) + 1):
+            path_is_dir = is_dir or depth < len(parts)
+            # Innermost .gitignore first; the first one with an opinion decides.
+            for base in range(depth - 1, -1, -1):
+                decision = self._rules_for("/".join(parts[:base])).match(
+                    "/".join(parts[base:depth]), path_is_dir
+                )
+                if decision is not None:
+                    break
+            if decision:
+                return True
+        return False
 
 
 class CodeParser:
     """Extract code elements (file/class/function) from source files."""
 
+    def __init__(self) -> None:
+        # tree-sitter parsers are costly to build; keep one per language for
+        # the lifetime of this parser (and so of each parse worker process).
+        self._ts_parsers: dict[str, object] = {}
+        self.telemetry = Telemetry()
+
     def parse_file(self, path: Path, root: Path) -> list[Element]:
         """Return all elements found in *path*. Always includes a file-level element."""
         relative = str(path.relative_to(root))
         try:
-            code = path.read_text(encoding="utf-8", errors="ignore")
+            raw = path.read_bytes()
         except OSError:
             logger.exception("Failed to read %s", path)
             return []
+        code = _decode_source(raw)
 
         file_element = Element(
             path=relative,
@@ -272,21 +2470,26 @@ class CodeParser:
             if _TREE_SITTER_AVAILABLE
             else self._parse_heuristic(code, relative, suffix)
         )
-        return [file_element, *sub_elements]
+        elements = [file_element, *sub_elements]
+        _set_byte_ranges(raw, elements)
+        return elements
 
-    @staticmethod
-    def _parse_tree_sitter(code: str, relative: str, lang: str) -> list[Element]:
+    def _parse_tree_sitter(self, code: str, relative: str, lang: str) -> list[Element]:
         """Use tree-sitter to extract function and class elements."""
-        if _ts_languages is None:
+        ts_languages = _optional_import("tree_sitter_language_pack")
+        if ts_languages is None:
             return []
 
-        try:
-            parser = _ts_languages.get_parser(lang)
-        except Exception:
-            logger.exception("tree-sitter parser unavailable for %s", lang)
-            return []
+        parser = self._ts_parsers.get(lang)
+        if parser is None:
+            try:
+                parser = ts_languages.get_parser(lang)
+            except Exception:
+                logger.exception("tree-sitter parser unavailable for %s", lang)
+                return []
+            self._ts_parsers[lang] = parser
 
-        tree = parser.parse(code.encode())
+        tree = parser.parse(code.encode())  # type: ignore[attr-defined]
         lines = code.splitlines()
         elements: list[Element] = []
         lang_func_types = set(_FUNC_TYPES.get(lang, []))
@@ -389,31 +2592,378 @@ class CodeParser:
 
         return elements
 
-    def walk_directory(self, root: Path, ignore_file: Path | None = None) -> list[Path]:
-        """Return sorted list of parseable source files under *root*."""
-        extra_patterns: list[str] = []
-        for candidate in (ignore_file, root / ".gitignore"):
-            if candidate and candidate.exists():
-                for line in candidate.read_text().splitlines():
-                    line = line.strip()
-                    if line and not line.startswith("#"):
-                        extra_patterns.append(line.lstrip("/"))
-
+    def walk_directory(
+        self, root: Path, ignore_file: Path | None = None, dirs: list[Path] | None = None
+    ) -> list[Path]:
+        """Return sorted list of parseable source files under *root*.
+
+        Ignored directories are pruned before they are opened, so a large
+        ``node_modules`` costs one name check. Each directory's ``.gitignore``
+        applies below it and overrides its parents; *ignore_file* (normally
+        ``.pyramidignore``) is read after the root ``.gitignore`` and wins
+        over it.  Every directory entered, *root* included, is appended to
+        *dirs* when it is given.
+        """
         results: list[Path] = []
-        for path in root.rglob("*"):
-            if not path.is_file():
-                continue
-            if _should_ignore(path):
-                continue
-            rel = str(path.relative_to(root))
-            if any(pat in rel or rel.endswith(pat) for pat in extra_patterns):
-                continue
-            if path.suffix.lower() in SUPPORTED_EXTENSIONS:
-                results.append(path)
-
+        with self.telemetry.phase("walk", cpu_bound=True):
+            root_rules = IgnoreRules.from_files(root / ".gitignore", ignore_file)
+            # (directory, its path relative to root, [(rules, base rel), ...] innermost first)
+            stack: list[tuple[str, str, list[tuple[IgnoreRules, str]]]] = [
+                (str(root), "", [(root_rules, "")] if root_rules else [])
+            ]
+            while stack:
+                directory, dir_rel, rules = stack.pop()
+                if dirs is not None:
+                    dirs.append(Path(directory))
+                if dir_rel:
+                    nested = IgnoreRules.from_files(Path(directory, ".gitignore"))
+                    if nested:
+                        rules = [(nested, dir_rel + "/"), *rules]
+                try:
+                    entries = list(os.scandir(directory))
+                except OSError:
+                    continue
+                for entry in entries:
+                    name = entry.name
+                    try:
+                        is_dir = entry.is_dir(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if is_dir:
+                        if name in _IGNORE_DIRS:
+                            continue
+                    elif _should_ignore(name) or os.path.splitext(name)[1].lower() not in SUPPORTED_EXTENSIONS:
+                        continue
+                    rel = dir_rel + "/" + name if dir_rel else name
+                    ignored = None
+                    for rule_set, base in rules:
+                        ignored = rule_set.match(rel[len(base):], is_dir)
+                        if ignored is not None:
+                            break
+                    if ignored:
+                        continue
+                    if is_dir:
+                        stack.append((entry.path, rel, rules))
+                    elif entry.is_file():
+                        results.append(Path(entry.path))
+
         return sorted(results)
 
 
+def _decode_source(raw: bytes) -> str:
+    """Source text as parsed: UTF-8 with bad bytes dropped and newlines as ``\\n``."""
+    return raw.decode("utf-8", errors="ignore").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _set_byte_ranges(raw: bytes, elements: list[Element]) -> None:
+    """Fill each element's byte range (whole lines) in the file's bytes *raw*.
+
+    Lines are split as in the decoded text, but measured in the bytes on
+    disk, so CRLF endings and undecodable bytes keep the offsets exact.
+    """
+    offsets = [0]
+    for line in raw.decode("utf-8", errors="surrogateescape").splitlines(keepends=True):
+        offsets.append(offsets[-1] + len(line.encode("utf-8", errors="surrogateescape")))
+    for element in elements:
+        if element.element_type == "file":
+            element.start_byte, element.end_byte = 0, offsets[-1]
+        else:
+            element.start_byte = offsets[min(element.start_line - 1, len(offsets) - 1)]
+            element.end_byte = offsets[min(element.end_line, len(offsets) - 1)]
+
+
+def element_parents(elements: list[Element]) -> list[int | None]:
+    """Index of each element's innermost enclosing element within one file.
+
+    *elements* are in ``parse_file`` order: the file element first, then
+    classes and functions in pre-order, so an enclosing element always comes
+    before the elements it contains.
+    """
+    parents: list[int | None] = []
+    stack: list[int] = []
+    for i, element in enumerate(elements):
+        while stack and not (
+            elements[stack[-1]].start_line <= element.start_line
+            and element.end_line <= elements[stack[-1]].end_line
+        ):
+            stack.pop()
+        parents.append(stack[-1] if stack else None)
+        stack.append(i)
+    return parents
+
+
+_PARSE_POOL_MIN_FILES = 32  # Below this, process start-up costs more than it saves
+_worker_parser: CodeParser | None = None
+
+
+ParseTimes = tuple[float, float, float, float]  # parse wall, parse CPU, hash wall, hash CPU
+
+
+def _parse_worker(task: tuple[str, str]) -> tuple[str, list[tuple[Element, str]], ParseTimes]:
+    """Parse and hash one file. Runs in a parse worker process (or in-process).
+
+    Each process keeps a single CodeParser so its tree-sitter parsers are
+    built once per language rather than once per file.
+    """
+    global _worker_parser
+    if _worker_parser is None:
+        _worker_parser = CodeParser()
+    path, root = Path(task[0]), Path(task[1])
+    wall, cpu = time.perf_counter(), time.thread_time()
+    elements = _worker_parser.parse_file(path, root)
+    parsed_wall, parsed_cpu = time.perf_counter(), time.thread_time()
+    hashed = element_keys(elements)
+    times = (
+        parsed_wall - wall,
+        parsed_cpu - cpu,
+        time.perf_counter() - parsed_wall,
+        time.thread_time() - parsed_cpu,
+    )
+    return str(path.relative_to(root)), hashed, times
+
+
+def iter_parsed_files(
+    paths: list[Path], root: Path, workers: int, telemetry: Telemetry | None = None
+) -> Iterator[tuple[str, list[tuple[Element, str]]]]:
+    """Yield (relative_path, [(element, key), ...]) per file, in *paths* order.
+
+    With ``workers > 1`` parsing and hashing run in a ProcessPoolExecutor and
+    results stream back as each chunk finishes, so callers can start
+    summarizing before the whole tree is parsed.  Each file's parse and hash
+    times are added to *telemetry*.
+    """
+    telemetry = telemetry or Telemetry()
+    tasks = [(str(p), str(root)) for p in paths]
+    if workers <= 1 or len(tasks) < _PARSE_POOL_MIN_FILES:
+        def _in_process(task: tuple[str, str]) -> tuple[str, list[tuple[Element, str]], ParseTimes]:
+            with telemetry.profiled():
+                return _parse_worker(task)
+
+        yield from _timed_parses(map(_in_process, tasks), telemetry)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+
+    chunksize = max(1, min(64, len(tasks) // (workers * 4)))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from _timed_parses(pool.map(_parse_worker, tasks, chunksize=chunksize), telemetry)
+
+
+def _timed_parses(
+    results: Iterator[tuple[str, list[tuple[Element, str]], ParseTimes]], telemetry: Telemetry
+) -> Iterator[tuple[str, list[tuple[Element, str]]]]:
+    for rel, parsed, (parse_wall, parse_cpu, hash_wall, hash_cpu) in results:
+        telemetry.add("parse", parse_wall, parse_cpu)
+        telemetry.add("hash", hash_wall, hash_cpu)
+        telemetry.count("elements_parsed", len(parsed))
+        yield rel, parsed
+
+
+# ─────────────────────────────────────────────
+# SECTION: Git change detection
+# ─────────────────────────────────────────────
+
+_GIT_TIMEOUT = 60
+
+
+def _git(root: Path, *args: str) -> str | None:
+    """Output of ``git -C root ARGS``, or None when git is missing or fails."""
+    try:
+        proc = subprocess.run(
+            ["git", "-C", str(root), *args],
+            capture_output=True,
+            encoding="utf-8",
+            errors="surrogateescape",
+            timeout=_GIT_TIMEOUT,
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return proc.stdout if proc.returncode == 0 else None
+
+
+@dataclass
+class GitTree:
+    """The source files git reports under an analyze root.
+
+    ``files`` maps each relative path to its index blob id -- a content
+    fingerprint git already computed -- or None when the working copy differs
+    from the index (or the file is untracked) and must be checked by stat.
+    ``renames`` maps new paths to old ones since the commit of the last run.
+    """
+
+    head: str | None
+    files: dict[str, str | None]
+    renames: dict[str, str]
+
+
+def git_tree(root: Path, since: str | None = None, ignore_file: Path | None = None) -> GitTree | None:
+    """Ask git for the source files under *root*; None if it is not a work tree.
+
+    Applies the same built-in exclusions and *ignore_file* rules as
+    ``CodeParser.walk_directory``.  git applies .gitignore only to untracked
+    files, so tracked files it would ignore (force-added vendored or
+    generated code) are dropped too: the walker never sees them either, and
+    the element set must not depend on whether ``.git`` exists.
+    """
+    listing = _git(root, "ls-files", "--stage", "-z")
+    if listing is None:
+        return None
+    worktree = _git(root, "diff", "--name-status", "--no-renames", "--relative", "-z")
+    untracked = _git(
+        root, "ls-files", "--others", "--exclude-standard", "-z",
+        *(f"--exclude={name}/" for name in sorted(_IGNORE_DIRS)),
+    )
+    tracked_ignored = _git(root, "ls-files", "--cached", "--ignored", "--exclude-standard", "-z")
+    if worktree is None or untracked is None or tracked_ignored is None:
+        return None
+    head = (_git(root, "rev-parse", "--verify", "--quiet", "HEAD") or "").strip() or None
+
+    skipped = set(tracked_ignored.split("\0"))
+    files: dict[str, str | None] = {}
+    for record in listing.split("\0"):
+        meta, _, rel = record.partition("\t")
+        if not rel or rel in skipped:
+            continue
+        mode, blob, stage = meta.split()
+        if mode in ("120000", "160000"):  # symlinks and submodules
+            continue
+        files[rel] = blob if stage == "0" else None  # stages 1-3: unmerged
+    fields = worktree.split("\0")
+    for status, rel in zip(fields[0::2], fields[1::2]):
+        if status == "D":
+            files.pop(rel, None)
+        elif rel in files:
+            files[rel] = None
+    for rel in untracked.split("\0"):
+        if rel:
+            files[rel] = None
+
+    renames: dict[str, str] = {}
+    diff = _git(root, "diff", "--name-status", "-M", "--relative", "-z", since) if since else None
+    if diff:
+        fields = diff.split("\0")
+        i = 0
+        while i < len(fields) - 1:
+            status = fields[i]
+            if status.startswith(("R", "C")):
+                if status[0] == "R":
+                    renames[fields[i + 2]] = fields[i + 1]
+                i += 3
+            else:
+                i += 2
+
+    rules = IgnoreRules.from_files(ignore_file)
+    ignored_dirs: dict[str, bool] = {}
+
+    def _ignored(rel: str) -> bool:
+        parts = rel.split("/")
+        name = parts[-1]
+        if _should_ignore(name) or os.path.splitext(name)[1].lower() not in SUPPORTED_EXTENSIONS:
+            return True
+        if any(part in _IGNORE_DIRS for part in parts[:-1]):
+            return True
+        if not rules:
+            return False
+        for depth in range(1, len(parts)):
+            prefix = "/".join(parts[:depth])
+            if prefix not in ignored_dirs:
+                ignored_dirs[prefix] = bool(rules.match(prefix, True))
+            if ignored_dirs[prefix]:
+                return True
+        return bool(rules.match(rel, False))
+
+    native = os.sep != "/"
+    return GitTree(
+        head=head,
+        files={
+            (rel.replace("/", os.sep) if native else rel): blob
+            for rel, blob in files.items()
+            if not _ignored(rel)
+        },
+        renames={
+            (new.replace("/", os.sep) if native else new): (old.replace("/", os.sep) if native else old)
+            for new, old in renames.items()
+        },
+    )
+
+
+@dataclass
+class TreeDiff:
+    """How the files under an analyze root differ from the last run's manifest.
+
+    ``current`` starts with the manifest entries of files that need no work
+    (unchanged, or renamed with the same blob); ``to_parse`` lists the rest,
+    with their new fingerprints in ``fingerprints``.  ``moves`` holds
+    (old path, new path, element keys) for each renamed file.
+    """
+
+    current: dict[str, dict[str, object]]
+    fingerprints: dict[str, dict[str, object]]
+    to_parse: list[Path]
+    moves: list[tuple[str, str, list[str]]]
+    deleted: list[str]
+    unchanged: int = 0
+
+
+def diff_tree(
+    root: Path,
+    files: list[Path],
+    previous: dict[str, dict[str, object]],
+    git: GitTree | None,
+    rescan: bool = False,
+) -> TreeDiff:
+    """Compare *files* under *root* with the *previous* run's manifest entries.
+
+    Files whose fingerprint -- git blob id, else (size, mtime_ns, inode) --
+    matches the manifest are skipped without being opened; the manifest only
+    ever lists files whose elements were all stored successfully.  *rescan*
+    (--force, or a changed summarizer) sends every file to the parser.
+    """
+    renames = dict(git.renames) if git is not None else {}
+    if git is not None:
+        # Exact renames git could not report (no recorded commit, or the file
+        # was untracked then): a new path holding a vanished path's blob.
+        gone = {
+            str(entry["blob"]): rel
+            for rel, entry in previous.items()
+            if rel not in git.files and entry.get("blob")
+        }
+        for rel, blob in git.files.items():
+            if blob in gone and rel not in previous and rel not in renames:
+                renames[rel] = gone[blob]
+
+    diff = TreeDiff(current={}, fingerprints={}, to_parse=[], moves=[], deleted=[])
+    seen: set[str] = set()
+    for file_path in files:
+        rel = str(file_path.relative_to(root))
+        seen.add(rel)
+        blob = git.files.get(rel) if git is not None else None
+        try:
+            fingerprint: dict[str, object] = (
+                {"blob": blob} if blob else dict(_stat_fingerprint(file_path.stat()))
+            )
+        except OSError:
+            logger.exception("Failed to stat %s", file_path)
+            continue
+        prev = previous.get(rel)
+        if not rescan and prev and all(prev.get(k) == v for k, v in fingerprint.items()):
+            diff.current[rel] = prev
+            diff.unchanged += 1
+            continue
+        old = renames.get(rel)
+        origin = previous.get(old) if old and prev is None else None
+        if origin is not None:
+            diff.moves.append((old, rel, list(origin.get("elements") or ())))  # type: ignore[arg-type, call-overload]
+            if not rescan and blob and origin.get("blob") == blob:
+                diff.current[rel] = {**origin, **fingerprint}
+                continue
+        diff.fingerprints[rel] = fingerprint
+        diff.to_parse.append(file_path)
+
+    moved_from = {old for old, _new, _keys in diff.moves}
+    diff.deleted = sorted(set(previous) - seen - moved_from)
+    return diff
+
+
 # ─────────────────────────────────────────────
 # SECTION: Summarizer
 # ─────────────────────────────────────────────
@@ -429,7 +2979,7 @@ Word counts must be exact.
 Element type: {element_type}
 Element name: {name}
 File: {path}
-
+{note}
 Code:
 ```
 {code}
@@ -448,6 +2998,11 @@ The "8" value starts with the exact "4" text. The "16" value starts with the exa
 Each entry is a strict prefix of all longer entries.
 """
 
+_OUTLINE_NOTE = """\
+Nested {children} are shown as their signature followed by an indented line starting with "…"
+that holds a summary of their body; the bodies themselves are omitted.
+"""
+
 _EXTEND_PROMPT = """\
 Extend the following {seed_level}-word summary to exactly {target} words by appending new words after it.
 Do NOT change the existing text — only add words after the last word.
@@ -458,8 +3013,306 @@ Existing {seed_level}-word summary:
 Return ONLY a JSON object: {{"{target}": "<the {target}-word summary that starts with the existing text>"}}
 """
 
+_BATCH_PROMPT = """\
+Summarize EACH of the code elements below at increasing word-count levels using iterative expansion.
+For every element, build each level by starting with the COMPLETE text of its previous shorter level, then append additional words.
+Never alter the text already written for a shorter level — only append.
+
+Return ONLY a JSON object keyed by element id ("e1", "e2", ...). Each value is an object whose
+keys are word-count strings and whose values are that element's summaries. Word counts must be exact.
+Summarize every element independently; include every id.
+
+Required word counts in ascending order: {levels}
+
+Example for two elements and levels [4, 8]:
+{{
+  "e1": {{"4": "loads json config file", "8": "loads json config file from pyramid directory"}},
+  "e2": {{"4": "hashes user password securely", "8": "hashes user password securely with salted sha256 digest"}}
+}}
+
+{elements}
+"""
+
+_BATCH_ELEMENT = """\
+### {key}
+Element type: {element_type}
+Element name: {name}
+File: {path}
+```
+{code}
+```
+"""
+
+# Part of every summary cache key: editing any prompt invalidates the cache.
+_PROMPT_VERSION = hashlib.sha256(
+    "".join((_SUMMARY_PROMPT, _OUTLINE_NOTE, _EXTEND_PROMPT, _BATCH_PROMPT, _BATCH_ELEMENT)).encode()
+).hexdigest()[:12]
+
 _ANALYZE_LEVELS = (4, 8, 16)
+_OUTLINE_LEVEL = "16"  # child summary level quoted in a parent's outline
 LEVEL_SEQUENCE = (4, 8, 16, 32, 64)
+_MAX_OUTPUT_TOKENS = 512
+_BATCH_MAX_ELEMENTS = 40
+_BATCH_OUTPUT_TOKENS_PER_ELEMENT = 96  # ~28 words of summaries plus JSON overhead
+_BATCH_ELEMENT_OVERHEAD_TOKENS = 40  # header lines around each packed element
+_BATCH_API_MAX_REQUESTS = 10_000  # requests per provider batch job (both cap far higher)
+
+
+def outline_code(container: Element, children: list[tuple[Element, str | None]]) -> str:
+    """Return *container*'s source with each child body replaced by its summary.
+
+    Each child keeps its first (signature) line, followed by an indented
+    ``… summary`` line.  Children without a summary (None) keep their code.
+    """
+    lines = container.code.splitlines()
+    out: list[str] = []
+    cursor = 0
+    for child, summary in sorted(children, key=lambda c: c[0].start_line):
+        start = child.start_line - container.start_line
+        end = child.end_line - container.start_line
+        if summary is None or start < cursor or end >= len(lines):
+            continue
+        signature = lines[start]
+        indent = signature[: len(signature) - len(signature.lstrip())]
+        out.extend(lines[cursor:start])
+        out.append(signature)
+        out.append(f"{indent}    … {summary}")
+        cursor = end + 1
+    out.extend(lines[cursor:])
+    return "\n".join(out)
+
+
+class SummarizationError(RuntimeError):
+    """An element could not be summarized, even after retries."""
+
+
+# ── Rate limiting and retries ──
+
+_RETRYABLE_STATUS = frozenset({408, 409, 429, 500, 502, 503, 504, 529})
+_THROTTLE_STATUS = frozenset({429, 529})  # 529 = Anthropic "overloaded"
+_THROTTLE_TEXT = ("rate limit", "rate_limit", "overloaded", "429", "529")
+_SLOT_POLL_SECONDS = 0.05
+
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token)."""
+    return len(text) // 4 + 1
+
+
+def _error_status(exc: BaseException) -> int | None:
+    """HTTP status of an SDK error (duck-typed, so the SDKs stay optional)."""
+    status = getattr(exc, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def _is_throttle(exc: BaseException) -> bool:
+    status = _error_status(exc)
+    if status is not None:
+        return status in _THROTTLE_STATUS
+    message = str(exc).lower()
+    return any(marker in message for marker in _THROTTLE_TEXT)
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    status = _error_status(exc)
+    if status is not None:
+        return status in _RETRYABLE_STATUS or status >= 500
+    if isinstance(exc, (TimeoutError, ConnectionError, subprocess.TimeoutExpired)):
+        return True
+    # APIConnectionError / APITimeoutError carry no status code.
+    return type(exc).__name__ in {"APIConnectionError", "APITimeoutError"} or _is_throttle(exc)
+
+
+def _retry_after(exc: BaseException) -> float | None:
+    """Seconds the provider asked us to wait (retry-after-ms / retry-after), if any."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    millis = headers.get("retry-after-ms")
+    if millis:
+        try:
+            return max(0.0, float(millis) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    import email.utils
+
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class _TokenBucket:
+    """Per-minute budget that refills continuously."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.stamp = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimitScheduler:
+    """Retry, back off and pace provider calls.
+
+    * Retries 408/409/429/5xx/529 and connection errors up to *max_attempts*,
+      sleeping for the provider's retry-after when given, else jittered
+      exponential backoff.
+    * Adapts concurrency AIMD-style: +1/limit per success, halved (at most
+      once per second) on a throttle response, never below 1 or above the
+      starting concurrency.
+    * Keeps separate requests-per-minute and tokens-per-minute buckets per
+      provider (``budgets = {"anthropic": {"rpm": 50, "tpm": 40000}}``).
+
+    Works for both the thread pool (``call``) and the asyncio engine (``acall``).
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 4,
+        budgets: dict[str, dict[str, float]] | None = None,
+        max_attempts: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ) -> None:
+        self.max_limit = max(1, concurrency)
+        self.limit = float(self.max_limit)
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.retries = 0
+        self.throttled = 0
+        self._budgets = budgets or {}
+        self._buckets: dict[str, tuple[_TokenBucket | None, _TokenBucket | None]] = {}
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def budget(self, provider: str) -> dict[str, float]:
+        """The ``{rpm, tpm}`` budget configured for *provider* (possibly empty)."""
+        return dict(self._budgets.get(provider, {}))
+
+    def _bucket_pair(self, provider: str) -> tuple[_TokenBucket | None, _TokenBucket | None]:
+        if provider not in self._buckets:
+            budget = self._budgets.get(provider, {})
+            self._buckets[provider] = (
+                _TokenBucket(budget["rpm"]) if budget.get("rpm") else None,
+                _TokenBucket(budget["tpm"]) if budget.get("tpm") else None,
+            )
+        return self._buckets[provider]
+
+    def _try_acquire(self, provider: str, tokens: int) -> float:
+        """Take a slot and budget now (returns 0.0) or return seconds to wait."""
+        with self._lock:
+            if self.in_flight >= max(1, int(self.limit)):
+                return _SLOT_POLL_SECONDS
+            requests, token_budget = self._bucket_pair(provider)
+            wait = max(
+                requests.wait_time(1) if requests else 0.0,
+                token_budget.wait_time(tokens) if token_budget else 0.0,
+            )
+            if wait:
+                return wait
+            if requests:
+                requests.take(1)
+            if token_budget:
+                token_budget.take(tokens)
+            self.in_flight += 1
+            return 0.0
+
+    def _release(self, exc: BaseException | None) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            if exc is None:
+                self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            elif _is_throttle(exc):
+                self.throttled += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= 1.0:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._last_decrease = now
+
+    def _next_delay(self, attempt: int, exc: BaseException) -> float | None:
+        """Delay before the next attempt, or None if the error is final."""
+        if attempt + 1 >= self.max_attempts or not _is_retryable(exc):
+            return None
+        with self._lock:
+            self.retries += 1
+        hinted = _retry_after(exc)
+        if hinted is not None:
+            return min(hinted, self.max_delay)
+        cap = min(self.max_delay, self.base_delay * 2**attempt)
+        return random.uniform(cap / 2, cap)
+
+    def call(
+        self,
+        provider: str,
+        fn: Callable[[str], str],
+        prompt: str,
+        output_tokens: int = _MAX_OUTPUT_TOKENS,
+    ) -> str:
+        """Run ``fn(prompt)`` under the scheduler; raise SummarizationError when it gives up."""
+        tokens = _estimate_tokens(prompt) + output_tokens
+        for attempt in range(self.max_attempts):
+            while wait := self._try_acquire(provider, tokens):
+                time.sleep(wait)
+            try:
+                result = fn(prompt)
+            except Exception as exc:  # SDK error types are optional imports
+                self._release(exc)
+                delay = self._next_delay(attempt, exc)
+                if delay is None:
+                    raise SummarizationError(f"{provider}: {exc}") from exc
+                time.sleep(delay)
+                continue
+            self._release(None)
+            return result
+        raise SummarizationError(f"{provider}: retries exhausted")
+
+    async def acall(
+        self,
+        provider: str,
+        fn: Callable[[str], Coroutine[object, object, str]],
+        prompt: str,
+        output_tokens: int = _MAX_OUTPUT_TOKENS,
+    ) -> str:
+        """Async counterpart of ``call``."""
+        import asyncio
+
+        tokens = _estimate_tokens(prompt) + output_tokens
+        for attempt in range(self.max_attempts):
+            while wait := self._try_acquire(provider, tokens):
+                await asyncio.sleep(wait)
+            try:
+                result = await fn(prompt)
+            except Exception as exc:  # SDK error types are optional imports
+                self._release(exc)
+                delay = self._next_delay(attempt, exc)
+                if delay is None:
+                    raise SummarizationError(f"{provider}: {exc}") from exc
+                await asyncio.sleep(delay)
+                continue
+            self._release(None)
+            return result
+        raise SummarizationError(f"{provider}: retries exhausted")
 
 
 class Summarizer:
@@ -470,15 +3323,40 @@ class Summarizer:
         api: str = "anthropic",
         model: str | None = None,
         no_llm: bool = False,
+        scheduler: RateLimitScheduler | None = None,
     ) -> None:
         self.api = api
         self.model = model or self._default_model(api)
         self.no_llm = no_llm
+        self.scheduler = scheduler or RateLimitScheduler()
+        self.telemetry = Telemetry()
+        # SDK clients are created once and shared: one connection pool per
+        # provider instead of a fresh TLS handshake per element.
+        self._clients: dict[str, object] = {}
+        self._clients_lock = threading.Lock()
+        self._version: str | None = None
 
     @staticmethod
     def _default_model(api: str) -> str:
         return "gpt-4o-mini" if api == "openai" else "claude-haiku-4-5-20251001"
 
+    @property
+    def version(self) -> str:
+        """What this summarizer's output depends on: its model (or provider) and the prompts.
+
+        The claude CLI and the stub pick their own model, so the provider
+        name stands in for it.
+        """
+        if self._version is None:
+            provider = self._detect_provider()
+            source = self.model if provider in ("anthropic", "openai") else provider
+            self._version = f"{source}+{_PROMPT_VERSION}"
+        return self._version
+
+    def cache_key(self, element: Element) -> str:
+        """The SummaryCache key of *element*'s summaries from this summarizer."""
+        return summary_key(element.content_hash(), self.version)
+
     def _detect_provider(self) -> str:
         """Return the best available provider: anthropic | openai | claude-cli | stub."""
         if self.no_llm:
@@ -497,13 +3375,81 @@ class Summarizer:
             return "claude-cli"
         return "stub"
 
-    def _call_provider(self, provider: str, prompt: str) -> str:
+    def _call_provider(
+        self, provider: str, prompt: str, max_tokens: int = _MAX_OUTPUT_TOKENS
+    ) -> str:
         """Dispatch a prompt to the named provider and return raw text."""
-        if provider == "anthropic":
-            return self._call_anthropic(prompt)
-        if provider == "openai":
-            return self._call_openai(prompt)
-        return self._call_claude_cli(prompt)
+        start, ok = time.perf_counter(), False
+        try:
+            if provider == "anthropic":
+                text = self._call_anthropic(prompt, max_tokens)
+            elif provider == "openai":
+                text = self._call_openai(prompt, max_tokens)
+            else:
+                text = self._call_claude_cli(prompt)
+                self._record_usage(provider, None, prompt, text)
+            ok = True
+            return text
+        finally:
+            self.telemetry.llm_call(provider, time.perf_counter() - start, ok)
+
+    async def _acall_provider(
+        self, provider: str, prompt: str, max_tokens: int = _MAX_OUTPUT_TOKENS
+    ) -> str:
+        """Async counterpart of ``_call_provider`` using the shared async clients."""
+        start, ok = time.perf_counter(), False
+        try:
+            if provider == "anthropic":
+                text = await self._acall_anthropic(prompt, max_tokens)
+            elif provider == "openai":
+                text = await self._acall_openai(prompt, max_tokens)
+            else:
+                text = await self._acall_claude_cli(prompt)
+                self._record_usage(provider, None, prompt, text)
+            ok = True
+            return text
+        finally:
+            self.telemetry.llm_call(provider, time.perf_counter() - start, ok)
+
+    def _record_usage(self, provider: str, usage: object, prompt: str, text: str) -> None:
+        """Count the tokens an SDK response reports, or estimate them from the text."""
+        if usage is None:
+            self.telemetry.llm_tokens(provider, _estimate_tokens(prompt), _estimate_tokens(text), estimated=True)
+            return
+        self.telemetry.llm_tokens(
+            provider,
+            int(getattr(usage, "input_tokens", None) or getattr(usage, "prompt_tokens", 0) or 0),
+            int(getattr(usage, "output_tokens", None) or getattr(usage, "completion_tokens", 0) or 0),
+        )
+
+    @staticmethod
+    def _build_prompt(
+        element: Element,
+        levels: list[int],
+        seed: str | None,
+        seed_level: int | None,
+        outline: str | None = None,
+    ) -> str:
+        if seed and len(levels) == 1:
+            return _EXTEND_PROMPT.format(
+                seed_level=seed_level,
+                target=levels[0],
+                seed=seed,
+            )
+        source = element.code if outline is None else outline
+        code = source[:8000] + ("\n... (truncated)" if len(source) > 8000 else "")
+        note = ""
+        if outline is not None:
+            children = "functions" if element.element_type == "class" else "classes and functions"
+            note = _OUTLINE_NOTE.format(children=children)
+        return _SUMMARY_PROMPT.format(
+            element_type=element.element_type,
+            name=element.name,
+            path=element.path,
+            note=note,
+            code=code,
+            levels=levels,
+        )
 
     def summarize(
         self,
@@ -511,67 +3457,369 @@ class Summarizer:
         levels: tuple[int, ...] | list[int],
         seed: str | None = None,
         seed_level: int | None = None,
+        outline: str | None = None,
     ) -> dict[str, str]:
         """Return {str(level): summary} for each level.
 
         When *seed* is provided (a shorter summary that already exists) and only
         one level is requested, uses _EXTEND_PROMPT to append words rather than
         regenerate from scratch.  This preserves the prefix invariant.
+
+        *outline* (see ``outline_code``) replaces the element's code in the
+        prompt, so a class or file is described from its children's summaries.
+
+        Raises SummarizationError when the provider still fails after the
+        scheduler's retries; callers must not store a placeholder for it.
         """
         provider = self._detect_provider()
 
         if provider == "stub":
+            self.telemetry.count("placeholder_summaries")
             return {str(lvl): f"{element.element_type} {element.name}" for lvl in levels}
 
-        sorted_levels = sorted(levels)
+        prompt = self._build_prompt(element, sorted(levels), seed, seed_level, outline)
+        raw = self.scheduler.call(
+            provider, lambda p: self._call_provider(provider, p), prompt
+        )
+        return self._parse_summaries(raw, levels)
 
-        if seed and len(sorted_levels) == 1:
-            prompt = _EXTEND_PROMPT.format(
-                seed_level=seed_level,
-                target=sorted_levels[0],
-                seed=seed,
-            )
-        else:
-            code = element.code[:8000] + ("\n... (truncated)" if len(element.code) > 8000 else "")
-            prompt = _SUMMARY_PROMPT.format(
+    async def asummarize(
+        self,
+        element: Element,
+        levels: tuple[int, ...] | list[int],
+        seed: str | None = None,
+        seed_level: int | None = None,
+        outline: str | None = None,
+    ) -> dict[str, str]:
+        """Async counterpart of ``summarize``; same prompts, fallbacks and result shape."""
+        provider = self._detect_provider()
+
+        if provider == "stub":
+            self.telemetry.count("placeholder_summaries")
+            return {str(lvl): f"{element.element_type} {element.name}" for lvl in levels}
+
+        prompt = self._build_prompt(element, sorted(levels), seed, seed_level, outline)
+        raw = await self.scheduler.acall(
+            provider, lambda p: self._acall_provider(provider, p), prompt
+        )
+        return self._parse_summaries(raw, levels)
+
+    # ── Packed (multi-element) requests ──
+
+    @staticmethod
+    def packed_tokens(element: Element) -> int:
+        """Estimated prompt tokens one element adds to a packed request."""
+        return _estimate_tokens(element.code) + _BATCH_ELEMENT_OVERHEAD_TOKENS
+
+    @staticmethod
+    def _build_batch_prompt(elements: list[Element], levels: list[int]) -> str:
+        parts = [
+            _BATCH_ELEMENT.format(
+                key=f"e{i}",
                 element_type=element.element_type,
                 name=element.name,
                 path=element.path,
-                code=code,
-                levels=sorted_levels,
+                code=element.code,
             )
+            for i, element in enumerate(elements, start=1)
+        ]
+        return _BATCH_PROMPT.format(levels=levels, elements="\n".join(parts))
 
+    @staticmethod
+    def _parse_batch(raw: str) -> dict[str, object]:
+        """Extract the keyed JSON object from a packed response ({} if unparseable)."""
+        for candidate in (raw, raw[raw.find("{") : raw.rfind("}") + 1]):
+            try:
+                data = json.loads(candidate)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(data, dict):
+                return data
+        logger.warning("Failed to parse JSON from packed LLM response")
+        return {}
+
+    @staticmethod
+    def _valid_levels(summaries: object, levels: list[int]) -> dict[str, str] | None:
+        """Return {level: text} if *summaries* has every level with a plausible length."""
+        if not isinstance(summaries, dict):
+            return None
+        result: dict[str, str] = {}
+        previous = 0
+        for lvl in levels:
+            text = summaries.get(str(lvl))
+            if not isinstance(text, str) or not text.strip():
+                return None
+            words = len(text.split())
+            if words > 2 * lvl + 4 or words < previous:
+                return None
+            previous = words
+            result[str(lvl)] = text.strip()
+        return result
+
+    def _unpack_batch(
+        self, raw: str, elements: list[Element], levels: list[int]
+    ) -> list[dict[str, str] | None]:
+        parsed = self._parse_batch(raw)
+        return [
+            self._valid_levels(parsed.get(f"e{i}"), levels)
+            for i in range(1, len(elements) + 1)
+        ]
+
+    def summarize_batch(
+        self, elements: list[Element], levels: tuple[int, ...] | list[int]
+    ) -> list[dict[str, str] | SummarizationError]:
+        """Summarize several small elements in one request.
+
+        Each element's levels are validated on their own; only elements whose
+        part of the answer is missing or malformed are retried with a
+        per-element ``summarize`` call.  Per-element failures are returned
+        (not raised) so one bad element never sinks the whole pack.
+        """
+        sorted_levels = sorted(levels)
+        if len(elements) == 1 or self._detect_provider() == "stub":
+            return [self._summarize_or_error(e, sorted_levels) for e in elements]
+
+        provider = self._detect_provider()
+        max_tokens = _MAX_OUTPUT_TOKENS + _BATCH_OUTPUT_TOKENS_PER_ELEMENT * len(elements)
+        prompt = self._build_batch_prompt(elements, sorted_levels)
         try:
-            raw = self._call_provider(provider, prompt)
-            return self._parse_summaries(raw, levels)
-        except (json.JSONDecodeError, KeyError, ValueError, RuntimeError, OSError):
-            logger.exception("Failed to get summaries for %s", element.path)
-            return {str(lvl): f"{element.element_type} {element.name}" for lvl in levels}
+            raw = self.scheduler.call(
+                provider,
+                lambda p: self._call_provider(provider, p, max_tokens),
+                prompt,
+                output_tokens=max_tokens,
+            )
+        except SummarizationError as exc:
+            return [exc] * len(elements)
+        unpacked = self._unpack_batch(raw, elements, sorted_levels)
+        self.telemetry.count("pack_fallbacks", sum(s is None for s in unpacked))
+        return [
+            summaries if summaries is not None else self._summarize_or_error(element, sorted_levels)
+            for element, summaries in zip(elements, unpacked)
+        ]
+
+    async def asummarize_batch(
+        self, elements: list[Element], levels: tuple[int, ...] | list[int]
+    ) -> list[dict[str, str] | SummarizationError]:
+        """Async counterpart of ``summarize_batch``."""
+        sorted_levels = sorted(levels)
+        if len(elements) == 1 or self._detect_provider() == "stub":
+            return [await self._asummarize_or_error(e, sorted_levels) for e in elements]
+
+        provider = self._detect_provider()
+        max_tokens = _MAX_OUTPUT_TOKENS + _BATCH_OUTPUT_TOKENS_PER_ELEMENT * len(elements)
+        prompt = self._build_batch_prompt(elements, sorted_levels)
+        try:
+            raw = await self.scheduler.acall(
+                provider,
+                lambda p: self._acall_provider(provider, p, max_tokens),
+                prompt,
+                output_tokens=max_tokens,
+            )
+        except SummarizationError as exc:
+            return [exc] * len(elements)
+        unpacked = self._unpack_batch(raw, elements, sorted_levels)
+        self.telemetry.count("pack_fallbacks", sum(s is None for s in unpacked))
+        return [
+            summaries if summaries is not None else await self._asummarize_or_error(element, sorted_levels)
+            for element, summaries in zip(elements, unpacked)
+        ]
+
+    def _summarize_or_error(
+        self, element: Element, levels: list[int], outline: str | None = None
+    ) -> dict[str, str] | SummarizationError:
+        try:
+            return self.summarize(element, levels, outline=outline)
+        except SummarizationError as exc:
+            return exc
+
+    async def _asummarize_or_error(
+        self, element: Element, levels: list[int], outline: str | None = None
+    ) -> dict[str, str] | SummarizationError:
+        try:
+            return await self.asummarize(element, levels, outline=outline)
+        except SummarizationError as exc:
+            return exc
 
-    def _call_anthropic(self, prompt: str) -> str:
-        if _anthropic is None:
-            raise RuntimeError("anthropic package not installed: uv add anthropic")
-        client = _anthropic.Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
-        response = client.messages.create(
+    # ── Provider batch APIs (analyze --batch-api) ──
+
+    def submit_batch(self, provider: str, prompts: dict[str, str]) -> str:
+        """Submit ``{custom_id: prompt}`` as one asynchronous batch job; return its id."""
+        try:
+            if provider == "anthropic":
+                client = self._client("anthropic")
+                batch = client.messages.batches.create(  # type: ignore[attr-defined]
+                    requests=[
+                        {
+                            "custom_id": custom_id,
+                            "params": {
+                                "model": self.model,
+                                "max_tokens": _MAX_OUTPUT_TOKENS,
+                                "temperature": 0.1,
+                                "messages": [{"role": "user", "content": prompt}],
+                            },
+                        }
+                        for custom_id, prompt in prompts.items()
+                    ]
+                )
+                return str(batch.id)
+            if provider == "openai":
+                client = self._client("openai")
+                lines = [
+                    json.dumps({
+                        "custom_id": custom_id,
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": {
+                            "model": self.model,
+                            "messages": [{"role": "user", "content": prompt}],
+                            "response_format": {"type": "json_object"},
+                            "max_tokens": _MAX_OUTPUT_TOKENS,
+                            "temperature": 0.1,
+                        },
+                    })
+                    for custom_id, prompt in prompts.items()
+                ]
+                upload = client.files.create(  # type: ignore[attr-defined]
+                    file=("pyramid-batch.jsonl", "\n".join(lines).encode()), purpose="batch"
+                )
+                batch = client.batches.create(  # type: ignore[attr-defined]
+                    input_file_id=upload.id,
+                    endpoint="/v1/chat/completions",
+                    completion_window="24h",
+                )
+                return str(batch.id)
+        except Exception as exc:  # SDK error types are optional imports
+            raise SummarizationError(f"{provider} batch submission failed: {exc}") from exc
+        raise SummarizationError(f"provider {provider!r} has no batch API")
+
+    def batch_finished(self, provider: str, batch_id: str) -> bool:
+        """Return True once the provider has stopped processing *batch_id*."""
+        try:
+            if provider == "anthropic":
+                batch = self._client("anthropic").messages.batches.retrieve(batch_id)  # type: ignore[attr-defined]
+                return batch.processing_status == "ended"  # type: ignore[no-any-return]
+            batch = self._client("openai").batches.retrieve(batch_id)  # type: ignore[attr-defined]
+            return batch.status in ("completed", "failed", "expired", "cancelled")  # type: ignore[no-any-return]
+        except Exception as exc:  # SDK error types are optional imports
+            raise SummarizationError(f"{provider} batch status check failed: {exc}") from exc
+
+    def batch_results(self, provider: str, batch_id: str) -> dict[str, str | SummarizationError]:
+        """Return ``{custom_id: response text | error}`` for a finished batch."""
+        results: dict[str, str | SummarizationError] = {}
+        try:
+            if provider == "anthropic":
+                client = self._client("anthropic")
+                for row in client.messages.batches.results(batch_id):  # type: ignore[attr-defined]
+                    if row.result.type == "succeeded":
+                        results[row.custom_id] = row.result.message.content[0].text
+                    else:
+                        detail = getattr(row.result, "error", None) or row.result.type
+                        results[row.custom_id] = SummarizationError(f"batch request {detail}")
+                return results
+            client = self._client("openai")
+            batch = client.batches.retrieve(batch_id)  # type: ignore[attr-defined]
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if not file_id:
+                    continue
+                for line in client.files.content(file_id).text.splitlines():  # type: ignore[attr-defined]
+                    if not line.strip():
+                        continue
+                    row = json.loads(line)
+                    response = row.get("response") or {}
+                    if response.get("status_code") == 200:
+                        message = response["body"]["choices"][0]["message"]
+                        results[row["custom_id"]] = message.get("content") or ""
+                    else:
+                        detail = row.get("error") or response.get("body", {}).get("error")
+                        results[row["custom_id"]] = SummarizationError(f"batch request failed: {detail}")
+            return results
+        except Exception as exc:  # SDK error types are optional imports
+            raise SummarizationError(f"{provider} batch result download failed: {exc}") from exc
+
+    def _client(self, kind: str) -> object:
+        """Return the shared SDK client for *kind*, creating it on first use.
+
+        *kind* is one of ``anthropic``, ``openai``, ``anthropic-async`` and
+        ``openai-async``.  Base URLs follow the SDKs' own ANTHROPIC_BASE_URL /
+        OPENAI_BASE_URL variables, which is how tests point at a local server.
+        SDK-level retries are disabled; RateLimitScheduler owns retrying.
+        """
+        with self._clients_lock:
+            client = self._clients.get(kind)
+            if client is not None:
+                return client
+            if kind.startswith("anthropic"):
+                anthropic = _optional_import("anthropic")
+                if anthropic is None:
+                    raise RuntimeError("anthropic package not installed: uv add anthropic")
+                cls = anthropic.AsyncAnthropic if kind.endswith("-async") else anthropic.Anthropic
+                client = cls(api_key=os.environ["ANTHROPIC_API_KEY"], max_retries=0)
+            else:
+                openai = _optional_import("openai")
+                if openai is None:
+                    raise RuntimeError("openai package not installed: uv add openai")
+                cls = openai.AsyncOpenAI if kind.endswith("-async") else openai.OpenAI
+                client = cls(api_key=os.environ["OPENAI_API_KEY"], max_retries=0)
+            self._clients[kind] = client
+            return client
+
+    async def aclose(self) -> None:
+        """Close the shared async clients (call from the loop that used them)."""
+        for kind in ("anthropic-async", "openai-async"):
+            client = self._clients.pop(kind, None)
+            if client is not None:
+                await client.close()  # type: ignore[attr-defined]
+
+    def _call_anthropic(self, prompt: str, max_tokens: int = _MAX_OUTPUT_TOKENS) -> str:
+        client = self._client("anthropic")
+        response = client.messages.create(  # type: ignore[attr-defined]
+            model=self.model,
+            max_tokens=max_tokens,
+            temperature=0.1,
+            messages=[{"role": "user", "content": prompt}],
+        )
+        text = response.content[0].text  # type: ignore[union-attr]
+        self._record_usage("anthropic", getattr(response, "usage", None), prompt, text)
+        return text  # type: ignore[no-any-return]
+
+    async def _acall_anthropic(self, prompt: str, max_tokens: int = _MAX_OUTPUT_TOKENS) -> str:
+        client = self._client("anthropic-async")
+        response = await client.messages.create(  # type: ignore[attr-defined]
             model=self.model,
-            max_tokens=512,
+            max_tokens=max_tokens,
             temperature=0.1,
             messages=[{"role": "user", "content": prompt}],
         )
-        return response.content[0].text  # type: ignore[union-attr]
+        text = response.content[0].text
+        self._record_usage("anthropic", getattr(response, "usage", None), prompt, text)
+        return text  # type: ignore[no-any-return]
 
-    def _call_openai(self, prompt: str) -> str:
-        if _openai is None:
-            raise RuntimeError("openai package not installed: uv add openai")
-        client = _openai.OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-        response = client.chat.completions.create(
+    def _call_openai(self, prompt: str, max_tokens: int = _MAX_OUTPUT_TOKENS) -> str:
+        client = self._client("openai")
+        response = client.chat.completions.create(  # type: ignore[attr-defined]
             model=self.model,
             messages=[{"role": "user", "content": prompt}],
             response_format={"type": "json_object"},
-            max_tokens=512,
+            max_tokens=max_tokens,
             temperature=0.1,
         )
-        return response.choices[0].message.content or ""
+        text = response.choices[0].message.content or ""
+        self._record_usage("openai", getattr(response, "usage", None), prompt, text)
+        return text  # type: ignore[no-any-return]
+
+    async def _acall_openai(self, prompt: str, max_tokens: int = _MAX_OUTPUT_TOKENS) -> str:
+        client = self._client("openai-async")
+        response = await client.chat.completions.create(  # type: ignore[attr-defined]
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            response_format={"type": "json_object"},
+            max_tokens=max_tokens,
+            temperature=0.1,
+        )
+        text = response.choices[0].message.content or ""
+        self._record_usage("openai", getattr(response, "usage", None), prompt, text)
+        return text  # type: ignore[no-any-return]
 
     @staticmethod
     def _call_claude_cli(prompt: str) -> str:
@@ -587,25 +3835,97 @@ class Summarizer:
             raise RuntimeError(f"claude CLI exited {result.returncode}: {result.stderr.strip()}")
         return result.stdout.strip()
 
+    @staticmethod
+    async def _acall_claude_cli(prompt: str) -> str:
+        """Async claude CLI call via an asyncio subprocess."""
+        import asyncio
+
+        proc = await asyncio.create_subprocess_exec(
+            "claude", "-p", prompt, "--output-format", "text",
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=60)
+        except asyncio.TimeoutError:
+            proc.kill()
+            raise RuntimeError("claude CLI timed out after 60s") from None
+        if proc.returncode != 0:
+            raise RuntimeError(f"claude CLI exited {proc.returncode}: {stderr.decode().strip()}")
+        return stdout.decode().strip()
+
     @staticmethod
     def _parse_summaries(
         raw: str, levels: tuple[int, ...] | list[int]
     ) -> dict[str, str]:
-        """Extract JSON {level: summary} from an LLM response string."""
+        """Extract JSON {level: summary} from an LLM response string.
+
+        Raises SummarizationError unless every requested level is there with
+        a plausible length (``_valid_levels``): prose, or JSON missing a
+        level, goes to the retry queue instead of being stored.
+        """
+        data: object = None
         try:
             data = json.loads(raw)
-            return {str(k): str(v) for k, v in data.items()}
         except json.JSONDecodeError:
-            pass
-        # Try to extract a JSON object from surrounding text
-        m = re.search(r"\{[^{}]*\}", raw, re.DOTALL)
-        if m:
-            try:
-                data = json.loads(m.group())
-                return {str(k): str(v) for k, v in data.items()}
-            except json.JSONDecodeError:
-                logger.exception("Failed to parse JSON from LLM response")
-        return {str(lvl): raw.strip() for lvl in levels}
+            # Try to extract a JSON object from surrounding text
+            m = re.search(r"\{[^{}]*\}", raw, re.DOTALL)
+            if m:
+                with contextlib.suppress(json.JSONDecodeError):
+                    data = json.loads(m.group())
+        if isinstance(data, dict):
+            data = {str(k): v for k, v in data.items()}
+        summaries = Summarizer._valid_levels(data, sorted(levels))
+        if summaries is None:
+            raise SummarizationError(f"malformed summary response: {raw.strip()[:80]!r}")
+        return summaries
+
+
+class AsyncSummaryEngine:
+    """Run summarizer coroutines on a private event loop with bounded fan-out.
+
+    ``submit`` returns a ``concurrent.futures.Future`` so callers can treat
+    the engine like a thread pool, while up to *concurrency* requests are in
+    flight on the shared async SDK clients.
+    """
+
+    def __init__(self, summarizer: Summarizer, concurrency: int) -> None:
+        import asyncio
+
+        self._asyncio = asyncio
+        self.summarizer = summarizer
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="pyramid-async", daemon=True
+        )
+
+    def __enter__(self) -> AsyncSummaryEngine:
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_exc: object) -> None:
+        self.close()
+
+    async def _bounded(self, coro: Coroutine[object, object, _T]) -> _T:
+        async with self._semaphore:
+            return await coro
+
+    def submit(
+        self, fn: Callable[..., Coroutine[object, object, _T]], *args: object
+    ) -> Future[_T]:
+        """Schedule ``fn(*args)`` on the engine loop."""
+        return self._asyncio.run_coroutine_threadsafe(self._bounded(fn(*args)), self._loop)
+
+    def close(self) -> None:
+        """Close the async clients and stop the loop (after submitted work has finished)."""
+        if not self._thread.is_alive():
+            return
+        self._asyncio.run_coroutine_threadsafe(self.summarizer.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
 
 
 # ─────────────────────────────────────────────
@@ -613,13 +3933,1088 @@ class Summarizer:
 # ─────────────────────────────────────────────
 
 
-def _pyramid_dir(db_path: str | None) -> Path:
-    if db_path:
-        return Path(db_path)
-    env = os.environ.get("PYRAMID_DB")
-    if env:
-        return Path(env)
-    return Path.cwd() / ".pyramid"
+def _pyramid_dir(db_path: str | None) -> Path:
+    if db_path:
+        return Path(db_path)
+    env = os.environ.get("PYRAMID_DB")
+    if env:
+        return Path(env)
+    return Path.cwd() / ".pyramid"
+
+
+def _open_storage(db_path: str | None) -> StorageManager:
+    try:
+        if _SERVER is not None:
+            return _SERVER.storage(_pyramid_dir(db_path))
+        return open_storage(_pyramid_dir(db_path))
+    except ValueError as exc:
+        raise click.ClickException(str(exc)) from exc
+
+
+def _reindex_element(storage: StorageManager, sha: str, data: dict[str, object]) -> None:
+    """Refresh the search structures for one element whose levels changed."""
+    search = SearchIndex(storage.pyramid_dir)
+    if search.exists():
+        search.add(sha, data)
+        search.close()
+    if _NUMPY_AVAILABLE:
+        vectors = VectorIndex(storage.pyramid_dir)
+        if vectors.exists():
+            vectors.add(sha, data)
+            vectors.close()
+
+
+def _relocate_elements(
+    storage: StorageManager, moves: list[tuple[str, str, list[str]]]
+) -> dict[str, str]:
+    """Re-key the stored elements of renamed files; return {old key: new key}.
+
+    *moves* holds ``(old path, new path, keys)``.  A rename keeps each
+    element's code, and so its summaries; only ``path`` (and a file
+    element's ``name``) change, and with the path the location key, so no
+    summary is regenerated.
+    """
+    search = SearchIndex(storage.pyramid_dir)
+    vectors = VectorIndex(storage.pyramid_dir) if _NUMPY_AVAILABLE else None
+    has_search = search.exists()
+    has_vectors = vectors is not None and vectors.exists()
+    rekeyed: dict[str, str] = {}
+    for old, new, keys in moves:
+        seen: dict[str, int] = {}
+        for key in keys:
+            data = storage.load_data(key)
+            if not data or data.get("path") != old:
+                continue
+            sha = _code_sha(data)
+            new_key = location_key(new, sha, seen.get(sha, 0))
+            seen[sha] = seen.get(sha, 0) + 1
+            data["path"] = new
+            if data.get("element_type") == "file" and data.get("name") == Path(old).name:
+                data["name"] = Path(new).name
+            storage.delete_element(key)
+            storage.put_element(new_key, data)
+            if has_search:
+                search.remove(key)
+                search.add(new_key, data)
+            if has_vectors:
+                vectors.remove(key)  # type: ignore[union-attr]
+                vectors.add(new_key, data)  # type: ignore[union-attr]
+            rekeyed[key] = new_key
+    storage.commit()
+    search.close()
+    if vectors is not None:
+        vectors.close()
+    return rekeyed
+
+
+def _build_summarizer(
+    config: dict[str, object],
+    api: str | None,
+    model: str | None,
+    no_llm: bool,
+    concurrency: int,
+    rpm: float | None = None,
+    tpm: float | None = None,
+    max_attempts: int = 6,
+) -> tuple[Summarizer, str]:
+    """A Summarizer with its rate-limit scheduler, and the provider it will use."""
+    effective_api = api or str(config.get("api", "anthropic"))
+    summarizer = Summarizer(api=effective_api, model=model, no_llm=no_llm)
+    # Budgets come from config.json "rate_limits" ({provider: {rpm, tpm}}),
+    # with --rpm/--tpm overriding them for the provider actually in use.
+    budgets: dict[str, dict[str, float]] = {
+        name: dict(limits)  # type: ignore[call-overload]
+        for name, limits in dict(config.get("rate_limits") or {}).items()  # type: ignore[call-overload]
+    }
+    provider = summarizer._detect_provider()
+    if rpm is not None:
+        budgets.setdefault(provider, {})["rpm"] = rpm
+    if tpm is not None:
+        budgets.setdefault(provider, {})["tpm"] = tpm
+    summarizer.scheduler = RateLimitScheduler(
+        concurrency=concurrency, budgets=budgets, max_attempts=max_attempts
+    )
+    return summarizer, provider
+
+
+def _element_label(entry: dict[str, object]) -> str:
+    """``path`` for a file, ``path::name`` for its members."""
+    path = str(entry.get("path", ""))
+    if entry.get("element_type", "file") == "file":
+        return path
+    return f"{path}::{entry.get('name', '')}"
+
+
+def _extend_levels(summarizer: Summarizer, data: dict[str, object], target: int) -> dict[str, str]:
+    """*data*'s levels with every gap up to *target* filled; raises SummarizationError.
+
+    Missing levels are generated in sequence from the lowest gap up, each
+    seeded by the level below it (``_EXTEND_PROMPT``), so the prefix chain
+    is never broken.
+    Example: target=32, stored={4,8,16} → generate only 32
+    Example: target=32, stored={4}      → generate 8, 16, 32 in order
+    """
+    data_levels: dict[str, str] = dict(data.get("levels") or {})  # type: ignore[arg-type]
+    to_generate = [
+        lv for lv in LEVEL_SEQUENCE[: LEVEL_SEQUENCE.index(target) + 1]
+        if str(lv) not in data_levels
+    ]
+    if not to_generate:
+        return data_levels
+    etype = str(data.get("element_type", "file"))
+    name = str(data.get("name", ""))
+    element = Element(
+        path=str(data.get("path", "")),
+        element_type=etype,
+        name=name,
+        code=str(data.get("code", "")),
+        start_line=int(data.get("start_line", 1)),  # type: ignore[arg-type]
+        end_line=int(data.get("end_line", 1)),  # type: ignore[arg-type]
+    )
+    # Seed = highest stored level below the first gap
+    available_below = [
+        lv for lv in LEVEL_SEQUENCE if lv < to_generate[0] and str(lv) in data_levels
+    ]
+    seed_level: int | None = max(available_below) if available_below else None
+    seed: str | None = data_levels[str(seed_level)] if seed_level else None
+    for gen_level in to_generate:
+        result = summarizer.summarize(element, (gen_level,), seed=seed, seed_level=seed_level)
+        generated = result.get(str(gen_level))
+        if not generated:
+            raise SummarizationError(f"no level {gen_level} in the response")
+        data_levels[str(gen_level)] = generated
+        seed_level, seed = gen_level, generated
+    return data_levels
+
+
+def _expand_elements(
+    storage: StorageManager,
+    summarizer: Summarizer,
+    items: list[tuple[str, dict[str, object]]],
+    target: int,
+    workers: int,
+    bar: object | None = None,
+) -> dict[str, dict[str, str] | SummarizationError]:
+    """Extend each ``(key, data)`` in *items* to *target*; store and re-index the results.
+
+    Levels already in the summary cache for the element's code are reused.
+    An element's other levels are generated one after another (each seeds
+    the next); different elements run concurrently on *workers* threads
+    sharing the summarizer's rate limits.  Writes stay on the calling thread.
+    """
+    results: dict[str, dict[str, str] | SummarizationError] = {}
+    cache = SummaryCache(storage.pyramid_dir)
+    search = SearchIndex(storage.pyramid_dir)
+    vectors = VectorIndex(storage.pyramid_dir) if _NUMPY_AVAILABLE else None
+    has_search = search.exists()
+    has_vectors = vectors is not None and vectors.exists()
+    cache_keys: dict[str, str] = {}
+    work: list[tuple[str, dict[str, object], dict[str, object]]] = []  # (key, stored, seeded)
+    root = storage.load_manifest().get("root")
+    for sha, data in items:
+        code = _element_code(storage, data, str(root) if root else None)
+        if code is None:
+            logger.error("Failed to expand %s: source changed since indexing", _element_label(data))
+            results[sha] = SummarizationError("source changed since indexing; re-run analyze")
+            if bar is not None:
+                bar.update(1)  # type: ignore[attr-defined]
+            continue
+        cache_keys[sha] = summary_key(_code_sha(data), summarizer.version)
+        cached = cache.get(cache_keys[sha]) or {}
+        levels = {**cached, **dict(data.get("levels") or {})}  # type: ignore[call-overload]
+        work.append((sha, data, {**data, "code": code, "levels": levels}))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(_extend_levels, summarizer, seeded, target): (sha, data)
+            for sha, data, seeded in work
+        }
+        for future in as_completed(futures):
+            sha, data = futures[future]
+            try:
+                levels = future.result()
+            except SummarizationError as exc:
+                logger.error("Failed to expand %s: %s", _element_label(data), exc)
+                results[sha] = exc
+            else:
+                stored = dict(data.get("levels") or {})  # type: ignore[call-overload]
+                cache.put(cache_keys[sha], {lv: v for lv, v in levels.items() if lv not in stored})
+                record = {**data, "levels": levels}
+                if _index_entry(record) == _index_entry(data):
+                    storage.save_data(sha, record)  # only levels above the hot index changed
+                else:
+                    storage.put_element(sha, record)
+                if has_search:
+                    search.add(sha, record)
+                if has_vectors:
+                    vectors.add(sha, record)  # type: ignore[union-attr]
+                results[sha] = levels
+            if bar is not None:
+                bar.update(1)  # type: ignore[attr-defined]
+    storage.commit()
+    cache.close()
+    search.close()
+    if vectors is not None:
+        vectors.close()
+    return results
+
+
+def _element_record(
+    element: Element, summaries: dict[str, str], code_refs: bool = False
+) -> dict[str, object]:
+    """The stored data for *element* with its generated *summaries*.
+
+    With *code_refs* the code is not copied: ``code_ref`` holds its byte
+    range in the working tree and its sha, and only a file element keeps
+    the whole file, zlib-compressed, for when the tree has moved on.
+    """
+    record: dict[str, object] = {
+        "path": element.path,
+        "element_type": element.element_type,
+        "name": element.name,
+        "start_line": element.start_line,
+        "end_line": element.end_line,
+    }
+    if code_refs:
+        ref: dict[str, object] = {
+            "start": element.start_byte, "end": element.end_byte, "sha": element.content_hash()
+        }
+        if element.element_type == "file":
+            ref["z"] = base64.b64encode(zlib.compress(element.code.encode(), 9)).decode()
+        record["code_ref"] = ref
+    else:
+        record["code"] = element.code
+    record["levels"] = summaries
+    return record
+
+
+def _code_sha(data: dict[str, object]) -> str:
+    """SHA-256 of a stored element's code, without reading it."""
+    ref = data.get("code_ref")
+    if isinstance(ref, dict):
+        return str(ref["sha"])
+    return hashlib.sha256(str(data.get("code", "")).encode()).hexdigest()
+
+
+def _element_code(storage: StorageManager, data: dict[str, object], root: str | None) -> str | None:
+    """A stored element's code; None when it can no longer be recovered.
+
+    Inline code is returned as is.  A ``code_ref`` is read from the
+    working tree under *root* and checked against its sha; if the file
+    changed since indexing, the code is cut from the compressed copy kept
+    by the file's element instead.
+    """
+    ref = data.get("code_ref")
+    if not isinstance(ref, dict):
+        return str(data.get("code", ""))
+    path, is_file = str(data.get("path", "")), data.get("element_type") == "file"
+
+    def _verified(code: str) -> str | None:
+        return code if hashlib.sha256(code.encode()).hexdigest() == ref["sha"] else None
+
+    if root:
+        try:
+            with (Path(root) / path).open("rb") as f:
+                f.seek(int(ref["start"]))
+                raw = f.read(int(ref["end"]) - int(ref["start"]))
+        except OSError:
+            pass
+        else:
+            text = _decode_source(raw)
+            if (code := _verified(text if is_file else "\n".join(text.splitlines()))) is not None:
+                return code
+    copies = [ref] if is_file else [
+        (storage.load_data(key) or {}).get("code_ref")
+        for key, entry in storage.find_by_path(path)
+        if entry.get("path") == path and entry.get("element_type") == "file"
+    ]
+    start, end = int(data.get("start_line", 1)), int(data.get("end_line", 1))  # type: ignore[call-overload]
+    for copy in copies:
+        if not isinstance(copy, dict) or "z" not in copy:
+            continue
+        text = zlib.decompress(base64.b64decode(str(copy["z"]))).decode()
+        if (code := _verified(text if is_file else "\n".join(text.splitlines()[start - 1 : end]))) is not None:
+            return code
+    return None
+
+
+def _refresh_code_ref(storage: StorageManager, key: str, element: Element) -> None:
+    """Re-point a stored, unchanged element at the lines and bytes it now occupies."""
+    data = storage.load_data(key)
+    ref = data.get("code_ref") if data else None
+    if not isinstance(ref, dict):
+        return
+    if (data.get("start_line"), data.get("end_line"), ref.get("start"), ref.get("end")) == (  # type: ignore[union-attr]
+        element.start_line, element.end_line, element.start_byte, element.end_byte
+    ):
+        return
+    storage.put_element(key, {
+        **data,  # type: ignore[dict-item]
+        "start_line": element.start_line,
+        "end_line": element.end_line,
+        "code_ref": {**ref, "start": element.start_byte, "end": element.end_byte},
+    })
+
+
+def _submit_batch_job(
+    storage: StorageManager,
+    summarizer: Summarizer,
+    provider: str,
+    root: Path,
+    paths: list[Path],
+    fingerprints: dict[str, dict[str, object]],
+    current: dict[str, dict[str, object]],
+    force: bool,
+    parse_workers: int | None,
+    stale: bool = False,
+    code_refs: bool = False,
+) -> dict[str, object] | None:
+    """Parse *paths* and submit every uncached element as provider batch jobs.
+
+    The job manifest (batch.json) is written after each accepted submission,
+    so an interrupted run never loses a job it already paid for.  Files whose
+    elements are all stored or in the summary cache go straight into
+    *current*; the rest are held in the job and join the file manifest once
+    their elements are ingested.  Requests are keyed by summary cache key,
+    so duplicated code is sent once; ``keys`` maps each back to its
+    locations.  *stale* re-checks stored elements against the cache, as
+    after a model or prompt change.
+    """
+    elements: dict[str, dict[str, object]] = {}
+    prompts: dict[str, str] = {}
+    locations: dict[str, list[str]] = {}
+    pending_files: dict[str, dict[str, object]] = {}
+    cache = SummaryCache(storage.pyramid_dir)
+    search = SearchIndex(storage.pyramid_dir)
+    vectors = VectorIndex(storage.pyramid_dir) if _NUMPY_AVAILABLE else None
+    for rel, parsed in iter_parsed_files(
+        paths, root, parse_workers or os.cpu_count() or 1, storage.telemetry
+    ):
+        if not parsed:
+            continue
+        keys = [key for _element, key in parsed]
+        entry: dict[str, object] = {**fingerprints[rel], "sha": keys[0], "elements": keys}
+        todo = []
+        for element, key in parsed:
+            if not (force or stale) and storage.has_entry(key):
+                continue
+            ckey = summarizer.cache_key(element)
+            cached = None if force else cache.get(ckey, _ANALYZE_LEVELS)
+            if cached is None:
+                todo.append((element, key, ckey))
+                continue
+            data = _element_record(element, cached, code_refs)
+            storage.put_element(key, data)
+            search.add(key, data)
+            if vectors is not None:
+                vectors.add(key, data)
+            storage.telemetry.count("elements_reused")
+        if not todo:
+            current[rel] = entry
+            continue
+        pending_files[rel] = entry
+        for element, key, ckey in todo:
+            elements[key] = _element_record(element, {}, code_refs)
+            locations.setdefault(ckey, []).append(key)
+            if ckey not in prompts:
+                prompts[ckey] = Summarizer._build_prompt(element, list(_ANALYZE_LEVELS), None, None)
+    storage.commit()
+    search.close()
+    if vectors is not None:
+        vectors.close()
+    cache.close()
+    storage.save_manifest({"root": str(root), "files": current, "summaries": summarizer.version})
+    if not prompts:
+        return None
+    batches: list[dict[str, object]] = []
+    job: dict[str, object] = {
+        "provider": provider,
+        "model": summarizer.model,
+        "root": str(root),
+        "submitted_at": datetime.now(timezone.utc).isoformat(),
+        "batches": batches,
+        "summaries": summarizer.version,
+        "elements": elements,
+        "keys": locations,
+        "files": pending_files,
+    }
+    shas = list(prompts)
+    for start in range(0, len(shas), _BATCH_API_MAX_REQUESTS):
+        chunk = shas[start : start + _BATCH_API_MAX_REQUESTS]
+        try:
+            batch_id = summarizer.submit_batch(provider, {sha: prompts[sha] for sha in chunk})
+        except SummarizationError as exc:
+            if not batches:
+                raise click.ClickException(str(exc)) from exc
+            click.echo(
+                f"Warning: {exc}; continuing with the {len(batches)} job(s) already submitted.",
+                err=True,
+            )
+            break
+        batches.append({"id": batch_id, "shas": chunk, "ingested": False})
+        storage.save_batch_job(job)
+    submitted = sum(len(b["shas"]) for b in batches)  # type: ignore[arg-type]
+    click.echo(f"Submitted {submitted} request(s) in {len(batches)} {provider} batch job(s)")
+    return job
+
+
+def _finish_batch_job(
+    storage: StorageManager,
+    summarizer: Summarizer,
+    job: dict[str, object],
+    poll_interval: float,
+    wait: bool,
+) -> None:
+    """Poll the job's batches, ingest each as it ends, then retire batch.json.
+
+    *storage* is closed on every way out, finished or not.
+    """
+    provider = str(job["provider"])
+    batches: list[dict[str, object]] = job["batches"]  # type: ignore[assignment]
+    elements: dict[str, dict[str, object]] = job["elements"]  # type: ignore[assignment]
+    # Jobs submitted before the summary cache keyed requests by element.
+    locations: dict[str, list[str]] = dict(job.get("keys") or {})  # type: ignore[call-overload]
+    failures = storage.load_retry_queue()
+    cache = SummaryCache(storage.pyramid_dir)
+    search = SearchIndex(storage.pyramid_dir)
+    vectors = VectorIndex(storage.pyramid_dir) if _NUMPY_AVAILABLE else None
+    indexed = 0
+    try:
+        while True:
+            for batch in batches:
+                if batch["ingested"] or not summarizer.batch_finished(provider, str(batch["id"])):
+                    continue
+                results = summarizer.batch_results(provider, str(batch["id"]))
+                for ckey in batch["shas"]:  # type: ignore[attr-defined]
+                    outcome = results.get(ckey, SummarizationError("missing from batch results"))
+                    levels = None
+                    if not isinstance(outcome, SummarizationError):
+                        # Validated like an interactive answer: a malformed one
+                        # is queued for retry, never stored or cached.
+                        try:
+                            levels = Summarizer._parse_summaries(outcome, _ANALYZE_LEVELS)
+                        except SummarizationError as exc:
+                            outcome = exc
+                        else:
+                            if ckey in locations:
+                                cache.put(ckey, levels)
+                    for sha in locations.get(ckey, [ckey]):
+                        record = elements[sha]
+                        if levels is None:
+                            attempts = int(failures.get(sha, {}).get("attempts", 0))  # type: ignore[arg-type]
+                            failures[sha] = {
+                                "path": record["path"],
+                                "name": record["name"],
+                                "element_type": record["element_type"],
+                                "error": str(outcome),
+                                "attempts": attempts + 1,
+                                "failed_at": datetime.now(timezone.utc).isoformat(),
+                            }
+                            continue
+                        data = {**record, "levels": levels}
+                        storage.put_element(sha, data)
+                        search.add(sha, data)
+                        if vectors is not None:
+                            vectors.add(sha, data)
+                        failures.pop(sha, None)
+                        indexed += 1
+                cache.commit()
+                storage.commit()
+                batch["ingested"] = True
+                storage.save_batch_job(job)
+                storage.save_retry_queue(failures)
+            waiting = [str(b["id"]) for b in batches if not b["ingested"]]
+            if not waiting:
+                break
+            if not wait:
+                storage.close()
+                click.echo(
+                    f"{len(waiting)} batch job(s) still processing; "
+                    "re-run `analyze --batch-api` to resume."
+                )
+                return
+            time.sleep(poll_interval)
+    except SummarizationError as exc:
+        storage.close()
+        raise click.ClickException(f"{exc} (batch.json kept; re-run to resume)") from exc
+    finally:
+        cache.close()
+        search.close()
+        if vectors is not None:
+            vectors.close()
+
+    manifest = storage.load_manifest()
+    files: dict[str, dict[str, object]] = dict(manifest.get("files") or {})  # type: ignore[arg-type]
+    for rel, entry in dict(job["files"]).items():  # type: ignore[call-overload]
+        if all(storage.has_entry(sha) for sha in entry["elements"]):
+            files[rel] = entry
+    storage.save_manifest({"root": job["root"], "files": files, "summaries": job.get("summaries")})
+    storage.save_batch_job(None)
+    storage.close()
+    click.echo(f"\nDone. Indexed {indexed} elements from batch results → {storage.pyramid_dir}")
+    if failures:
+        click.echo(
+            f"{len(failures)} element(s) failed and were queued in {storage.retry_path.name}; "
+            "re-run analyze to retry them.",
+            err=True,
+        )
+
+
+_Outcome = dict[str, str] | SummarizationError
+_Job = list[tuple[Element, str, str, int]]  # (element, key, rel, index in file)
+
+
+class SummaryPipeline:
+    """Summarize parsed files for ``analyze`` and store each finished element.
+
+    Parsed files stream from the parse stage straight into the LLM pool;
+    finished futures are handed back through a queue so all storage writes
+    stay on the calling thread.  Each job is a list of elements: a single
+    one, or a pack of small elements sharing one request when
+    *batch_tokens* is set.  A job with an outline is one *hierarchical*
+    container, dispatched once every child being summarized in this run
+    has finished.
+
+    Elements are summarized by code: one whose code is in the summary cache
+    is stored without a request, and one whose code is already in flight
+    waits for that request as its follower.  With *force* only summaries
+    made by this run are reused.  Elements that still fail after retries
+    are queued in ``failures``, not stored, so no placeholder summary ever
+    gets cached under their key; their file is dropped from *current*.
+    """
+
+    def __init__(
+        self,
+        storage: StorageManager,
+        summarizer: Summarizer,
+        cache: SummaryCache,
+        current: dict[str, dict[str, object]],
+        fingerprints: dict[str, dict[str, object]],
+        force: bool = False,
+        stale: bool = False,
+        hierarchical: bool = False,
+        batch_tokens: int = 0,
+        code_refs: bool = False,
+    ) -> None:
+        self.storage = storage
+        self.summarizer = summarizer
+        self.cache = cache
+        self.current = current
+        self.fingerprints = fingerprints
+        self.force = force
+        self.stale = stale
+        self.hierarchical = hierarchical
+        self.batch_tokens = batch_tokens
+        self.code_refs = code_refs
+        self.search = SearchIndex(storage.pyramid_dir)
+        self.vectors = VectorIndex(storage.pyramid_dir) if _NUMPY_AVAILABLE else None
+        self.futures: dict[Future[list[_Outcome]], _Job] = {}
+        self.failures: dict[str, dict[str, object]] = {}
+        self.completed = 0
+        self.reused = 0
+        self._previous_failures = storage.load_retry_queue()
+        self._done: queue.SimpleQueue[Future[list[_Outcome]]] = queue.SimpleQueue()
+        self._handled = 0
+        self._outstanding: dict[str, int] = {}  # relative path -> unfinished elements
+        self._pending: _Job = []  # small elements waiting to fill a pack
+        self._pending_tokens = 0
+        # Per file with work left: its parsed elements, each element's parent
+        # index (all None unless hierarchical) and the level-16 summaries
+        # produced this run.
+        self._trees: dict[str, tuple[list[tuple[Element, str]], list[int | None], dict[int, str]]] = {}
+        self._waiting: dict[tuple[str, int], int] = {}  # (rel, index) -> unfinished children
+        self._cache_keys: dict[str, str] = {}  # location key -> summary cache key
+        self._followers: dict[str, _Job] = {}  # cache key in flight -> elements waiting on it
+        self._produced: set[str] = set()
+        self._pool: ThreadPoolExecutor | AsyncSummaryEngine | None = None
+        self._bar: object = None
+
+    def run(
+        self,
+        parsed_files: Iterator[tuple[str, list[tuple[Element, str]]]],
+        workers: int,
+        concurrency: int,
+        bar: object,
+    ) -> None:
+        """Summarize and store every element of *parsed_files* that needs it.
+
+        *concurrency* selects the asyncio engine over a pool of *workers*
+        threads; *bar* is advanced once per file whose elements are all done.
+        """
+        self._bar = bar
+        if concurrency:
+            self._pool = AsyncSummaryEngine(self.summarizer, concurrency)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=workers)
+        with self._pool:
+            for rel, parsed in parsed_files:
+                self._ingest(rel, parsed)
+                self._drain(block=False)
+            if self._pending:
+                self._submit(self._pending)
+            self._drain(block=True)
+
+    def commit(self) -> None:
+        """Commit the store and write the search indexes."""
+        self.storage.commit()
+        self.search.close()
+        if self.vectors is not None:
+            self.vectors.close()
+
+    def packs(self) -> tuple[int, int]:
+        """Return (requests shared by several elements, elements they carried)."""
+        packed = [len(job) for job in self.futures.values() if len(job) > 1]
+        return len(packed), sum(packed)
+
+    def _ingest(self, rel: str, parsed: list[tuple[Element, str]]) -> None:
+        storage = self.storage
+        if parsed:
+            keys = [key for _element, key in parsed]
+            self.current[rel] = {**self.fingerprints[rel], "sha": keys[0], "elements": keys}
+        todo = [
+            i for i, (_e, key) in enumerate(parsed)
+            if self.force or self.stale or not storage.has_entry(key)
+        ]
+        todo_set = set(todo)
+        storage.telemetry.count("elements_cached", len(parsed) - len(todo))
+        if self.code_refs and len(todo) < len(parsed):
+            # Unchanged members of an edited file may have moved.
+            for i, (element, key) in enumerate(parsed):
+                if i not in todo_set and element.element_type != "file":
+                    _refresh_code_ref(storage, key, element)
+        self._outstanding[rel] = len(todo)
+        for i in todo:
+            element, key = parsed[i]
+            self._cache_keys[key] = self.summarizer.cache_key(element)
+        if todo:
+            parents: list[int | None] = (
+                element_parents([element for element, _key in parsed])
+                if self.hierarchical
+                else [None] * len(parsed)
+            )
+            self._trees[rel] = (parsed, parents, {})
+            for i in todo:
+                parent = parents[i]
+                if parent is not None and parent in todo_set:
+                    self._waiting[(rel, parent)] = self._waiting.get((rel, parent), 0) + 1
+        # Cache hits finish inside _dispatch and may dispatch their parent,
+        # so the ready set is taken first.
+        for i in [i for i in todo if (rel, i) not in self._waiting]:
+            self._dispatch(rel, i)
+        if not todo:
+            self._bar.update(1)  # type: ignore[attr-defined]
+
+    def _summarize(self, elements: list[Element], outline: str | None) -> list[_Outcome]:
+        if outline is None:
+            return self.summarizer.summarize_batch(elements, _ANALYZE_LEVELS)
+        return [self.summarizer._summarize_or_error(elements[0], list(_ANALYZE_LEVELS), outline)]
+
+    async def _asummarize(self, elements: list[Element], outline: str | None) -> list[_Outcome]:
+        if outline is None:
+            return await self.summarizer.asummarize_batch(elements, _ANALYZE_LEVELS)
+        return [await self.summarizer._asummarize_or_error(elements[0], list(_ANALYZE_LEVELS), outline)]
+
+    def _submit(self, job: _Job, outline: str | None = None) -> None:
+        elements = [element for element, _key, _rel, _index in job]
+        process = self._asummarize if isinstance(self._pool, AsyncSummaryEngine) else self._summarize
+        future = self._pool.submit(process, elements, outline)  # type: ignore[union-attr, arg-type]
+        self.futures[future] = job
+        future.add_done_callback(self._done.put)
+
+    def _child_summary(self, rel: str, index: int) -> str | None:
+        parsed, _parents, fresh = self._trees[rel]
+        if index in fresh:
+            return fresh[index]
+        entry = self.storage.get_entry(parsed[index][1])
+        levels = dict(entry.get("levels") or {}) if entry else {}  # type: ignore[call-overload]
+        return levels.get(_OUTLINE_LEVEL)  # None (failed child): keep its code
+
+    def _dispatch(self, rel: str, index: int) -> None:
+        parsed, parents, _fresh = self._trees[rel]
+        element, key = parsed[index]
+        item = (element, key, rel, index)
+        ckey = self._cache_keys[key]
+        if ckey in self._followers:
+            self._followers[ckey].append(item)
+            return
+        cached = (
+            self.cache.get(ckey, _ANALYZE_LEVELS) if not self.force or ckey in self._produced else None
+        )
+        if cached is not None:
+            self.reused += 1
+            self._finish(item, cached)
+            return
+        self._followers[ckey] = []
+        children = [i for i, p in enumerate(parents) if p == index]
+        if children:
+            outline = outline_code(
+                element, [(parsed[i][0], self._child_summary(rel, i)) for i in children]
+            )
+            self._submit([item], outline)
+            return
+        tokens = Summarizer.packed_tokens(element)
+        if tokens > self.batch_tokens // 4:
+            self._submit([item])
+            return
+        self._pending.append(item)
+        self._pending_tokens += tokens
+        if self._pending_tokens >= self.batch_tokens or len(self._pending) >= _BATCH_MAX_ELEMENTS:
+            self._submit(self._pending)
+            self._pending, self._pending_tokens = [], 0
+
+    def _drain(self, block: bool) -> None:
+        while self._handled < len(self.futures):
+            try:
+                future = self._done.get(block=block)
+            except queue.Empty:
+                return
+            self._handled += 1
+            job = self.futures[future]
+            outcomes: list[_Outcome]
+            try:
+                outcomes = future.result()
+            except (RuntimeError, OSError, ValueError) as exc:
+                logger.exception("Failed to process %s", job[0][0].path)
+                outcomes = [SummarizationError(str(exc))] * len(job)
+            for item, outcome in zip(job, outcomes):
+                ckey = self._cache_keys[item[1]]
+                waiters = self._followers.pop(ckey, [])
+                if not isinstance(outcome, SummarizationError):
+                    self.cache.put(ckey, outcome)
+                    self._produced.add(ckey)
+                    self.reused += len(waiters)
+                for element in (item, *waiters):
+                    self._finish(element, outcome)
+
+    def _finish(self, item: tuple[Element, str, str, int], outcome: _Outcome) -> None:
+        elem, key, rel, index = item
+        if isinstance(outcome, SummarizationError):
+            logger.error("Failed to summarize %s::%s: %s", elem.path, elem.name, outcome)
+            self.current.pop(rel, None)
+            attempts = int(self._previous_failures.get(key, {}).get("attempts", 0))  # type: ignore[arg-type]
+            self.failures[key] = {
+                "path": elem.path,
+                "name": elem.name,
+                "element_type": elem.element_type,
+                "error": str(outcome),
+                "attempts": attempts + 1,
+                "failed_at": datetime.now(timezone.utc).isoformat(),
+            }
+        else:
+            data = _element_record(elem, outcome, self.code_refs)
+            self.storage.put_element(key, data)
+            with self.storage.telemetry.phase("search_index", cpu_bound=True):
+                self.search.add(key, data)
+                if self.vectors is not None:
+                    self.vectors.add(key, data)
+            self.completed += 1
+            if _OUTLINE_LEVEL in outcome:
+                self._trees[rel][2][index] = outcome[_OUTLINE_LEVEL]
+        self._cache_keys.pop(key, None)
+        parent = self._trees[rel][1][index]
+        if parent is not None and (rel, parent) in self._waiting:
+            self._waiting[(rel, parent)] -= 1
+            if not self._waiting[(rel, parent)]:
+                del self._waiting[(rel, parent)]
+                self._dispatch(rel, parent)
+        self._outstanding[rel] -= 1
+        if not self._outstanding[rel]:
+            del self._trees[rel]
+            self._bar.update(1)  # type: ignore[attr-defined]
+
+
+def collect_garbage(
+    storage: StorageManager, dry_run: bool = False, paths: set[str] | None = None
+) -> tuple[list[str], int]:
+    """Mark-and-sweep stored elements against manifest.json; return (shas, bytes).
+
+    Every sha listed for a manifest file is live.  Anything else is garbage
+    when its file is in the manifest (the element was edited away) or no
+    longer exists under the manifest root (the file was deleted).  Elements
+    of files that exist but are missing from the manifest -- e.g. a file with
+    a queued failure -- are kept, since the next analyze may reuse them.
+    With *paths*, only elements of those files are swept; the rest, such as
+    elements indexed from another root, are left to an explicit ``gc``.
+    """
+    manifest = storage.load_manifest()
+    root = manifest.get("root")
+    if not root:
+        return [], 0
+    files: dict[str, dict[str, object]] = dict(manifest.get("files") or {})  # type: ignore[arg-type]
+    live = {sha for entry in files.values() for sha in entry.get("elements") or ()}  # type: ignore[attr-defined]
+    on_disk: dict[str, bool] = {}
+    garbage: list[str] = []
+    for sha, entry in storage.iter_entries():
+        if sha in live:
+            continue
+        path = str(entry.get("path", ""))
+        if paths is not None and path not in paths:
+            continue
+        if path not in files:
+            if path not in on_disk:
+                on_disk[path] = (Path(str(root)) / path).exists()
+            if on_disk[path]:
+                continue
+        garbage.append(sha)
+    reclaimed = sum(storage.element_bytes(sha) for sha in garbage)
+    if dry_run or not garbage:
+        return garbage, reclaimed
+
+    search = SearchIndex(storage.pyramid_dir)
+    vectors = VectorIndex(storage.pyramid_dir) if _NUMPY_AVAILABLE else None
+    has_search = search.exists()
+    has_vectors = vectors is not None and vectors.exists()
+    for sha in garbage:
+        storage.delete_element(sha)
+        if has_search:
+            search.remove(sha)
+        if has_vectors:
+            vectors.remove(sha)  # type: ignore[union-attr]
+    storage.commit()
+    search.close()
+    if vectors is not None:
+        vectors.close()
+    return garbage, reclaimed
+
+
+def _format_bytes(size: int) -> str:
+    if size < 1024:
+        return f"{size} B"
+    if size < 1024 * 1024:
+        return f"{size / 1024:.1f} KB"
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+_DEFAULT_REQUEST_SECONDS = 3.0  # assumed provider latency when no earlier run measured it
+_BATCH_API_DISCOUNT = 0.5  # provider batch endpoints bill half the interactive price
+
+
+def _completion_tokens(levels: tuple[int, ...] | list[int]) -> int:
+    """Expected answer tokens for one element: the summaries plus JSON syntax."""
+    return int(sum(levels) * 4 / 3) + 6 * len(levels)
+
+
+@dataclass
+class AnalyzeEstimate:
+    """What an analyze run would send: requests, tokens and how they are grouped."""
+
+    elements: int = 0
+    cached: int = 0
+    requests: int = 0
+    packs: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def add_request(self, prompt: str, elements: int = 1) -> None:
+        self.requests += 1
+        self.prompt_tokens += _estimate_tokens(prompt)
+        per_element = _completion_tokens(_ANALYZE_LEVELS)
+        if elements > 1:
+            per_element += 4  # the element's "eN" key in a packed answer
+            self.packs += 1
+        self.completion_tokens += per_element * elements
+
+
+def estimate_analyze(
+    parsed_files: Iterator[tuple[str, list[tuple[Element, str]]]],
+    storage: StorageManager,
+    summarizer: Summarizer,
+    force: bool,
+    batch_tokens: int,
+    hierarchical: bool,
+    batch_api: bool,
+    stale: bool = False,
+) -> AnalyzeEstimate:
+    """Render the prompts analyze would send for *parsed_files*, without sending them.
+
+    Mirrors analyze's dispatch: stored elements and code already in the
+    summary cache (or earlier in this run) are skipped, small elements are
+    packed up to *batch_tokens*, and --hierarchical containers are rendered
+    from an outline whose child summaries stand in at full length.
+    """
+    levels = list(_ANALYZE_LEVELS)
+    child_summary = " ".join(["word"] * int(_OUTLINE_LEVEL))
+    small_tokens = batch_tokens // 4
+    estimate = AnalyzeEstimate()
+    pending: list[Element] = []
+    pending_tokens = 0
+    seen: set[str] = set()
+    cache = None if force else SummaryCache(storage.pyramid_dir)
+
+    def _flush() -> None:
+        if len(pending) == 1:
+            estimate.add_request(Summarizer._build_prompt(pending[0], levels, None, None))
+        elif pending:
+            estimate.add_request(Summarizer._build_batch_prompt(pending, levels), len(pending))
+        pending.clear()
+
+    for _rel, parsed in parsed_files:
+        elements = [element for element, _sha in parsed]
+        parents = element_parents(elements) if hierarchical else [None] * len(elements)
+        for index, (element, key) in enumerate(parsed):
+            if not (force or stale) and storage.has_entry(key):
+                estimate.cached += 1
+                continue
+            ckey = summarizer.cache_key(element)
+            if ckey in seen or (cache is not None and cache.exists() and cache.get(ckey, _ANALYZE_LEVELS) is not None):
+                estimate.cached += 1
+                continue
+            seen.add(ckey)
+            estimate.elements += 1
+            children = [i for i, parent in enumerate(parents) if parent == index]
+            if children:
+                outline = outline_code(element, [(elements[i], child_summary) for i in children])
+                estimate.add_request(Summarizer._build_prompt(element, levels, None, None, outline))
+                continue
+            tokens = Summarizer.packed_tokens(element)
+            if batch_api or tokens > small_tokens:
+                estimate.add_request(Summarizer._build_prompt(element, levels, None, None))
+                continue
+            pending.append(element)
+            pending_tokens += tokens
+            if pending_tokens >= batch_tokens or len(pending) >= _BATCH_MAX_ELEMENTS:
+                _flush()
+                pending_tokens = 0
+    _flush()
+    if cache is not None:
+        cache.close()
+    return estimate
+
+
+def _last_latency(storage: StorageManager, provider: str) -> float | None:
+    """Mean request latency of *provider* in the newest run report that used it."""
+    runs = sorted(storage.runs_dir.glob("*.json"), key=lambda p: p.stat().st_mtime_ns, reverse=True)
+    for path in runs:
+        try:
+            stats = dict(_read_json(path).get("providers") or {}).get(provider)  # type: ignore[call-overload]
+        except (OSError, ValueError):
+            continue
+        if stats and stats.get("latency"):
+            return float(stats["latency"]["mean"])
+    return None
+
+
+def _format_duration(seconds: float) -> str:
+    if seconds < 90:
+        return f"{seconds:.0f}s"
+    if seconds < 90 * 60:
+        return f"{seconds / 60:.0f} min"
+    return f"{seconds / 3600:.1f} h"
+
+
+def _print_estimate(
+    estimate: AnalyzeEstimate,
+    storage: StorageManager,
+    summarizer: Summarizer,
+    provider: str,
+    config: dict[str, object],
+    concurrency: int,
+    batch_api: bool,
+) -> None:
+    """Echo the --dry-run projection: requests, tokens, cost and wall time."""
+    click.echo(f"Elements to summarize: {estimate.elements:,} ({estimate.cached:,} already indexed)")
+    requests = f"Requests: {estimate.requests:,}"
+    if estimate.packs:
+        requests += f" ({estimate.packs:,} packed)"
+    click.echo(requests)
+    click.echo(
+        f"Tokens: ~{estimate.prompt_tokens:,} prompt / ~{estimate.completion_tokens:,} completion"
+    )
+    if provider == "stub":
+        click.echo("Provider: none (placeholder summaries; no cost)")
+        return
+    click.echo(f"Provider: {provider}, model {summarizer.model}")
+
+    prices = {
+        str(prefix): (float(cost[0]), float(cost[1]))
+        for prefix, cost in dict(config.get("prices") or {}).items()  # type: ignore[call-overload]
+    }
+    price = _price(summarizer.model, {**_PRICES, **prices})
+    if provider == "claude-cli":
+        click.echo("Estimated cost: billed to the claude CLI session")
+    elif price is None:
+        click.echo(f'Estimated cost: unknown (add "prices": {{"{summarizer.model}": [input, output]}} to config.json)')
+    else:
+        cost = (estimate.prompt_tokens * price[0] + estimate.completion_tokens * price[1]) / 1e6
+        if batch_api:
+            cost *= _BATCH_API_DISCOUNT
+        amount = f"{cost:,.2f}" if cost >= 1 else f"{cost:.4f}"
+        click.echo(f"Estimated cost: ~${amount}" + (" (batch API pricing)" if batch_api else ""))
+
+    if batch_api:
+        click.echo("Estimated time: set by the provider's batch queue (usually well under 24 h)")
+        return
+    measured = _last_latency(storage, provider)
+    latency = measured if measured is not None else _DEFAULT_REQUEST_SECONDS
+    seconds = estimate.requests * latency / max(1, concurrency)
+    limit = f"{concurrency} in flight"
+    budget = summarizer.scheduler.budget(provider)
+    if budget.get("rpm") and estimate.requests * 60 / budget["rpm"] > seconds:
+        seconds, limit = estimate.requests * 60 / budget["rpm"], f"{budget['rpm']:g} rpm"
+    tokens = estimate.prompt_tokens + estimate.completion_tokens
+    if budget.get("tpm") and tokens * 60 / budget["tpm"] > seconds:
+        seconds, limit = tokens * 60 / budget["tpm"], f"{budget['tpm']:g} tpm"
+    source = "last run" if measured is not None else "assumed"
+    click.echo(
+        f"Estimated time: ~{_format_duration(seconds)} "
+        f"(limited by {limit}; {latency:.1f}s per request, {source})"
+    )
+
+
+def _save_run_report(
+    storage: StorageManager,
+    summarizer: Summarizer,
+    telemetry: Telemetry,
+    config: dict[str, object],
+    provider: str,
+    root: Path,
+) -> None:
+    """Write analyze's run report (and --profile dump) to .pyramid/runs/."""
+    telemetry.count("retries", summarizer.scheduler.retries)
+    telemetry.count("throttled", summarizer.scheduler.throttled)
+    prices = {
+        str(prefix): (float(cost[0]), float(cost[1]))
+        for prefix, cost in dict(config.get("prices") or {}).items()  # type: ignore[call-overload]
+    }
+    report = {
+        "command": "analyze",
+        "root": str(root),
+        "provider": provider,
+        "backend": storage.BACKEND,
+        **telemetry.report(summarizer.model, prices),
+    }
+    try:
+        path = storage.save_run_report(report)
+        if telemetry.profiler is not None:
+            telemetry.profiler.dump_stats(str(path.with_suffix(".prof")))  # type: ignore[attr-defined]
+    except OSError:
+        logger.exception("Failed to write the run report")
+        return
+    tokens_in, tokens_out = telemetry.tokens()
+    if tokens_in or tokens_out:
+        cost = report["cost_usd"]
+        click.echo(
+            f"Tokens: {tokens_in:,} in / {tokens_out:,} out"
+            + (f" (≈ ${cost:.4f})" if cost is not None else "")
+        )
+    if telemetry.profiler is not None:
+        click.echo(f"Run report: {path}")
+        click.echo(f"Profile: {path.with_suffix('.prof')} (python -m pstats to browse)")
+
+
+def _echo_some(lines: list[str], limit: int = 20) -> None:
+    """Echo the first *limit* of *lines*, indented, and how many were left out."""
+    for line in lines[:limit]:
+        click.echo(f"  {line}")
+    if len(lines) > limit:
+        click.echo(f"  … {len(lines) - limit} more")
+
+
+def _auto_prune(storage: StorageManager, paths: set[str]) -> None:
+    """End-of-analyze gc: drop elements the files in *paths* no longer have."""
+    with storage.telemetry.phase("gc", cpu_bound=True):
+        garbage, reclaimed = collect_garbage(storage, paths=paths)
+    if garbage:
+        click.echo(f"Pruned {len(garbage)} stale element(s), reclaimed {_format_bytes(reclaimed)}")
 
 
 def _require_init(storage: StorageManager) -> None:
@@ -718,6 +5113,592 @@ def _prompt_agent_guidance(root: Path) -> None:
     click.echo(f"Added pyramid guidance to {target}", err=True)
 
 
+# ─────────────────────────────────────────────
+# SECTION: Server
+# ─────────────────────────────────────────────
+
+# Read-only commands a running server answers on the client's behalf.
+_SERVED_COMMANDS = frozenset({"list", "query", "get"})
+_SERVER: PyramidServer | None = None
+
+
+def _socket_path(pyramid_dir: Path) -> Path:
+    env = os.environ.get("PYRAMID_SOCKET")
+    return Path(env) if env else pyramid_dir / "serve.sock"
+
+
+class PyramidServer:
+    """Answer CLI commands from one long-lived process over JSON-RPC 2.0.
+
+    Messages are newline-delimited JSON objects.  Methods:
+
+    * ``run`` ``{"argv": [...]}`` -> ``{"stdout", "stderr", "exit_code"}``:
+      run a command in-process against the cached stores.  A command that
+      would write (``get`` of a level not generated yet) answers
+      ``{"local": true}`` instead, and the client runs it itself.
+    * ``reload`` -> ``{"changed": bool}``: pick up writes made by ``analyze``
+      (also done implicitly before every ``run``).
+    * ``ping`` -> ``"pong"``; ``shutdown`` -> ``null`` and stop serving.
+
+    Storage objects stay open per .pyramid/ directory, so the index is parsed
+    once and afterwards only the journal tail or a compacted index.json is
+    re-read when another process changes the store.
+    """
+
+    def __init__(self) -> None:
+        self._storages: dict[Path, StorageManager] = {}
+        self.running = True
+
+    def storage(self, pyramid_dir: Path) -> StorageManager:
+        """Return the cached store for *pyramid_dir*, refreshed from disk."""
+        key = pyramid_dir.resolve()
+        storage = self._storages.get(key)
+        if storage is None:
+            storage = open_storage(key)
+            storage.passive = True
+            self._storages[key] = storage
+        else:
+            storage.refresh()
+        return storage
+
+    def handle(self, message: dict[str, object]) -> dict[str, object] | None:
+        """Dispatch one JSON-RPC request; returns None for notifications."""
+        method = message.get("method")
+        params = message.get("params") or {}
+        result: object
+        if method == "run":
+            result = self._run([str(a) for a in params.get("argv", [])])  # type: ignore[union-attr]
+        elif method == "reload":
+            result = {"changed": any([s.refresh() for s in self._storages.values()])}
+        elif method == "ping":
+            result = "pong"
+        elif method == "shutdown":
+            self.running = False
+            result = None
+        else:
+            return self._error(message.get("id"), -32601, f"Method not found: {method}")
+        if "id" not in message:
+            return None
+        return {"jsonrpc": "2.0", "id": message["id"], "result": result}
+
+    def handle_line(self, line: bytes) -> bytes | None:
+        """Decode, dispatch and encode one newline-delimited message."""
+        try:
+            message = json.loads(line)
+            if not isinstance(message, dict):
+                raise ValueError("request must be a JSON object")
+        except ValueError as exc:
+            response: dict[str, object] | None = self._error(None, -32700, f"Parse error: {exc}")
+        else:
+            response = self.handle(message)
+        if response is None:
+            return None
+        return json.dumps(response, ensure_ascii=False).encode() + b"\n"
+
+    @staticmethod
+    def _error(request_id: object, code: int, text: str) -> dict[str, object]:
+        return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": text}}
+
+    def _run(self, argv: list[str]) -> dict[str, object]:
+        global _SERVER
+        if not argv or argv[0] not in _SERVED_COMMANDS:
+            served = ", ".join(sorted(_SERVED_COMMANDS))
+            return {"stdout": "", "stderr": f"serve only runs: {served}\n", "exit_code": 2}
+        stdout, stderr = io.StringIO(), io.StringIO()
+        exit_code = 0
+        _SERVER = self  # routes _open_storage to the cached stores
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                cli.main(args=argv, prog_name="pyramid_cli.py", standalone_mode=False)
+            except click.ClickException as exc:
+                exc.show()
+                exit_code = exc.exit_code
+            except click.exceptions.Exit as exc:
+                exit_code = exc.exit_code
+            except click.Abort:
+                exit_code = 1
+            except ReadOnlyStoreError as exc:
+                message = f"serve cannot run this command: {exc}\n"
+                return {"stdout": "", "stderr": message, "exit_code": 1, "local": True}
+            except Exception as exc:  # keep serving whatever one command does
+                logger.exception("serve: %s failed", argv[0])
+                click.echo(f"Error: {exc}", err=True)
+                exit_code = 1
+            finally:
+                _SERVER = None
+        return {"stdout": stdout.getvalue(), "stderr": stderr.getvalue(), "exit_code": exit_code}
+
+    def serve_stream(self, infile: io.BufferedIOBase, outfile: io.BufferedIOBase) -> None:
+        """Serve newline-delimited requests from *infile* until EOF or shutdown."""
+        for line in infile:
+            if not line.strip():
+                continue
+            response = self.handle_line(line)
+            if response is not None:
+                outfile.write(response)
+                outfile.flush()
+            if not self.running:
+                return
+
+    def serve_socket(self, path: Path) -> None:
+        """Accept connections on a Unix socket at *path*, one request at a time."""
+        server = self
+
+        class _Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                server.serve_stream(self.rfile, self.wfile)  # type: ignore[arg-type]
+                if not server.running:
+                    threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+        if path.exists():
+            if _server_alive(path):
+                raise click.ClickException(f"A server is already listening on {path}")
+            path.unlink()
+        with socketserver.UnixStreamServer(str(path), _Handler) as unix_server:
+            try:
+                unix_server.serve_forever()
+            finally:
+                path.unlink(missing_ok=True)
+
+
+def _server_alive(path: Path) -> bool:
+    with contextlib.suppress(OSError):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(str(path))
+            return True
+    return False
+
+
+def _rpc_call(path: Path, method: str, params: dict[str, object] | None = None) -> object:
+    """Send one JSON-RPC request over the socket at *path* and return its result."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(path))
+        request = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params or {}}
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as reader:
+            response = json.loads(reader.readline())
+    if "error" in response:
+        raise RuntimeError(response["error"]["message"])
+    return response["result"]
+
+
+def _run_via_server(argv: list[str]) -> int | None:
+    """Thin client: run a read-only command on a live server; None to run locally."""
+    if os.environ.get("PYRAMID_NO_SERVER") or not argv or argv[0] not in _SERVED_COMMANDS:
+        return None
+    if not hasattr(socket, "AF_UNIX") or "--help" in argv:
+        return None
+    db_path: str | None = None
+    for i, arg in enumerate(argv):
+        if arg == "--db-path" and i + 1 < len(argv):
+            db_path = argv[i + 1]
+        elif arg.startswith("--db-path="):
+            db_path = arg.split("=", 1)[1]
+    pyramid_dir = _pyramid_dir(db_path).resolve()
+    path = _socket_path(pyramid_dir)
+    if not path.exists():
+        return None
+    if db_path is None:  # the server's cwd is not ours
+        argv = [*argv, "--db-path", str(pyramid_dir)]
+    try:
+        result = _rpc_call(path, "run", {"argv": argv})
+    except (OSError, ValueError, RuntimeError):
+        return None  # stale socket or server gone: fall back to running locally
+    if result.get("local"):  # type: ignore[union-attr]
+        return None  # it would write to the store: run it in this process
+    sys.stdout.write(result["stdout"])  # type: ignore[index]
+    sys.stderr.write(result["stderr"])  # type: ignore[index]
+    return int(result["exit_code"])  # type: ignore[index]
+
+
+# ─────────────────────────────────────────────
+# SECTION: Watch
+# ─────────────────────────────────────────────
+
+# inotify(7) event bits
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_INOTIFY_EVENT_SIZE = 16  # struct inotify_event without its name
+
+
+class InotifyWatcher:
+    """Linux inotify through ctypes: one watch per non-ignored directory.
+
+    ``changes`` returns touched paths: files, or a directory when one is
+    created, moved in or the kernel queue overflowed (*root* then), which
+    callers rescan.  New directories are watched as they appear.
+    """
+
+    MASK = (
+        _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO
+        | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF
+    )
+
+    def __init__(self, root: Path, dirs: list[Path], path_filter: PathFilter) -> None:
+        import ctypes
+        import ctypes.util
+
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.root = root
+        self._fd = fd
+        self._filter = path_filter
+        self._wds: dict[int, Path] = {}
+        for directory in dirs:
+            self._add(directory)
+
+    def _add(self, directory: Path) -> None:
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            errno = self._ctypes.get_errno()
+            if errno == 28:  # ENOSPC: fs.inotify.max_user_watches exhausted
+                raise OSError(errno, "inotify watch limit reached")
+            return  # the directory is already gone
+        self._wds[wd] = directory
+
+    def _add_tree(self, directory: Path) -> None:
+        for current, subdirs, _files in os.walk(directory):
+            self._add(Path(current))
+            subdirs[:] = [
+                d for d in subdirs
+                if not self._filter.ignored(Path(current, d).relative_to(self.root).as_posix(), True)
+            ]
+
+    def changes(self, timeout: float) -> set[Path]:
+        """Block up to *timeout* seconds; return the paths touched meanwhile."""
+        import select
+        import struct
+
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        changed: set[Path] = set()
+        while ready:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _cookie, length = struct.unpack_from("iIII", buf, offset)
+                name = buf[offset + _INOTIFY_EVENT_SIZE:offset + _INOTIFY_EVENT_SIZE + length]
+                offset += _INOTIFY_EVENT_SIZE + length
+                if mask & _IN_Q_OVERFLOW:
+                    changed.add(self.root)
+                    continue
+                if mask & _IN_IGNORED:
+                    self._wds.pop(wd, None)
+                    continue
+                directory = self._wds.get(wd)
+                if directory is None:
+                    continue
+                name = name.rstrip(b"\0")
+                path = directory / os.fsdecode(name) if name else directory
+                if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                    if self._filter.ignored(path.relative_to(self.root).as_posix(), True):
+                        continue
+                    self._add_tree(path)
+                changed.add(path)
+        return changed
+
+    def close(self) -> None:
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher:
+    """Fallback watcher: rescan the tree every *interval* seconds.
+
+    Cheap because ``walk_directory`` prunes ignored directories; a file is
+    touched when its (mtime_ns, size) changes, appears or disappears.
+    """
+
+    def __init__(self, root: Path, ignore_file: Path | None, interval: float = 1.0) -> None:
+        self.root = root
+        self._ignore_file = ignore_file
+        self._interval = interval
+        self._parser = CodeParser()
+        self._snapshot = self._scan()
+        self._next = time.monotonic() + interval
+
+    def _scan(self) -> dict[Path, tuple[int, int]]:
+        snapshot: dict[Path, tuple[int, int]] = {}
+        for path in self._parser.walk_directory(self.root, self._ignore_file):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            snapshot[path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def changes(self, timeout: float) -> set[Path]:
+        """Block up to *timeout* seconds; return the paths touched meanwhile."""
+        wait = self._next - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0.0, wait))
+        self._next = time.monotonic() + self._interval
+        previous, self._snapshot = self._snapshot, self._scan()
+        return {p for p in previous.keys() | self._snapshot.keys() if previous.get(p) != self._snapshot.get(p)}
+
+    def close(self) -> None:
+        pass
+
+
+class IndexUpdater:
+    """Re-index touched files incrementally (``watch``).
+
+    ``update`` re-parses touched files on the calling thread, stores elements
+    whose code is in the summary cache, and queues each other element not
+    stored yet on a bounded queue served by
+    summarizer threads; when the queue is full ``update`` blocks, so a burst
+    of saves cannot run ahead of the LLM.  ``drain`` stores finished
+    summaries, again on the calling thread.  A file joins the manifest once
+    all its elements are stored, and a newer edit of the same file
+    supersedes one still in flight.
+    """
+
+    def __init__(
+        self,
+        storage: StorageManager,
+        summarizer: Summarizer,
+        root: Path,
+        workers: int = 4,
+        queue_size: int = 64,
+    ) -> None:
+        self.storage = storage
+        self.summarizer = summarizer
+        self.root = root
+        self.ignore_file = root / ".pyramidignore"
+        self.filter = PathFilter(root, self.ignore_file)
+        manifest = storage.load_manifest()
+        self.files: dict[str, dict[str, object]] = (
+            dict(manifest.get("files") or {}) if manifest.get("root") == str(root) else {}  # type: ignore[arg-type]
+        )
+        # Kept as found: only analyze re-checks the tree after a model change.
+        self.summaries = manifest.get("summaries") if self.files else summarizer.version
+        self.code_refs = bool(storage.load_config().get("code_refs"))
+        self.cache = SummaryCache(storage.pyramid_dir)
+        self._parser = CodeParser()
+        self._jobs: queue.Queue[tuple[str, int, Element, str] | None] = queue.Queue(maxsize=queue_size)
+        self._done: queue.SimpleQueue[tuple[str, int, Element, str, dict[str, str] | SummarizationError]] = (
+            queue.SimpleQueue()
+        )
+        # rel -> [generation, unfinished elements, manifest entry, failed elements]
+        self._pending: dict[str, list[object]] = {}
+        self._generation = 0
+        self._stored: dict[str, dict[str, object]] = {}  # sha -> record, since the last flush
+        self._dropped: set[str] = set()  # keys edited or deleted away, since the last flush
+        self._failures: dict[str, dict[str, object]] = {}
+        self._changed = False
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def busy(self) -> bool:
+        return bool(self._pending)
+
+    def _work(self) -> None:
+        while (job := self._jobs.get()) is not None:
+            rel, generation, element, sha = job
+            outcome = self.summarizer._summarize_or_error(element, list(_ANALYZE_LEVELS))
+            self._done.put((rel, generation, element, sha, outcome))
+
+    def _rel(self, path: Path) -> str | None:
+        try:
+            return str(path.relative_to(self.root))
+        except ValueError:
+            return None
+
+    def update(self, paths: set[Path]) -> None:
+        """Re-parse and queue the touched *paths* (files or directories)."""
+        if any(p.name in (".gitignore", self.ignore_file.name) for p in paths):
+            self.filter.reset()
+        touched: set[str] = set()
+        for path in paths:
+            rel = self._rel(path)
+            if rel is None:
+                continue
+            if path.is_dir():
+                # A new directory, or an overflowed event queue: rescan it.
+                prefix = "" if path == self.root else rel + os.sep
+                present = {
+                    str(f.relative_to(self.root))
+                    for f in self._parser.walk_directory(self.root, self.ignore_file)
+                    if str(f.relative_to(self.root)).startswith(prefix)
+                }
+                touched |= present
+                touched |= {r for r in self.files if r.startswith(prefix) and r not in present}
+            else:
+                touched.add(rel)
+                touched |= {r for r in self.files if r.startswith(rel + os.sep)}  # a deleted directory
+        for rel in sorted(touched):
+            path = self.root / rel
+            if path.is_file() and not self.filter.ignored(Path(rel).as_posix()):
+                self._reindex(rel, path)
+            elif rel in self.files or rel in self._pending:
+                self._set_entry(rel, None)
+                self._pending.pop(rel, None)
+                click.echo(f"removed  {rel}")
+
+    def _set_entry(self, rel: str, entry: dict[str, object] | None) -> None:
+        """List *entry* for *rel* (None: unlist it); its old keys become droppable."""
+        prev = self.files.pop(rel, None)
+        if entry is not None:
+            self.files[rel] = entry
+        if prev:
+            kept = set(entry["elements"]) if entry else set()  # type: ignore[call-overload]
+            self._dropped.update(k for k in prev.get("elements") or () if k not in kept)  # type: ignore[attr-defined]
+        self._changed = True
+
+    def _reindex(self, rel: str, path: Path) -> None:
+        try:
+            fingerprint = _stat_fingerprint(path.stat())
+        except OSError:
+            return
+        prev = self.files.get(rel)
+        if rel not in self._pending and prev and all(prev.get(k) == v for k, v in fingerprint.items()):
+            return
+        try:
+            elements = self._parser.parse_file(path, self.root)
+        except (OSError, ValueError):
+            logger.exception("Failed to parse %s", path)
+            return
+        keyed = element_keys(elements)
+        keys = [key for _element, key in keyed]
+        entry: dict[str, object] = {**fingerprint, "sha": keys[0] if keys else "", "elements": keys}
+        todo = []
+        for element, key in keyed:
+            if self.storage.has_entry(key):
+                if self.code_refs and element.element_type != "file":
+                    _refresh_code_ref(self.storage, key, element)
+                continue
+            cached = self.cache.get(self.summarizer.cache_key(element), _ANALYZE_LEVELS)
+            if cached is None:
+                todo.append((element, key))
+                continue
+            data = _element_record(element, cached, self.code_refs)
+            self.storage.put_element(key, data)
+            self._stored[key] = data
+        if not todo:
+            self._pending.pop(rel, None)
+            self._set_entry(rel, entry)
+            click.echo(f"updated  {rel}")
+            return
+        self._generation += 1
+        self._pending[rel] = [self._generation, len(todo), entry, 0]
+        for element, sha in todo:
+            self._jobs.put((rel, self._generation, element, sha))  # blocks while the queue is full
+
+    def drain(self) -> None:
+        """Store every finished summary; flush to disk if anything changed."""
+        while True:
+            try:
+                rel, generation, element, sha, outcome = self._done.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(outcome, SummarizationError):
+                logger.error("Failed to summarize %s::%s: %s", element.path, element.name, outcome)
+                self._failures[sha] = {
+                    "path": element.path,
+                    "name": element.name,
+                    "element_type": element.element_type,
+                    "error": str(outcome),
+                    "attempts": 1,
+                    "failed_at": datetime.now(timezone.utc).isoformat(),
+                }
+            else:
+                data = _element_record(element, outcome, self.code_refs)
+                self.storage.put_element(sha, data)
+                self.cache.put(self.summarizer.cache_key(element), outcome)
+                self._stored[sha] = data
+            state = self._pending.get(rel)
+            if state is None or state[0] != generation:
+                continue  # superseded by a newer edit; the summary is still kept
+            state[1] = int(state[1]) - 1  # type: ignore[call-overload]
+            if isinstance(outcome, SummarizationError):
+                state[3] = int(state[3]) + 1  # type: ignore[call-overload]
+            if state[1]:
+                continue
+            del self._pending[rel]
+            self._changed = True
+            if state[3]:
+                self.files.pop(rel, None)
+                click.echo(f"failed   {rel}: {state[3]} element(s) queued for retry", err=True)
+            else:
+                self._set_entry(rel, state[2])  # type: ignore[arg-type]
+                click.echo(f"updated  {rel}")
+        if self._changed or self._stored:
+            self.flush()
+
+    def flush(self) -> None:
+        # Only the keys touched files dropped are deleted; a full gc over the
+        # store is left to analyze and gc.  Keys still listed, or awaited by
+        # a pending file, were reused and stay.
+        live = {k for entry in self.files.values() for k in entry.get("elements") or ()}  # type: ignore[attr-defined]
+        live |= {k for state in self._pending.values() for k in state[2].get("elements") or ()}  # type: ignore[attr-defined]
+        dropped = sorted(self._dropped - live)
+        self._dropped = set()
+        for sha in dropped:
+            self.storage.delete_element(sha)
+            self._stored.pop(sha, None)
+        self.storage.commit()
+        self.cache.commit()
+        if self._stored or dropped:
+            search = SearchIndex(self.storage.pyramid_dir)
+            vectors = VectorIndex(self.storage.pyramid_dir) if _NUMPY_AVAILABLE else None
+            for sha in dropped:
+                search.remove(sha)
+                if vectors is not None:
+                    vectors.remove(sha)
+            for sha, data in self._stored.items():
+                search.add(sha, data)
+                if vectors is not None:
+                    vectors.add(sha, data)
+            search.close()
+            if vectors is not None:
+                vectors.close()
+            self._stored = {}
+        if self._failures:
+            retry = self.storage.load_retry_queue()
+            retry.update(self._failures)
+            self.storage.save_retry_queue(retry)
+            self._failures = {}
+        if self._changed:
+            self.storage.save_manifest(
+                {"root": str(self.root), "files": self.files, "summaries": self.summaries}
+            )
+            self._changed = False
+
+    def close(self) -> None:
+        """Drop queued work, let in-flight requests finish, store their results."""
+        while True:
+            try:
+                self._jobs.get_nowait()
+            except queue.Empty:
+                break
+        for _thread in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self.drain()
+        self.cache.close()
+
+
 # ─────────────────────────────────────────────
 # SECTION: CLI commands
 # ─────────────────────────────────────────────
@@ -740,13 +5721,28 @@ def cli() -> None:
     type=click.Choice(["anthropic", "openai"]),
     help="LLM provider (default: anthropic).",
 )
-def init(db_path: str | None, api: str) -> None:
+@click.option(
+    "--backend",
+    default="json",
+    type=click.Choice(sorted(_BACKENDS)),
+    help="Storage backend (default: json; sqlite or pack for large repos).",
+)
+@click.option(
+    "--code-refs",
+    is_flag=True,
+    help="Store code as byte ranges into the working tree instead of inline copies.",
+)
+def init(db_path: str | None, api: str, backend: str, code_refs: bool) -> None:
     """Initialize pyramid generator in the current directory."""
-    storage = StorageManager(_pyramid_dir(db_path))
-    if storage.is_initialized():
-        click.echo(f"Already initialized at {storage.pyramid_dir}")
+    existing = _open_storage(db_path)
+    if existing.is_initialized():
+        click.echo(f"Already initialized at {existing.pyramid_dir}")
         return
+    storage = open_storage(existing.pyramid_dir, backend)
     storage.init(api=api)
+    if code_refs:
+        storage.save_config({**storage.load_config(), "code_refs": True})
+    storage.close()
     click.echo(f"Initialized pyramid generator at {storage.pyramid_dir}")
 
     # Prompt to document the skill if no guidance exists yet.
@@ -779,6 +5775,65 @@ def init(db_path: str | None, api: str) -> None:
 @click.option("--model", default=None, help="Override LLM model name.")
 @click.option("--force", is_flag=True, help="Re-analyze all files, ignoring cache.")
 @click.option("--workers", default=4, show_default=True, help="Parallel LLM workers.")
+@click.option(
+    "--concurrency",
+    default=0,
+    type=click.IntRange(min=0),
+    help="Use the asyncio engine with up to N in-flight LLM requests (overrides --workers).",
+)
+@click.option("--rpm", default=None, type=float, help="Requests-per-minute budget for the provider.")
+@click.option("--tpm", default=None, type=float, help="Tokens-per-minute budget for the provider.")
+@click.option(
+    "--max-attempts",
+    default=6,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="LLM attempts per element before it goes on the retry queue.",
+)
+@click.option(
+    "--parse-workers",
+    default=None,
+    type=click.IntRange(min=1),
+    help="Parser processes (default: CPU count; 1 parses in-process).",
+)
+@click.option(
+    "--batch-tokens",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Pack small elements into shared LLM requests of about N prompt tokens (0 = off).",
+)
+@click.option(
+    "--batch-api",
+    is_flag=True,
+    help="Summarize through the provider's asynchronous batch API (cheaper, slower; resumable).",
+)
+@click.option(
+    "--poll-interval",
+    default=60.0,
+    show_default=True,
+    type=click.FloatRange(min=0),
+    help="Seconds between batch status checks with --batch-api.",
+)
+@click.option("--no-wait", is_flag=True, help="With --batch-api: submit or check once, then exit.")
+@click.option("--no-gc", "no_gc", is_flag=True, help="Keep stale elements (skip the end-of-run gc).")
+@click.option("--no-git", "no_git", is_flag=True, help="Walk and stat the tree even inside a git checkout.")
+@click.option(
+    "--hierarchical",
+    is_flag=True,
+    help="Summarize bottom-up: classes and files from outlines plus their children's summaries.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Walk, parse and diff as usual, then print the projected requests, tokens, cost and time; "
+    "no LLM call, nothing written.",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Save a cProfile dump of the CPU-bound phases next to the run report in .pyramid/runs/.",
+)
 @click.option("--no-llm", "no_llm", is_flag=True, help="Skip LLM; write placeholder summaries.")
 def analyze(
     path: str,
@@ -787,38 +5842,154 @@ def analyze(
     model: str | None,
     force: bool,
     workers: int,
+    concurrency: int,
+    rpm: float | None,
+    tpm: float | None,
+    max_attempts: int,
+    parse_workers: int | None,
+    batch_tokens: int,
+    batch_api: bool,
+    poll_interval: float,
+    no_wait: bool,
+    no_gc: bool,
+    no_git: bool,
+    hierarchical: bool,
+    dry_run: bool,
+    profile: bool,
     no_llm: bool,
 ) -> None:
     """Analyze a codebase and generate pyramid summaries."""
     root = Path(path).resolve()
-    storage = StorageManager(_pyramid_dir(db_path))
+    storage = _open_storage(db_path)
     _require_init(storage)
+    # However the run ends -- interrupted, failed or done -- the store and
+    # the summary cache are committed, so no finished summary is lost.
+    ctx = click.get_current_context()
+    ctx.call_on_close(storage.close)
+
+    # A dry run opens the store passively, like serve: the journal of an
+    # interrupted run is replayed in memory, and recovery waits for a real run.
+    storage.passive = dry_run
+    recovered = 0 if dry_run else storage.recover()
+    if recovered:
+        click.echo(f"Recovered {recovered} element(s) stored by an interrupted run")
 
     config = storage.load_config()
-    effective_api = api or str(config.get("api", "anthropic"))
-    summarizer = Summarizer(api=effective_api, model=model, no_llm=no_llm)
+    code_refs = bool(config.get("code_refs"))
+    summarizer, provider = _build_summarizer(
+        config, api, model, no_llm, concurrency or workers, rpm, tpm, max_attempts
+    )
+    # One Telemetry for the whole run; the report is written however the
+    # command ends (up to date, batch submitted, finished, or failed).
+    telemetry = Telemetry(profile=profile)
+    storage.telemetry = summarizer.telemetry = telemetry
+    if not dry_run:
+        ctx.call_on_close(
+            lambda: _save_run_report(storage, summarizer, telemetry, config, provider, root)
+        )
+    if batch_api and hierarchical:
+        raise click.UsageError("--hierarchical needs several dependent rounds; use it without --batch-api.")
+    if batch_api:
+        if provider not in ("anthropic", "openai"):
+            raise click.ClickException(
+                "--batch-api needs a provider batch endpoint: set ANTHROPIC_API_KEY or OPENAI_API_KEY."
+            )
+        # A job left by an earlier run is finished before anything new is sent.
+        job = storage.load_batch_job()
+        if job is not None and dry_run:
+            click.echo("A batch job from an earlier run is in flight; a real run finishes it first.")
+        elif job is not None:
+            ids = ", ".join(str(b["id"]) for b in job["batches"])  # type: ignore[attr-defined]
+            click.echo(f"Resuming batch job(s): {ids}")
+            _finish_batch_job(storage, summarizer, job, poll_interval, wait=not no_wait)
+            return
     parser = CodeParser()
+    parser.telemetry = telemetry
 
     click.echo(f"Analyzing: {root}")
-    files = parser.walk_directory(root, root / ".pyramidignore")
-    click.echo(f"Source files found: {len(files)}")
-
-    index = storage.load_index()
-    pending: list[tuple[Element, str]] = []
-    for file_path in files:
-        for element in parser.parse_file(file_path, root):
-            sha = element.content_hash()
-            if not force and sha in index:
-                continue
-            pending.append((element, sha))
-
-    if not pending:
+    # Inside a git checkout, git lists the files and supplies blob ids as
+    # content fingerprints, so nothing is walked or hashed; only files that
+    # differ from the index are stat'ed.
+    git = None
+    if not no_git:
+        with telemetry.phase("git"):
+            git = git_tree(root, str(config.get("last_commit") or "") or None, root / ".pyramidignore")
+    if git is not None:
+        files = [root / rel for rel in sorted(git.files)]
+        click.echo(f"Source files found: {len(files)} (from git)")
+    else:
+        files = parser.walk_directory(root, root / ".pyramidignore")
+        click.echo(f"Source files found: {len(files)}")
+
+    def _save_manifest() -> None:
+        storage.save_manifest({"root": str(root), "files": current, "summaries": summaries})
+        if git is not None and git.head and config.get("last_commit") != git.head:
+            storage.save_config({**config, "last_commit": git.head})
+
+    manifest = storage.load_manifest()
+    previous: dict[str, dict[str, object]] = (
+        dict(manifest.get("files") or {}) if manifest.get("root") == str(root) else {}  # type: ignore[arg-type]
+    )
+    # Summaries are cached by code and summarizer version.  A store from
+    # before the cache seeds it once; after a model or prompt change every
+    # file is re-parsed and its elements re-checked against the cache.
+    # Placeholders (--no-llm, or no provider) only fill in new elements:
+    # they never make stored summaries stale or take over the version.
+    cache = SummaryCache(storage.pyramid_dir)
+    ctx.call_on_close(cache.close)
+    version = manifest.get("summaries")
+    placeholder = provider == "stub"
+    if previous and version is None and not dry_run and not placeholder:
+        seeded = seed_summary_cache(storage, cache, summarizer.version)
+        if seeded:
+            click.echo(f"Seeded the summary cache from {seeded} stored element(s)")
+    stale = bool(previous) and version != summarizer.version and not placeholder
+    summaries = version if placeholder and previous else summarizer.version
+    if stale and version is not None:
+        click.echo("Model or prompts changed since the last run; re-checking every file")
+    with telemetry.phase("fingerprint", cpu_bound=True):
+        diff = diff_tree(root, files, previous, git, rescan=force or stale)
+    current = diff.current
+
+    def _prune() -> None:
+        # Only files this root listed before or lists now.  Elements stored
+        # from another root are not this run's garbage; gc sweeps them.
+        if not no_gc and manifest.get("root") in (None, str(root)):
+            _auto_prune(storage, set(previous) | set(current))
+
+    telemetry.count("files_found", len(files))
+    telemetry.count("files_unchanged", diff.unchanged)
+    telemetry.count("files_renamed", len(diff.moves))
+    telemetry.count("files_deleted", len(diff.deleted))
+    telemetry.count("files_parsed", len(diff.to_parse))
+    if diff.unchanged:
+        click.echo(f"Unchanged files skipped: {diff.unchanged}")
+    if diff.moves:
+        click.echo(f"Renamed since last run: {len(diff.moves)} file(s)")
+        _echo_some([f"{old} → {new}" for old, new, _keys in diff.moves])
+        # Unchanged elements keep their summaries; only their path, and so
+        # their location key, changes.
+        if not dry_run:
+            rekeyed = _relocate_elements(storage, diff.moves)
+            for _old, new, _keys in diff.moves:
+                if new in current:
+                    keys = [rekeyed.get(k, k) for k in current[new].get("elements") or ()]  # type: ignore[attr-defined]
+                    current[new] = {**current[new], "sha": keys[0] if keys else "", "elements": keys}
+    if diff.deleted:
+        click.echo(f"Deleted since last run: {len(diff.deleted)} file(s)")
+        _echo_some([f"- {rel}" for rel in diff.deleted])
+
+    to_parse = diff.to_parse
+    if not to_parse and dry_run:
+        click.echo("All files up to date; a real run would make no LLM calls.")
+        return
+    if not to_parse:
+        _save_manifest()
         click.echo("All files up to date.")
+        _prune()
+        storage.close()
         return
 
-    click.echo(f"Elements to summarize: {len(pending)}")
-
-    provider = summarizer._detect_provider()
     if provider == "stub" and not no_llm:
         click.echo(
             "Warning: no LLM provider configured. Using placeholder summaries.\n"
@@ -826,41 +5997,80 @@ def analyze(
             err=True,
         )
 
-    def _process(item: tuple[Element, str]) -> tuple[str, dict[str, object]]:
-        element, sha = item
-        summaries = summarizer.summarize(element, _ANALYZE_LEVELS)
-        storage.save_data(sha, {
-            "path": element.path,
-            "element_type": element.element_type,
-            "name": element.name,
-            "start_line": element.start_line,
-            "end_line": element.end_line,
-            "code": element.code,
-            "levels": summaries,
-        })
-        return sha, {
-            "path": element.path,
-            "element_type": element.element_type,
-            "name": element.name,
-            "levels": summaries,
-        }
+    if dry_run:
+        click.echo(f"Files to parse: {len(to_parse):,}")
+        estimate = estimate_analyze(
+            iter_parsed_files(to_parse, root, parse_workers or os.cpu_count() or 1, telemetry),
+            storage,
+            summarizer,
+            force,
+            batch_tokens,
+            hierarchical,
+            batch_api,
+            stale,
+        )
+        _print_estimate(estimate, storage, summarizer, provider, config, concurrency or workers, batch_api)
+        click.echo("Dry run: no LLM calls were made and .pyramid/ was not changed.")
+        return
 
-    completed = 0
-    with click.progressbar(length=len(pending), label="Summarizing") as bar:
-        with ThreadPoolExecutor(max_workers=workers) as pool:
-            futures = {pool.submit(_process, item): item for item in pending}
-            for future in as_completed(futures):
-                try:
-                    sha, entry = future.result()
-                    index[sha] = entry
-                    completed += 1
-                except (RuntimeError, OSError, ValueError):
-                    elem, _ = futures[future]
-                    logger.exception("Failed to process %s", elem.path)
-                bar.update(1)
+    if batch_api:
+        job = _submit_batch_job(
+            storage, summarizer, provider, root, to_parse, diff.fingerprints, current, force, parse_workers,
+            stale, code_refs,
+        )
+        if job is None:
+            storage.close()
+            click.echo("All files up to date.")
+            return
+        _finish_batch_job(storage, summarizer, job, poll_interval, wait=not no_wait)
+        return
+
+    pipeline = SummaryPipeline(
+        storage, summarizer, cache, current, diff.fingerprints, force, stale, hierarchical, batch_tokens,
+        code_refs,
+    )
+    with click.progressbar(length=len(to_parse), label="Indexing") as bar, telemetry.phase("pipeline"):
+        pipeline.run(
+            iter_parsed_files(to_parse, root, parse_workers or os.cpu_count() or 1, telemetry),
+            workers,
+            concurrency,
+            bar,
+        )
+
+    cache.close()
+    if not pipeline.futures and not pipeline.reused:
+        _save_manifest()
+        storage.save_retry_queue({})
+        click.echo("All files up to date.")
+        _prune()
+        storage.close()
+        return
 
-    storage.save_index(index)
-    click.echo(f"\nDone. Indexed {completed} elements → {storage.pyramid_dir}")
+    pipeline.commit()
+    _save_manifest()
+    storage.save_retry_queue(pipeline.failures)
+    telemetry.count("elements_summarized", pipeline.completed - pipeline.reused)
+    telemetry.count("elements_reused", pipeline.reused)
+    telemetry.count("elements_failed", len(pipeline.failures))
+    click.echo(f"\nDone. Indexed {pipeline.completed} elements → {storage.pyramid_dir}")
+    if pipeline.reused:
+        click.echo(f"Reused cached summaries for {pipeline.reused} element(s) with code summarized before")
+    _prune()
+    storage.close()
+    packs, packed = pipeline.packs()
+    if packs:
+        telemetry.count("packs", packs)
+        telemetry.count("elements_packed", packed)
+        click.echo(f"Packed {packed} small elements into {packs} request(s)")
+    scheduler = summarizer.scheduler
+    if scheduler.retries:
+        click.echo(f"Retries: {scheduler.retries} ({scheduler.throttled} throttled)")
+    if pipeline.failures:
+        click.echo(
+            f"{len(pipeline.failures)} element(s) failed and were queued in {storage.retry_path.name}; "
+            "re-run analyze to retry them.",
+            err=True,
+        )
 
 
 # ── query ─────────────────────────────────────
@@ -872,7 +6082,7 @@ def analyze(
     "--level",
     default="16",
     type=click.Choice(["4", "8", "16", "32", "64"]),
-    help="Summary level to search (default: 16).",
+    help="Summary level to display (default: 16).",
 )
 @click.option(
     "--type",
@@ -881,44 +6091,68 @@ def analyze(
     type=click.Choice(["file", "function", "class"]),
     help="Filter by element type.",
 )
+@click.option(
+    "--match",
+    default="all",
+    type=click.Choice(["all", "any"]),
+    help="Require all query terms (AND) or any of them (OR). Default: all.",
+)
+@click.option(
+    "--semantic",
+    is_flag=True,
+    help="Rank by offline vector similarity instead of keywords (needs numpy).",
+)
 @click.option("--db-path", default=None)
 @click.option("--limit", default=20, show_default=True, help="Max results.")
 def query(
     query_text: str,
     level: str,
     element_type: str | None,
+    match: str,
+    semantic: bool,
     db_path: str | None,
     limit: int,
 ) -> None:
-    """Search pyramid summaries by keyword."""
-    storage = StorageManager(_pyramid_dir(db_path))
+    """Search pyramid summaries, paths and names, ranked by BM25."""
+    storage = _open_storage(db_path)
     _require_init(storage)
 
-    index = storage.load_index()
-    if not index:
+    total = storage.count()
+    if not total:
         raise click.ClickException("No indexed elements. Run: uv run pyramid_cli.py analyze .")
 
-    needle = query_text.lower()
-    results: list[tuple[dict[str, object], str, str]] = []
-
-    for sha, entry in index.items():
-        if element_type and entry.get("element_type") != element_type:
-            continue
-        levels_data = entry.get("levels") or {}
-        summary = str(levels_data.get(level, ""))  # type: ignore[union-attr]
-        path_str = str(entry.get("path", ""))
-        if needle in summary.lower() or needle in path_str.lower():
-            results.append((entry, summary, sha))
+    if semantic:
+        if not _NUMPY_AVAILABLE:
+            raise click.ClickException("query --semantic needs numpy: uv add numpy")
+        vectors = VectorIndex(storage.pyramid_dir)
+        if vectors.count() != total:
+            click.echo("Building vector index…", err=True)
+            vectors.rebuild(storage)
+        results = vectors.search(query_text, element_type=element_type)
+    else:
+        search = SearchIndex(storage.pyramid_dir)
+        if search.count() != total:
+            click.echo("Building search index…", err=True)
+            search.rebuild(storage)
+        results = search.search(query_text, match=match, element_type=element_type)
 
     if not results:
         click.echo(f"No results for '{query_text}' at level {level}.")
         return
 
     click.echo(f"{len(results)} result(s) for '{query_text}' (level {level}):\n")
-    for entry, summary, _sha in results[:limit]:
+    for sha, _score in results[:limit]:
+        entry = storage.get_entry(sha)
+        if entry is None:
+            continue
         path_str = str(entry.get("path", ""))
         etype = str(entry.get("element_type", "file"))
         name = str(entry.get("name", ""))
+        levels_data = dict(entry.get("levels") or {})  # type: ignore[arg-type]
+        if level not in levels_data:
+            data = storage.load_data(sha) or {}
+            levels_data = dict(data.get("levels") or {})  # type: ignore[arg-type]
+        summary = str(levels_data.get(level, ""))
         label = path_str if etype == "file" else f"{path_str}::{name}"
         click.echo(f"  {label}  [{etype}]")
         click.echo(f"    {summary}")
@@ -943,6 +6177,7 @@ def query(
 @click.option("--db-path", default=None)
 @click.option("--api", default=None, type=click.Choice(["anthropic", "openai"]))
 @click.option("--model", default=None)
+@click.option("--workers", default=4, show_default=True, help="Parallel LLM workers for missing levels.")
 def get(
     element_path: str,
     level: str,
@@ -950,18 +6185,13 @@ def get(
     db_path: str | None,
     api: str | None,
     model: str | None,
+    workers: int,
 ) -> None:
     """Get pyramid summary for a specific code element."""
-    storage = StorageManager(_pyramid_dir(db_path))
+    storage = _open_storage(db_path)
     _require_init(storage)
 
-    index = storage.load_index()
-    needle = element_path.lower().replace("\\", "/")
-    matches = [
-        (sha, entry)
-        for sha, entry in index.items()
-        if str(entry.get("path", "")).lower().replace("\\", "/").startswith(needle)
-    ]
+    matches = storage.find_by_path(element_path)
 
     if not matches:
         raise click.ClickException(
@@ -969,86 +6199,56 @@ def get(
             "Run `uv run pyramid_cli.py list` to see available paths."
         )
 
+    # Fast path: level in index (4/8/16); then data/<sha>.json.  Whatever
+    # is still missing is generated for all matches at once.
+    summaries: dict[str, str] = {}
+    missing: list[tuple[str, dict[str, object]]] = []
     for sha, entry in matches:
-        path_str = str(entry.get("path", ""))
-        name = str(entry.get("name", ""))
-        etype = str(entry.get("element_type", "file"))
-        label = path_str if etype == "file" else f"{path_str}::{name}"
-
-        # Fast path: level in index (4/8/16)
         levels_data = entry.get("levels") or {}
         summary = str(levels_data.get(level, ""))  # type: ignore[union-attr]
-
         if not summary:
-            # Slow path: check or generate in data/<sha>.json
             data = storage.load_data(sha)
             if data is None:
                 raise click.ClickException(
-                    f"Data file missing for '{path_str}'. Re-run analyze."
+                    f"Data file missing for '{entry.get('path', '')}'. Re-run analyze."
                 )
-            data_levels: dict[str, str] = dict(data.get("levels") or {})  # type: ignore[arg-type]
-            summary = data_levels.get(level, "")
-
+            summary = str(dict(data.get("levels") or {}).get(level, ""))  # type: ignore[call-overload]
             if not summary:
-                # Fill every missing level in sequence from the lowest gap up to
-                # the requested level, so the prefix chain is never broken.
-                # Example: target=32, stored={4,8,16} → generate only 32
-                # Example: target=32, stored={4}      → generate 8, 16, 32 in order
-                target = int(level)
-                target_idx = LEVEL_SEQUENCE.index(target)
-                to_generate = [
-                    lv for lv in LEVEL_SEQUENCE[: target_idx + 1]
-                    if str(lv) not in data_levels
-                ]
-
-                config = storage.load_config()
-                effective_api = api or str(config.get("api", "anthropic"))
-                summarizer = Summarizer(api=effective_api, model=model)
-                element = Element(
-                    path=path_str,
-                    element_type=etype,
-                    name=name,
-                    code=str(data.get("code", "")),
-                    start_line=int(data.get("start_line", 1)),  # type: ignore[arg-type]
-                    end_line=int(data.get("end_line", 1)),  # type: ignore[arg-type]
-                )
-
-                # Seed = highest stored level below the first gap
-                first_missing = to_generate[0]
-                available_below = [
-                    lv for lv in LEVEL_SEQUENCE
-                    if lv < first_missing and str(lv) in data_levels
-                ]
-                cur_seed_level: int | None = max(available_below) if available_below else None
-                cur_seed: str | None = (
-                    data_levels[str(cur_seed_level)] if cur_seed_level else None
-                )
-
-                click.echo(
-                    f"Generating level(s) {to_generate} for '{label}'…", err=True
+                missing.append((sha, data))
+                continue
+        summaries[sha] = summary
+
+    if missing:
+        if storage.passive:
+            # Served: new levels are stored by the client's own process, never
+            # over the store a writer may be updating.
+            raise ReadOnlyStoreError(f"level {level} must be generated; run get locally")
+        config = storage.load_config()
+        summarizer = Summarizer(api=api or str(config.get("api", "anthropic")), model=model)
+        what = _element_label(missing[0][1]) if len(missing) == 1 else f"{len(missing)} elements"
+        click.echo(f"Generating level {level} for '{what}'…", err=True)
+        results = _expand_elements(storage, summarizer, missing, int(level), workers)
+        for sha, data in missing:
+            outcome = results[sha]
+            if isinstance(outcome, SummarizationError):
+                raise click.ClickException(
+                    f"Could not generate level {level} for '{_element_label(data)}': {outcome}"
                 )
-                for gen_level in to_generate:
-                    result = summarizer.summarize(
-                        element,
-                        (gen_level,),
-                        seed=cur_seed,
-                        seed_level=cur_seed_level,
-                    )
-                    generated = result.get(str(gen_level), f"{etype} {name}")
-                    data_levels[str(gen_level)] = generated
-                    cur_seed_level = gen_level
-                    cur_seed = generated
-
-                storage.save_data(sha, {**data, "levels": data_levels})  # type: ignore[arg-type]
-                summary = data_levels.get(level, "")
+            summaries[sha] = outcome.get(level, "")
 
+    root = storage.load_manifest().get("root") if show_code else None
+    for sha, entry in matches:
+        label = _element_label(entry)
+        summary = summaries[sha]
         click.echo(f"{label}  (level {level})")
         click.echo(f"  {summary}")
 
         if show_code:
             data = storage.load_data(sha)
-            code = str(data.get("code", "")) if data else ""
-            if code:
+            code = _element_code(storage, data, str(root) if root else None) if data else ""
+            if code is None:
+                click.echo("  (source changed since indexing and no stored copy matches; re-run analyze)")
+            elif code:
                 click.echo()
                 click.echo("─" * 72)
                 click.echo(code)
@@ -1056,6 +6256,71 @@ def get(
         click.echo()
 
 
+# ── expand ────────────────────────────────────
+
+
+@cli.command()
+@click.argument("prefixes", nargs=-1)
+@click.option(
+    "--level",
+    default="64",
+    type=click.Choice(["32", "64"]),
+    help="Deepest level to generate; lower missing levels are filled on the way (default: 64).",
+)
+@click.option(
+    "--type",
+    "element_type",
+    default=None,
+    type=click.Choice(["file", "function", "class"]),
+    help="Only expand elements of this type.",
+)
+@click.option("--workers", default=8, show_default=True, help="Elements expanded in parallel.")
+@click.option("--db-path", default=None)
+@click.option("--api", default=None, type=click.Choice(["anthropic", "openai"]))
+@click.option("--model", default=None)
+@click.option("--no-llm", "no_llm", is_flag=True, help="Skip LLM; write placeholder summaries.")
+def expand(
+    prefixes: tuple[str, ...],
+    level: str,
+    element_type: str | None,
+    workers: int,
+    db_path: str | None,
+    api: str | None,
+    model: str | None,
+    no_llm: bool,
+) -> None:
+    """Pre-generate deep levels (32/64) for elements under PREFIXES (default: all)."""
+    storage = _open_storage(db_path)
+    _require_init(storage)
+
+    selected: dict[str, dict[str, object]] = {}
+    for prefix in prefixes or ("",):
+        for sha, entry in storage.find_by_path(prefix):
+            if element_type is None or entry.get("element_type") == element_type:
+                selected[sha] = entry
+    if not selected:
+        raise click.ClickException("No matching elements. Run `uv run pyramid_cli.py list` to see paths.")
+
+    todo: list[tuple[str, dict[str, object]]] = []
+    for sha in selected:
+        data = storage.load_data(sha)
+        if data is not None and level not in dict(data.get("levels") or {}):  # type: ignore[call-overload]
+            todo.append((sha, data))
+    if not todo:
+        click.echo(f"All {len(selected)} element(s) already have level {level}.")
+        storage.close()
+        return
+
+    summarizer, _provider = _build_summarizer(storage.load_config(), api, model, no_llm, workers)
+    with click.progressbar(length=len(todo), label=f"Expanding to level {level}") as bar:
+        results = _expand_elements(storage, summarizer, todo, int(level), workers, bar)
+    storage.close()
+    failed = [sha for sha, outcome in results.items() if isinstance(outcome, SummarizationError)]
+    click.echo(f"\nExpanded {len(todo) - len(failed)} element(s) to level {level}.")
+    if failed:
+        click.echo(f"{len(failed)} element(s) failed; re-run expand to retry them.", err=True)
+
+
 # ── list ──────────────────────────────────────
 
 
@@ -1076,37 +6341,232 @@ def get(
 @click.option("--db-path", default=None)
 def list_cmd(level: str, element_type: str, db_path: str | None) -> None:
     """List indexed code elements with their summaries."""
-    storage = StorageManager(_pyramid_dir(db_path))
+    storage = _open_storage(db_path)
     _require_init(storage)
 
-    index = storage.load_index()
-    if not index:
+    if not storage.count():
         raise click.ClickException("No indexed elements. Run: uv run pyramid_cli.py analyze .")
 
-    rows: dict[str, tuple[str, str]] = {}
-    for _sha, entry in index.items():
+    # iter_sorted yields in path order, so rows need no sorting here.
+    rows: list[tuple[str, str]] = []
+    for _sha, entry in storage.iter_sorted(None if element_type == "all" else element_type):
         etype = str(entry.get("element_type", "file"))
-        if element_type != "all" and etype != element_type:
-            continue
         path_str = str(entry.get("path", ""))
         name = str(entry.get("name", ""))
         levels_data = entry.get("levels") or {}
         summary = str(levels_data.get(level, ""))  # type: ignore[union-attr]
         label = path_str if etype == "file" else f"{path_str}::{name}"
-        rows[label] = (summary, etype)
+        if rows and rows[-1][0] == label:
+            continue  # same-named members (overloads, redefinitions) list once
+        rows.append((label, summary))
 
     if not rows:
         click.echo(f"No {element_type} elements found.")
         return
 
     click.echo(f"{element_type.capitalize()} elements ({len(rows)} total):\n")
-    for label, (summary, _etype) in sorted(rows.items()):
+    for label, summary in rows:
         click.echo(f"  {label}")
         if summary:
             click.echo(f"    {summary}")
         click.echo()
 
 
+# ── gc ────────────────────────────────────────
+
+
+@cli.command()
+@click.option("--dry-run", is_flag=True, help="Report what would be removed without deleting.")
+@click.option("--db-path", default=None, help="Override .pyramid/ location.")
+def gc(dry_run: bool, db_path: str | None) -> None:
+    """Remove stored elements that the analyzed tree no longer contains.
+
+    With the pack backend the pack is then rewritten without dead records.
+    """
+    storage = _open_storage(db_path)
+    _require_init(storage)
+    if not storage.load_manifest().get("root"):
+        raise click.ClickException("No manifest yet. Run: uv run pyramid_cli.py analyze .")
+
+    garbage, reclaimed = collect_garbage(storage, dry_run=dry_run)
+    repacked = 0 if dry_run else storage.repack()
+    if not garbage:
+        storage.close()
+        click.echo("Nothing to collect.")
+        if repacked:
+            click.echo(f"Repacked element data, reclaimed {_format_bytes(repacked)}.")
+        return
+    if dry_run:
+        click.echo(f"Would remove {len(garbage)} stale element(s), reclaiming {_format_bytes(reclaimed)}:")
+        for sha in garbage[:20]:
+            entry = storage.get_entry(sha) or {}
+            etype = str(entry.get("element_type", "file"))
+            path_str = str(entry.get("path", ""))
+            label = path_str if etype == "file" else f"{path_str}::{entry.get('name', '')}"
+            click.echo(f"  - {label}  [{etype}]")
+        if len(garbage) > 20:
+            click.echo(f"  … {len(garbage) - 20} more")
+        storage.close()
+        return
+    storage.close()
+    click.echo(f"Removed {len(garbage)} stale element(s), reclaimed {_format_bytes(reclaimed)}.")
+    if repacked:
+        click.echo(f"Repacked element data, reclaimed {_format_bytes(repacked)}.")
+
+
+# ── serve ─────────────────────────────────────
+
+
+@cli.command()
+@click.option("--socket", "socket_path", default=None, help="Unix socket path (default: .pyramid/serve.sock).")
+@click.option("--stdio", is_flag=True, help="Speak JSON-RPC on stdin/stdout instead of a socket.")
+@click.option("--db-path", default=None, help="Override .pyramid/ location.")
+def serve(socket_path: str | None, stdio: bool, db_path: str | None) -> None:
+    """Keep the index in memory and answer list/query/get over JSON-RPC."""
+    storage = _open_storage(db_path)
+    _require_init(storage)
+    storage.close()
+    server = PyramidServer()
+    server.storage(storage.pyramid_dir).count()  # warm the index before the first request
+    if stdio:
+        server.serve_stream(sys.stdin.buffer, sys.stdout.buffer)  # type: ignore[arg-type]
+        return
+    if not hasattr(socket, "AF_UNIX"):
+        raise click.ClickException("Unix sockets are unavailable here; use serve --stdio.")
+    path = Path(socket_path) if socket_path else _socket_path(storage.pyramid_dir.resolve())
+    click.echo(f"Serving {storage.pyramid_dir} on {path} (Ctrl-C to stop)", err=True)
+    with contextlib.suppress(KeyboardInterrupt):
+        server.serve_socket(path)
+
+
+# ── watch ─────────────────────────────────────
+
+
+@cli.command()
+@click.argument("path", default=".", type=click.Path(exists=True, file_okay=False))
+@click.option("--db-path", default=None, help="Override .pyramid/ location.")
+@click.option(
+    "--api",
+    default=None,
+    type=click.Choice(["anthropic", "openai"]),
+    help="LLM provider override.",
+)
+@click.option("--model", default=None, help="Override LLM model name.")
+@click.option("--workers", default=4, show_default=True, help="Parallel LLM workers.")
+@click.option(
+    "--queue-size",
+    default=64,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Elements waiting for a worker before new changes are held back.",
+)
+@click.option(
+    "--debounce",
+    default=0.5,
+    show_default=True,
+    type=click.FloatRange(min=0),
+    help="Seconds of quiet after a change before re-indexing.",
+)
+@click.option("--poll", is_flag=True, help="Poll the tree instead of using inotify.")
+@click.option(
+    "--interval",
+    default=1.0,
+    show_default=True,
+    type=click.FloatRange(min=0.05),
+    help="Seconds between rescans when polling.",
+)
+@click.option("--no-llm", "no_llm", is_flag=True, help="Skip LLM; write placeholder summaries.")
+def watch(
+    path: str,
+    db_path: str | None,
+    api: str | None,
+    model: str | None,
+    workers: int,
+    queue_size: int,
+    debounce: float,
+    poll: bool,
+    interval: float,
+    no_llm: bool,
+) -> None:
+    """Keep the index live: re-index files as they change (Ctrl-C to stop)."""
+    root = Path(path).resolve()
+    storage = _open_storage(db_path)
+    _require_init(storage)
+    storage.recover()
+    summarizer, _provider = _build_summarizer(storage.load_config(), api, model, no_llm, workers)
+    updater = IndexUpdater(storage, summarizer, root, workers=workers, queue_size=queue_size)
+
+    watcher: InotifyWatcher | PollingWatcher
+    dirs: list[Path] = []
+    if poll:
+        watcher = PollingWatcher(root, updater.ignore_file, interval)
+    else:
+        try:
+            CodeParser().walk_directory(root, updater.ignore_file, dirs=dirs)
+            watcher = InotifyWatcher(root, dirs, updater.filter)
+        except (OSError, AttributeError) as exc:  # not Linux, no libc symbol, or watch limit
+            click.echo(f"inotify unavailable ({exc}); polling every {interval:g}s", err=True)
+            watcher = PollingWatcher(root, updater.ignore_file, interval)
+    mode = "polling" if isinstance(watcher, PollingWatcher) else f"inotify, {len(dirs)} directories"
+    click.echo(f"Watching {root} ({mode}). Ctrl-C to stop.")
+
+    # Touched paths collect until no event has arrived for --debounce
+    # seconds, so an editor's save burst or a branch switch is one update.
+    touched: set[Path] = set()
+    last_event = 0.0
+    try:
+        while True:
+            changed = watcher.changes(0.1 if touched or updater.busy else 1.0)
+            if changed:
+                touched |= changed
+                last_event = time.monotonic()
+            if touched and time.monotonic() - last_event >= debounce:
+                batch, touched = touched, set()
+                updater.update(batch)
+            updater.drain()
+    except KeyboardInterrupt:
+        click.echo("Stopping…")
+    finally:
+        watcher.close()
+        updater.close()
+        storage.close()
+
+
+# ── migrate ───────────────────────────────────
+
+
+@cli.command()
+@click.option(
+    "--to",
+    "target",
+    required=True,
+    type=click.Choice(sorted(_BACKENDS)),
+    help="Destination storage backend.",
+)
+@click.option("--db-path", default=None, help="Override .pyramid/ location.")
+def migrate(target: str, db_path: str | None) -> None:
+    """Copy the index into another storage backend and switch to it."""
+    source = _open_storage(db_path)
+    _require_init(source)
+    if source.BACKEND == target:
+        click.echo(f"Already using the {target} backend.")
+        return
+
+    dest = open_storage(source.pyramid_dir, target)
+    config = source.load_config()
+    dest.init(api=str(config.get("api", "anthropic")))
+    copied = migrate_storage(source, dest)
+    dest.close()
+    source.close()
+
+    dest.save_config({**config, "backend": target})
+    click.echo(f"Migrated {copied} elements from {source.BACKEND} to {target}.")
+    click.echo("The previous files were left in place; delete them once satisfied.")
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    served = _run_via_server(sys.argv[1:])
+    if served is not None:
+        sys.exit(served)
     cli()
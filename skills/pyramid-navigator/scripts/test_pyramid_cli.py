@@ -7,18 +7,45 @@ Run:
 
 from __future__ import annotations
 
+import io
 import json
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
 import pytest
 from click.testing import CliRunner
 
+import pyramid_cli
 from pyramid_cli import (
     CodeParser,
     Element,
+    IndexUpdater,
+    InotifyWatcher,
+    PackStorage,
+    PathFilter,
+    PollingWatcher,
+    PyramidServer,
+    RateLimitScheduler,
+    ReadOnlyStoreError,
+    SearchIndex,
+    SummarizationError,
+    SummaryCache,
+    SQLiteStorage,
     StorageManager,
     Summarizer,
+    VectorIndex,
     cli,
+    element_parents,
+    open_storage,
+    outline_code,
+    tokenize,
 )
 
 # ─────────────────────────────────────────────
@@ -39,6 +66,152 @@ def initialized(tmp_path: Path, runner: CliRunner) -> Path:
     return tmp_path
 
 
+class _FakeAnthropicHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for POST /v1/messages that answers with fixed summaries."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive, so connection reuse is observable
+
+    def _send_json(self, obj: object) -> None:
+        payload = json.dumps(obj).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _batch(self, batch_id: str) -> dict[str, object]:
+        polls = self.server.batches[batch_id]["polls"]  # type: ignore[attr-defined]
+        base = f"http://127.0.0.1:{self.server.server_port}"
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "in_progress" if polls else "ended",
+            "results_url": None if polls else f"{base}/v1/messages/batches/{batch_id}/results",
+        }
+
+    def do_GET(self) -> None:  # noqa: N802
+        """Message Batches: status polls and JSONL results."""
+        parts = self.path.split("?")[0].strip("/").split("/")  # v1 messages batches <id> [results]
+        batch = self.server.batches[parts[3]]  # type: ignore[attr-defined]
+        if len(parts) == 4:
+            status = self._batch(parts[3])
+            batch["polls"] = max(0, batch["polls"] - 1)
+            self._send_json(status)
+            return
+        rows = []
+        for request in batch["requests"]:
+            prompt = request["params"]["messages"][0]["content"]
+            if self.server.batch_fail_marker and self.server.batch_fail_marker in prompt:  # type: ignore[attr-defined]
+                result = {"type": "errored", "error": {"type": "error", "error": {"type": "api_error"}}}
+            else:
+                text = json.dumps({
+                    "4": "batched four word summary",
+                    "8": "batched eight word summary of the code",
+                    "16": "batched sixteen word summary of the code in this module",
+                })
+                if self.server.batch_garbage_marker and self.server.batch_garbage_marker in prompt:  # type: ignore[attr-defined]
+                    text = "Sorry, I can't summarize that."
+                result = {
+                    "type": "succeeded",
+                    "message": {
+                        "id": "msg_fake", "type": "message", "role": "assistant", "model": "fake",
+                        "content": [{"type": "text", "text": text}],
+                        "stop_reason": "end_turn", "usage": {"input_tokens": 10, "output_tokens": 10},
+                    },
+                }
+            rows.append(json.dumps({"custom_id": request["custom_id"], "result": result}))
+        payload = "\n".join(rows).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/binary")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self) -> None:  # noqa: N802
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path.startswith("/v1/messages/batches"):
+            batch_id = f"msgbatch_{len(self.server.batches) + 1}"  # type: ignore[attr-defined]
+            self.server.batches[batch_id] = {  # type: ignore[attr-defined]
+                "requests": json.loads(body)["requests"],
+                "polls": self.server.batch_polls,  # type: ignore[attr-defined]
+            }
+            self._send_json(self._batch(batch_id))
+            return
+        prompt = json.loads(body)["messages"][0]["content"]
+        self.server.requests.append(prompt)  # type: ignore[attr-defined]
+        self.server.clients.add(self.client_address)  # type: ignore[attr-defined]
+        with self.server.lock:  # type: ignore[attr-defined]
+            statuses = self.server.error_statuses  # type: ignore[attr-defined]
+            status = statuses.pop(0) if statuses else self.server.always_status  # type: ignore[attr-defined]
+        if status:
+            error = json.dumps({"type": "error", "error": {"type": "rate_limit_error", "message": "slow down"}}).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(error)))
+            self.send_header("retry-after", "0")
+            self.end_headers()
+            self.wfile.write(error)
+            return
+        levels = {
+            "4": "fake four word summary",
+            "8": "fake eight word summary of the code",
+            "16": "fake sixteen word summary of the code in this module",
+        }
+        keys = re.findall(r"^### (e\d+)$", prompt, re.MULTILINE)
+        extend = re.search(r"to exactly (\d+) words.*summary:\n  (.*?)\n\nReturn", prompt, re.DOTALL)
+        if extend:  # _EXTEND_PROMPT: append to the seed
+            text = json.dumps({extend.group(1): f"{extend.group(2)} extended to {extend.group(1)}"})
+        elif keys:  # packed request: answer per element id, minus any dropped ones
+            dropped = self.server.drop_keys  # type: ignore[attr-defined]
+            text = json.dumps({key: levels for key in keys if key not in dropped})
+        elif self.server.garbage_marker and self.server.garbage_marker in prompt:  # type: ignore[attr-defined]
+            text = "Sorry, I can't summarize that."
+        else:
+            text = json.dumps(levels)
+        payload = json.dumps({
+            "id": "msg_fake",
+            "type": "message",
+            "role": "assistant",
+            "model": "fake",
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "usage": {"input_tokens": 10, "output_tokens": 10},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *_args: object) -> None:
+        pass
+
+
+@pytest.fixture()
+def fake_anthropic(monkeypatch: pytest.MonkeyPatch) -> Iterator[ThreadingHTTPServer]:
+    """Run a local fake Anthropic API and point the SDK at it."""
+    pytest.importorskip("anthropic")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeAnthropicHandler)
+    server.requests = []  # type: ignore[attr-defined]
+    server.clients = set()  # type: ignore[attr-defined]
+    server.lock = threading.Lock()  # type: ignore[attr-defined]
+    server.error_statuses = []  # type: ignore[attr-defined]  # statuses for the next requests
+    server.always_status = 0  # type: ignore[attr-defined]  # non-zero: fail every request
+    server.drop_keys = set()  # type: ignore[attr-defined]  # element ids omitted from packed answers
+    server.garbage_marker = ""  # type: ignore[attr-defined]  # prompts containing it get prose back
+    server.batches = {}  # type: ignore[attr-defined]  # batch id -> {requests, polls left}
+    server.batch_polls = 0  # type: ignore[attr-defined]  # "in_progress" answers before a batch ends
+    server.batch_fail_marker = ""  # type: ignore[attr-defined]  # prompts containing it error out
+    server.batch_garbage_marker = ""  # type: ignore[attr-defined]  # prompts containing it get prose back
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test-key")
+    monkeypatch.setenv("ANTHROPIC_BASE_URL", f"http://127.0.0.1:{server.server_port}")
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 @pytest.fixture()
 def analyzed(initialized: Path, runner: CliRunner) -> Path:
     """Return tmp_path with a Python source file indexed (--no-llm)."""
@@ -151,6 +324,528 @@ def test_analyze_up_to_date_on_rerun(analyzed: Path, runner: CliRunner) -> None:
     assert "up to date" in result.output.lower()
 
 
+def test_analyze_skips_unchanged_files_without_reading(
+    analyzed: Path, runner: CliRunner, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    manifest = json.loads((analyzed / ".pyramid" / "manifest.json").read_text())
+    entry = manifest["files"]["auth.py"]
+    assert {"size", "mtime_ns", "inode", "sha", "elements"} <= set(entry)
+
+    def _fail(*_args: object) -> list[Element]:
+        raise AssertionError("unchanged file was parsed")
+
+    monkeypatch.setattr(CodeParser, "parse_file", _fail)
+    result = runner.invoke(
+        cli, ["analyze", str(analyzed), "--db-path", str(analyzed / ".pyramid"), "--no-llm"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Unchanged files skipped: 1" in result.output
+
+
+def test_analyze_reparses_modified_file(analyzed: Path, runner: CliRunner) -> None:
+    (analyzed / "auth.py").write_text("def logout() -> None:\n    pass\n")
+    result = runner.invoke(
+        cli, ["analyze", str(analyzed), "--db-path", str(analyzed / ".pyramid"), "--no-llm"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Indexed 2 elements" in result.output
+
+
+def test_analyze_reports_deleted_files(analyzed: Path, runner: CliRunner) -> None:
+    (analyzed / "auth.py").unlink()
+    result = runner.invoke(
+        cli, ["analyze", str(analyzed), "--db-path", str(analyzed / ".pyramid"), "--no-llm"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Deleted since last run: 1 file(s)" in result.output
+    assert "- auth.py" in result.output
+    manifest = json.loads((analyzed / ".pyramid" / "manifest.json").read_text())
+    assert "auth.py" not in manifest["files"]
+
+
+def _git(repo: Path, *args: str) -> None:
+    subprocess.run(
+        ["git", "-C", str(repo), "-c", "user.name=t", "-c", "user.email=t@example.com", *args],
+        check=True, capture_output=True,
+    )
+
+
+@pytest.fixture
+def git_analyzed(analyzed: Path) -> Path:
+    """*analyzed*, committed to a fresh git repo and re-analyzed from git."""
+    if shutil.which("git") is None:
+        pytest.skip("git not installed")
+    _git(analyzed, "init", "-q")
+    _git(analyzed, "add", "auth.py")
+    _git(analyzed, "commit", "-q", "-m", "init")
+    result = CliRunner().invoke(
+        cli, ["analyze", str(analyzed), "--db-path", str(analyzed / ".pyramid"), "--no-llm"]
+    )
+    assert "(from git)" in result.output, result.output
+    return analyzed
+
+
+def test_analyze_git_records_commit_and_blobs(git_analyzed: Path) -> None:
+    pyramid = git_analyzed / ".pyramid"
+    config = json.loads((pyramid / "config.json").read_text())
+    assert re.fullmatch(r"[0-9a-f]{40}", config["last_commit"])
+    manifest = json.loads((pyramid / "manifest.json").read_text())
+    assert re.fullmatch(r"[0-9a-f]{40}", manifest["files"]["auth.py"]["blob"])
+
+
+def test_analyze_git_skips_touched_but_identical_file(
+    git_analyzed: Path, runner: CliRunner, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    (git_analyzed / "auth.py").touch()
+    monkeypatch.setattr(CodeParser, "walk_directory", lambda *_a: pytest.fail("walked the tree"))
+    result = runner.invoke(
+        cli, ["analyze", str(git_analyzed), "--db-path", str(git_analyzed / ".pyramid"), "--no-llm"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Unchanged files skipped: 1" in result.output
+
+
+def test_analyze_git_rename_keeps_summaries(
+    git_analyzed: Path, runner: CliRunner, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    db = str(git_analyzed / ".pyramid")
+    (git_analyzed / "svc").mkdir()
+    _git(git_analyzed, "mv", "auth.py", "svc/login.py")
+    _git(git_analyzed, "commit", "-q", "-m", "move")
+    monkeypatch.setattr(CodeParser, "parse_file", lambda *_a: pytest.fail("renamed file was parsed"))
+    result = runner.invoke(cli, ["analyze", str(git_analyzed), "--db-path", db, "--no-llm"])
+    assert result.exit_code == 0, result.output
+    assert "Renamed since last run: 1 file(s)" in result.output
+    assert "auth.py → svc/login.py" in result.output
+    assert "Deleted since last run" not in result.output
+    assert "Pruned" not in result.output
+
+    result = runner.invoke(cli, ["get", "svc/login.py", "--db-path", db])
+    assert result.exit_code == 0, result.output
+    assert "hash_password" in result.output
+    assert "login.py" in result.output
+    result = runner.invoke(cli, ["query", "AuthService", "--db-path", db])
+    assert "svc/login.py" in result.output
+
+
+def test_analyze_git_modified_file_reparsed(git_analyzed: Path, runner: CliRunner) -> None:
+    with (git_analyzed / "auth.py").open("a") as fh:
+        fh.write("\ndef logout() -> None:\n    pass\n")
+    result = runner.invoke(
+        cli, ["analyze", str(git_analyzed), "--db-path", str(git_analyzed / ".pyramid"), "--no-llm"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Unchanged files skipped" not in result.output
+    assert "Indexed" in result.output
+    result = runner.invoke(cli, ["get", "auth.py", "--db-path", str(git_analyzed / ".pyramid")])
+    assert "logout" in result.output
+
+
+def test_analyze_parse_worker_pool(initialized: Path, runner: CliRunner) -> None:
+    for i in range(40):
+        (initialized / f"mod{i}.py").write_text(f"def func_{i}():\n    return {i}\n")
+    result = runner.invoke(
+        cli,
+        [
+            "analyze",
+            str(initialized),
+            "--db-path",
+            str(initialized / ".pyramid"),
+            "--no-llm",
+            "--parse-workers",
+            "2",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Indexed 80 elements" in result.output
+
+
+def test_analyze_async_engine_against_local_server(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    for i in range(30):
+        (initialized / f"mod{i}.py").write_text(f"def func_{i}():\n    return {i}\n")
+    result = runner.invoke(
+        cli,
+        [
+            "analyze",
+            str(initialized),
+            "--db-path",
+            str(initialized / ".pyramid"),
+            "--concurrency",
+            "8",
+            "--parse-workers",
+            "1",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Indexed 60 elements" in result.output
+    assert len(fake_anthropic.requests) == 60  # type: ignore[attr-defined]
+    # One shared client: connections are pooled, not opened per element.
+    assert len(fake_anthropic.clients) <= 8  # type: ignore[attr-defined]
+    index = json.loads((initialized / ".pyramid" / "index.json").read_text())
+    assert {e["levels"]["4"] for e in index.values()} == {"fake four word summary"}
+
+
+def test_analyze_retries_throttled_requests(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    (initialized / "a.py").write_text("def a():\n    pass\n")
+    fake_anthropic.error_statuses = [429, 529]  # type: ignore[attr-defined]
+    result = runner.invoke(
+        cli,
+        ["analyze", str(initialized), "--db-path", str(initialized / ".pyramid"), "--workers", "1"],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Indexed 2 elements" in result.output
+    assert "Retries: 2 (2 throttled)" in result.output
+
+
+def test_analyze_writes_run_report(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    db = initialized / ".pyramid"
+    (initialized / "a.py").write_text("def a():\n    pass\n")
+    fake_anthropic.error_statuses = [429]  # type: ignore[attr-defined]
+    args = ["analyze", str(initialized), "--db-path", str(db), "--workers", "1", "--parse-workers", "1"]
+    result = runner.invoke(cli, [*args, "--profile"])
+    assert result.exit_code == 0, result.output
+    assert "Tokens: 20 in / 20 out" in result.output  # the fake reports 10/10 per request
+
+    (report_path,) = (db / "runs").glob("*.json")
+    assert report_path.with_suffix(".prof").exists()
+    report = json.loads(report_path.read_text())
+    assert report["command"] == "analyze"
+    assert {"walk", "fingerprint", "parse", "hash", "store", "pipeline"} <= set(report["phases"])
+    assert report["counters"]["elements_summarized"] == 2
+    assert report["counters"]["retries"] == 1
+    anthropic = report["providers"]["anthropic"]
+    assert (anthropic["requests"], anthropic["errors"]) == (3, 1)
+    assert sum(anthropic["latency"]["histogram"].values()) == 3
+    assert anthropic["input_tokens"] == 20 and not anthropic["tokens_estimated"]
+    assert report["cost_usd"] == pytest.approx((20 * 1.0 + 20 * 5.0) / 1e6)  # claude-haiku-4-5 pricing
+
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    (latest,) = set((db / "runs").glob("*.json")) - {report_path}
+    noop = json.loads(latest.read_text())
+    assert noop["rates"]["files_unchanged"] == 1.0
+    assert noop["providers"] == {} and noop["cost_usd"] is None
+
+
+def test_analyze_dry_run_projects_without_calling_or_writing(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    db = initialized / ".pyramid"
+    for i in range(3):
+        (initialized / f"mod{i}.py").write_text(f"def func_{i}():\n    return {i}\n")
+    before = sorted((p.relative_to(db), p.stat().st_mtime_ns) for p in db.rglob("*"))
+    args = ["analyze", str(initialized), "--db-path", str(db), "--workers", "2", "--parse-workers", "1"]
+    result = runner.invoke(cli, [*args, "--dry-run", "--rpm", "30"])
+    assert result.exit_code == 0, result.output
+    assert fake_anthropic.requests == []  # type: ignore[attr-defined]
+    assert sorted((p.relative_to(db), p.stat().st_mtime_ns) for p in db.rglob("*")) == before
+    assert "Elements to summarize: 6 (0 already indexed)" in result.output
+    assert "Requests: 6" in result.output
+    assert "limited by 30 rpm" in result.output
+    projected = int(re.search(r"Tokens: ~([\d,]+) prompt", result.output).group(1).replace(",", ""))  # type: ignore[union-attr]
+
+    # The projection is rendered from the same prompts the real run sends.
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    prompts = fake_anthropic.requests  # type: ignore[attr-defined]
+    assert len(prompts) == 6
+    assert projected == sum(pyramid_cli._estimate_tokens(p) for p in prompts)
+
+    (initialized / "mod0.py").write_text("def func_0():\n    return 'changed'\n")
+    result = runner.invoke(cli, [*args, "--dry-run", "--batch-api"])
+    assert result.exit_code == 0, result.output
+    assert "Elements to summarize: 2 (0 already indexed)" in result.output
+    assert "(batch API pricing)" in result.output
+
+
+def test_analyze_duplicate_code_summarized_once_and_cached_per_model(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    db = initialized / ".pyramid"
+    for pkg in ("pa", "pb"):
+        (initialized / pkg).mkdir()
+        (initialized / pkg / "__init__.py").write_text("")
+    (initialized / "a.py").write_text("def shared():\n    return 1\n")
+    (initialized / "b.py").write_text("import os\n\n\ndef shared():\n    return 1\n")
+    args = ["analyze", str(initialized), "--db-path", str(db), "--workers", "1", "--parse-workers", "1"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    # Two empty __init__.py files and two copies of shared(): 6 elements, 4 requests.
+    assert "Indexed 6 elements" in result.output
+    assert len(fake_anthropic.requests) == 4  # type: ignore[attr-defined]
+    index = json.loads((db / "index.json").read_text())
+    assert sorted(e["path"] for e in index.values() if e["name"] in ("shared", "__init__.py")) == [
+        "a.py", "b.py", str(Path("pa", "__init__.py")), str(Path("pb", "__init__.py")),
+    ]
+    for target in ("pa/__init__.py", "pb/__init__.py", "b.py"):
+        result = runner.invoke(cli, ["get", target, "--db-path", str(db)])
+        assert result.exit_code == 0 and "fake" in result.output, result.output
+
+    # A new model misses the cache without --force; switching back hits it.
+    result = runner.invoke(cli, [*args, "--model", "claude-sonnet-4-5"])
+    assert result.exit_code == 0, result.output
+    assert "re-checking every file" in result.output
+    assert len(fake_anthropic.requests) == 8  # type: ignore[attr-defined]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert "Reused cached summaries for 6 element(s)" in result.output
+    assert len(fake_anthropic.requests) == 8  # type: ignore[attr-defined]
+    result = runner.invoke(cli, args)
+    assert "All files up to date." in result.output
+
+
+def test_analyze_no_llm_keeps_real_summaries(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    db = initialized / ".pyramid"
+    (initialized / "a.py").write_text("def a():\n    return 1\n")
+    args = ["analyze", str(initialized), "--db-path", str(db), "--workers", "1"]
+    assert runner.invoke(cli, args).exit_code == 0
+    version = json.loads((db / "manifest.json").read_text())["summaries"]
+
+    (initialized / "b.py").write_text("def b():\n    return 2\n")
+    result = runner.invoke(cli, [*args, "--no-llm"])
+    assert result.exit_code == 0, result.output
+    assert "re-checking every file" not in result.output
+    assert "fake" in runner.invoke(cli, ["get", "a.py", "--db-path", str(db)]).output
+    assert json.loads((db / "manifest.json").read_text())["summaries"] == version
+    requests = len(fake_anthropic.requests)  # type: ignore[attr-defined]
+    assert "All files up to date." in runner.invoke(cli, args).output
+    assert len(fake_anthropic.requests) == requests  # type: ignore[attr-defined]
+
+
+def test_analyze_queues_failures_instead_of_placeholders(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    db = initialized / ".pyramid"
+    (initialized / "a.py").write_text("def a():\n    pass\n")
+    fake_anthropic.always_status = 503  # type: ignore[attr-defined]
+    result = runner.invoke(
+        cli, ["analyze", str(initialized), "--db-path", str(db), "--max-attempts", "2"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "2 element(s) failed" in result.output
+    assert json.loads((db / "index.json").read_text()) == {}
+    queued = json.loads((db / "retry.json").read_text())
+    assert {entry["attempts"] for entry in queued.values()} == {1}
+    assert "a.py" not in json.loads((db / "manifest.json").read_text())["files"]
+
+    fake_anthropic.always_status = 0  # type: ignore[attr-defined]
+    result = runner.invoke(cli, ["analyze", str(initialized), "--db-path", str(db)])
+    assert "Indexed 2 elements" in result.output
+    assert not (db / "retry.json").exists()
+
+
+def test_analyze_queues_malformed_responses(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    db = initialized / ".pyramid"
+    (initialized / "a.py").write_text("def garbled():\n    pass\n")
+    fake_anthropic.garbage_marker = "garbled"  # type: ignore[attr-defined]
+    result = runner.invoke(cli, ["analyze", str(initialized), "--db-path", str(db)])
+    assert result.exit_code == 0, result.output
+    assert "2 element(s) failed" in result.output
+    assert json.loads((db / "index.json").read_text()) == {}
+    assert all("malformed" in e["error"] for e in json.loads((db / "retry.json").read_text()).values())
+    assert SummaryCache(db).count() == 0
+
+
+def test_analyze_packs_small_elements(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    for i in range(10):
+        (initialized / f"mod{i}.py").write_text(f"def func_{i}():\n    return {i}\n")
+    result = runner.invoke(
+        cli,
+        ["analyze", str(initialized), "--db-path", str(initialized / ".pyramid"),
+         "--batch-tokens", "4000", "--parse-workers", "1"],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Indexed 20 elements" in result.output
+    assert "Packed 20 small elements into 1 request(s)" in result.output
+    assert len(fake_anthropic.requests) == 1  # type: ignore[attr-defined]
+    index = json.loads((initialized / ".pyramid" / "index.json").read_text())
+    assert {e["levels"]["4"] for e in index.values()} == {"fake four word summary"}
+
+
+def test_expand_generates_deep_levels_along_the_seed_chain(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    db = str(initialized / ".pyramid")
+    for i in range(6):
+        (initialized / f"mod{i}.py").write_text(f"def func_{i}():\n    return {i}\n")
+    result = runner.invoke(cli, ["analyze", str(initialized), "--db-path", db, "--parse-workers", "1"])
+    assert result.exit_code == 0, result.output
+    fake_anthropic.requests.clear()  # type: ignore[attr-defined]
+
+    result = runner.invoke(cli, ["expand", "mod", "--type", "function", "--db-path", db, "--workers", "4"])
+    assert result.exit_code == 0, result.output
+    assert "Expanded 6 element(s) to level 64" in result.output
+    assert len(fake_anthropic.requests) == 12  # type: ignore[attr-defined]  # 32 then 64, per element
+    storage = StorageManager(Path(db))
+    for sha, _entry in storage.find_by_path("mod0.py"):
+        levels = storage.load_data(sha)["levels"]  # type: ignore[index]
+        if "64" in levels:
+            assert levels["32"].startswith(levels["16"])
+            assert levels["64"] == f"{levels['32']} extended to 64"
+
+    fake_anthropic.requests.clear()  # type: ignore[attr-defined]
+    result = runner.invoke(cli, ["expand", "--type", "function", "--db-path", db])
+    assert "already have level 64" in result.output
+    result = runner.invoke(cli, ["get", "mod3.py", "--level", "32", "--db-path", db])
+    assert result.exit_code == 0, result.output
+    assert len(fake_anthropic.requests) == 1  # type: ignore[attr-defined]  # only the file element
+    assert result.output.count("extended to 32") == 2
+
+
+def test_extend_levels_never_fills_in_a_placeholder(monkeypatch: pytest.MonkeyPatch) -> None:
+    summarizer = Summarizer(no_llm=True)
+    monkeypatch.setattr(summarizer, "summarize", lambda *_args, **_kwargs: {})
+    data = {"path": "a.py", "element_type": "function", "name": "foo", "code": "pass",
+            "levels": {"4": "a", "8": "a b", "16": "a b c"}}
+    with pytest.raises(SummarizationError):
+        pyramid_cli._extend_levels(summarizer, data, 32)
+
+
+def test_summarize_batch_falls_back_per_element(fake_anthropic: ThreadingHTTPServer) -> None:
+    fake_anthropic.drop_keys = {"e2"}  # type: ignore[attr-defined]
+    summarizer = Summarizer(api="anthropic", model=None, no_llm=False)
+    elements = [
+        Element(path="a.py", element_type="function", name=name, start_line=1, end_line=2, code="pass")
+        for name in ("a", "b", "c")
+    ]
+    results = summarizer.summarize_batch(elements, (4, 8, 16))
+    assert all(r["4"] == "fake four word summary" for r in results)  # type: ignore[index]
+    # One packed request, then a single retry for the element missing from it.
+    requests = fake_anthropic.requests  # type: ignore[attr-defined]
+    assert len(requests) == 2
+    assert "Element name: b" in requests[1] and "### e1" not in requests[1]
+
+
+def test_analyze_batch_api_submits_polls_and_ingests(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    db = initialized / ".pyramid"
+    (initialized / "a.py").write_text("def a():\n    pass\n")
+    (initialized / "b.py").write_text("def broken():\n    pass\n")
+    (initialized / "c.py").write_text("def garbled():\n    pass\n")
+    fake_anthropic.batch_polls = 2  # type: ignore[attr-defined]
+    fake_anthropic.batch_fail_marker = "broken"  # type: ignore[attr-defined]
+    fake_anthropic.batch_garbage_marker = "garbled"  # type: ignore[attr-defined]
+    result = runner.invoke(
+        cli, ["analyze", str(initialized), "--db-path", str(db), "--batch-api", "--poll-interval", "0"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "Submitted 6 request(s) in 1 anthropic batch job(s)" in result.output
+    assert "Indexed 2 elements from batch results" in result.output
+    assert fake_anthropic.requests == []  # type: ignore[attr-defined]  # no interactive calls
+    index = json.loads((db / "index.json").read_text())
+    assert {e["levels"]["4"] for e in index.values()} == {"batched four word summary"}
+    retry = json.loads((db / "retry.json").read_text())
+    assert len(retry) == 4  # errored and malformed alike, none stored as a summary
+    assert any("malformed" in entry["error"] for entry in retry.values())
+    assert SummaryCache(db).count() == 2
+    assert list(json.loads((db / "manifest.json").read_text())["files"]) == ["a.py"]
+    assert not (db / "batch.json").exists()
+
+
+def test_analyze_batch_api_resumes_after_exit(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    db = initialized / ".pyramid"
+    (initialized / "a.py").write_text("def a():\n    pass\n")
+    fake_anthropic.batch_polls = 5  # type: ignore[attr-defined]
+    args = ["analyze", str(initialized), "--db-path", str(db), "--batch-api", "--no-wait"]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert "1 batch job(s) still processing" in result.output
+    assert json.loads((db / "batch.json").read_text())["batches"][0]["id"] == "msgbatch_1"
+    assert json.loads((db / "index.json").read_text()) == {}
+
+    # Leaving a job in flight still releases the store.
+    storage = open_storage(db)
+    closed: list[bool] = []
+    monkeypatch.setattr(storage, "close", lambda: closed.append(True))
+    job = storage.load_batch_job()
+    pyramid_cli._finish_batch_job(storage, Summarizer(), job, 0.0, wait=False)  # type: ignore[arg-type]
+    assert closed == [True]
+
+    fake_anthropic.batches["msgbatch_1"]["polls"] = 0  # type: ignore[attr-defined]
+    result = runner.invoke(cli, args)
+    assert result.exit_code == 0, result.output
+    assert "Resuming batch job(s): msgbatch_1" in result.output
+    assert "Indexed 2 elements" in result.output
+    assert len(fake_anthropic.batches) == 1  # type: ignore[attr-defined]  # nothing re-submitted
+    assert "a.py" in json.loads((db / "manifest.json").read_text())["files"]
+    assert not (db / "batch.json").exists()
+
+
+def test_analyze_hierarchical_summarizes_bottom_up(
+    initialized: Path, runner: CliRunner, fake_anthropic: ThreadingHTTPServer
+) -> None:
+    (initialized / "svc.py").write_text(
+        "import os\n"
+        "\n"
+        "def load_secret(name):\n"
+        "    return os.environ['SECRET_' + name]\n"
+        "\n"
+        "def unrelated():\n"
+        "    return 1\n"
+    )
+    result = runner.invoke(
+        cli,
+        ["analyze", str(initialized), "--db-path", str(initialized / ".pyramid"),
+         "--hierarchical", "--workers", "1"],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Indexed 3 elements" in result.output
+    requests = fake_anthropic.requests  # type: ignore[attr-defined]
+    assert len(requests) == 3
+    # Functions first, then the file from its outline: bodies replaced by summaries.
+    file_prompt = requests[-1]
+    assert "Element type: file" in file_prompt
+    assert "def load_secret(name):\n    … fake sixteen word summary" in file_prompt
+    assert "SECRET_" not in file_prompt
+    assert "import os" in file_prompt
+
+
+def test_element_parents_and_outline() -> None:
+    code = "class A:\n    def f(self):\n        return 1\n\n    def g(self):\n        pass\nx = 1\n"
+    elements = [
+        Element(path="m.py", element_type="file", name="m.py", code=code, start_line=1, end_line=7),
+        Element(path="m.py", element_type="class", name="A", code="", start_line=1, end_line=6),
+        Element(path="m.py", element_type="function", name="f", code="", start_line=2, end_line=3),
+        Element(path="m.py", element_type="function", name="g", code="", start_line=5, end_line=6),
+    ]
+    assert element_parents(elements) == [None, 0, 1, 1]
+    outline = outline_code(elements[0], [(elements[1], "a class"), (elements[2], None)])
+    assert outline == "class A:\n    … a class\nx = 1"
+    cls = Element(path="m.py", element_type="class", name="A",
+                  code="\n".join(code.splitlines()[:6]), start_line=1, end_line=6)
+    outline = outline_code(cls, [(elements[2], "returns one"), (elements[3], None)])
+    assert outline.splitlines() == [
+        "class A:", "    def f(self):", "        … returns one", "", "    def g(self):", "        pass",
+    ]
+
+
+def test_analyze_async_engine_no_llm(initialized: Path, runner: CliRunner) -> None:
+    (initialized / "a.py").write_text("def a():\n    pass\n")
+    result = runner.invoke(
+        cli,
+        ["analyze", str(initialized), "--db-path", str(initialized / ".pyramid"),
+         "--no-llm", "--concurrency", "4"],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Indexed 2 elements" in result.output
+
+
 def test_analyze_force_reruns(analyzed: Path, runner: CliRunner) -> None:
     result = runner.invoke(
         cli,
@@ -174,6 +869,258 @@ def test_analyze_force_reruns(analyzed: Path, runner: CliRunner) -> None:
 # ─────────────────────────────────────────────
 
 
+def test_gc_dry_run_then_sweep(analyzed: Path, runner: CliRunner) -> None:
+    db = analyzed / ".pyramid"
+    (analyzed / "auth.py").write_text("def hash_password(pw: str) -> str:\n    return pw[::-1]\n")
+    result = runner.invoke(
+        cli, ["analyze", str(analyzed), "--db-path", str(db), "--no-llm", "--no-gc"]
+    )
+    assert result.exit_code == 0, result.output
+    before = len(json.loads((db / "index.json").read_text()))
+
+    result = runner.invoke(cli, ["gc", "--dry-run", "--db-path", str(db)])
+    assert result.exit_code == 0, result.output
+    assert "Would remove 3 stale element(s)" in result.output
+    assert "auth.py::AuthService  [class]" in result.output
+    assert len(json.loads((db / "index.json").read_text())) == before
+
+    result = runner.invoke(cli, ["gc", "--db-path", str(db)])
+    assert "Removed 3 stale element(s)" in result.output
+    index = json.loads((db / "index.json").read_text())
+    assert len(index) == before - 3
+    assert len(list((db / "data").glob("*.json"))) == len(index)
+    result = runner.invoke(cli, ["query", "AuthService", "--db-path", str(db)])
+    assert "No results" in result.output
+
+
+def test_analyze_prunes_deleted_files(analyzed: Path, runner: CliRunner) -> None:
+    db = analyzed / ".pyramid"
+    (analyzed / "auth.py").unlink()
+    (analyzed / "other.py").write_text("def other():\n    pass\n")
+    result = runner.invoke(cli, ["analyze", str(analyzed), "--db-path", str(db), "--no-llm"])
+    assert result.exit_code == 0, result.output
+    assert "Pruned 3 stale element(s)" in result.output
+    paths = {e["path"] for e in json.loads((db / "index.json").read_text()).values()}
+    assert paths == {"other.py"}
+
+
+def test_analyze_other_root_keeps_elements(tmp_path: Path, runner: CliRunner) -> None:
+    db = str(tmp_path / ".pyramid")
+    runner.invoke(cli, ["init", "--db-path", db])
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "top.py").write_text("def top():\n    pass\n")
+    (tmp_path / "sub" / "s.py").write_text("def s():\n    pass\n")
+    runner.invoke(cli, ["analyze", str(tmp_path), "--db-path", db, "--no-llm"])
+    result = runner.invoke(cli, ["analyze", str(tmp_path / "sub"), "--db-path", db, "--no-llm"])
+    assert result.exit_code == 0, result.output
+    assert "Pruned" not in result.output
+    paths = {e["path"] for e in json.loads((tmp_path / ".pyramid" / "index.json").read_text()).values()}
+    assert {"top.py", "sub/s.py", "s.py"} <= paths
+
+
+def test_serve_stdio_json_rpc(analyzed: Path) -> None:
+    db = str(analyzed / ".pyramid")
+    requests = [
+        {"jsonrpc": "2.0", "id": 1, "method": "ping"},
+        {"jsonrpc": "2.0", "id": 2, "method": "run", "params": {"argv": ["query", "AuthService", "--db-path", db]}},
+        {"jsonrpc": "2.0", "id": 3, "method": "run", "params": {"argv": ["analyze", "."]}},
+        {"jsonrpc": "2.0", "id": 4, "method": "nope"},
+        {"jsonrpc": "2.0", "id": 5, "method": "shutdown"},
+        {"jsonrpc": "2.0", "id": 6, "method": "ping"},
+    ]
+    infile = io.BytesIO(b"".join(json.dumps(r).encode() + b"\n" for r in requests) + b"not json\n")
+    out = io.BytesIO()
+    PyramidServer().serve_stream(infile, out)
+    responses = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [r["id"] for r in responses] == [1, 2, 3, 4, 5]  # stops after shutdown
+    assert responses[0]["result"] == "pong"
+    assert responses[1]["result"]["exit_code"] == 0
+    assert "AuthService" in responses[1]["result"]["stdout"]
+    assert responses[2]["result"]["exit_code"] == 2  # only read-only commands are served
+    assert responses[3]["error"]["code"] == -32601
+
+
+def test_serve_socket_thin_client_sees_new_analysis(
+    analyzed: Path, runner: CliRunner, capsys: pytest.CaptureFixture[str]
+) -> None:
+    db = analyzed / ".pyramid"
+    sock = db / "serve.sock"
+    server = PyramidServer()
+    server.storage(db).count()
+    thread = threading.Thread(target=server.serve_socket, args=(sock,), daemon=True)
+    thread.start()
+    for _ in range(100):
+        if sock.exists():
+            break
+        time.sleep(0.02)
+
+    assert pyramid_cli._run_via_server(["query", "AuthService", "--db-path", str(db)]) == 0
+    assert "AuthService" in capsys.readouterr().out
+
+    (analyzed / "billing.py").write_text("def charge_card(amount):\n    return amount\n")
+    result = runner.invoke(cli, ["analyze", str(analyzed), "--db-path", str(db), "--no-llm"])
+    assert result.exit_code == 0, result.output
+    assert pyramid_cli._run_via_server(["get", "billing.py", "--db-path", str(db)]) == 0
+    assert "billing.py" in capsys.readouterr().out
+    assert pyramid_cli._run_via_server(["get", "missing.py", "--db-path", str(db)]) == 1
+
+    pyramid_cli._rpc_call(sock, "shutdown")
+    thread.join(timeout=5)
+    assert not thread.is_alive() and not sock.exists()
+    assert pyramid_cli._run_via_server(["query", "AuthService", "--db-path", str(db)]) is None
+
+
+def test_served_get_never_writes_under_a_running_writer(analyzed: Path) -> None:
+    db = analyzed / ".pyramid"
+    server = PyramidServer()
+    served = server.storage(db)
+    served.count()
+    writer = StorageManager(db)
+    writer.put_element("k2", _record("b"))
+
+    argv = ["get", "auth.py", "--level", "32", "--db-path", str(db)]
+    response = server.handle({"jsonrpc": "2.0", "id": 1, "method": "run", "params": {"argv": argv}})
+    assert response["result"]["local"] is True  # type: ignore[index]
+    with pytest.raises(ReadOnlyStoreError):
+        served.commit()
+    with pytest.raises(ReadOnlyStoreError):
+        served.put_element("k1", _record("a"))
+
+    writer.put_element("k3", _record("c"))
+    writer.close()  # interrupted: nothing committed
+    assert (db / "journal.jsonl").exists()
+    fresh = StorageManager(db)
+    assert fresh.get_entry("k2") is not None and fresh.get_entry("k3") is not None
+
+
+def _settle(updater: IndexUpdater) -> None:
+    for _ in range(200):
+        updater.drain()
+        if not updater.busy:
+            return
+        time.sleep(0.02)
+    raise AssertionError("updater never went idle")
+
+
+def test_watch_updater_reindexes_touched_files(analyzed: Path, runner: CliRunner) -> None:
+    db = analyzed / ".pyramid"
+    storage = StorageManager(db)
+    updater = IndexUpdater(storage, Summarizer(no_llm=True), analyzed, workers=2, queue_size=1)
+    with (analyzed / "auth.py").open("a") as fh:
+        fh.write("\ndef logout(user: str) -> None:\n    pass\n")
+    (analyzed / "pkg").mkdir()
+    (analyzed / "pkg" / "billing.py").write_text("def charge_card(amount):\n    return amount\n")
+    updater.update({analyzed / "auth.py", analyzed / "pkg"})
+    _settle(updater)
+    manifest = json.loads((db / "manifest.json").read_text())
+    assert set(manifest["files"]) == {"auth.py", "pkg/billing.py"}
+    assert "logout" in runner.invoke(cli, ["get", "auth.py", "--db-path", str(db)]).output
+    assert "pkg/billing.py" in runner.invoke(cli, ["query", "charge", "--db-path", str(db)]).output
+
+    (analyzed / "auth.py").unlink()
+    updater.update({analyzed / "auth.py"})
+    updater.close()
+    manifest = json.loads((db / "manifest.json").read_text())
+    assert set(manifest["files"]) == {"pkg/billing.py"}
+    assert runner.invoke(cli, ["get", "auth.py", "--db-path", str(db)]).exit_code != 0
+
+
+def test_watch_updater_drops_only_keys_of_touched_files(analyzed: Path) -> None:
+    db = analyzed / ".pyramid"
+    storage = StorageManager(db)
+    storage.put_element("foreign", _record("elsewhere"))  # a full gc would sweep this
+    storage.commit()
+    before = set(json.loads((db / "manifest.json").read_text())["files"]["auth.py"]["elements"])
+    updater = IndexUpdater(storage, Summarizer(no_llm=True), analyzed, workers=1)
+    (analyzed / "auth.py").write_text("def only():\n    pass\n")
+    updater.update({analyzed / "auth.py"})
+    _settle(updater)
+    updater.close()
+    index = json.loads((db / "index.json").read_text())
+    assert "foreign" in index
+    assert not before & set(index)
+    assert {e["name"] for e in index.values() if e["path"] == "auth.py"} == {"auth.py", "only"}
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux-only")
+def test_inotify_watcher_reports_files_and_new_dirs(tmp_path: Path) -> None:
+    (tmp_path / "node_modules").mkdir()
+    dirs: list[Path] = []
+    CodeParser().walk_directory(tmp_path, dirs=dirs)
+    watcher = InotifyWatcher(tmp_path, dirs, PathFilter(tmp_path))
+    try:
+        (tmp_path / "a.py").write_text("x = 1\n")
+        (tmp_path / "sub").mkdir()
+        assert watcher.changes(1.0) >= {tmp_path / "a.py", tmp_path / "sub"}
+        (tmp_path / "sub" / "b.py").write_text("y = 2\n")  # watched once sub appeared
+        assert tmp_path / "sub" / "b.py" in watcher.changes(1.0)
+        (tmp_path / "node_modules" / "c.js").write_text("z\n")
+        assert watcher.changes(0.1) == set()
+    finally:
+        watcher.close()
+
+
+def test_polling_watcher_reports_changes(tmp_path: Path) -> None:
+    (tmp_path / "a.py").write_text("x = 1\n")
+    watcher = PollingWatcher(tmp_path, None, interval=0.05)
+    (tmp_path / "a.py").write_text("x = 12\n")
+    (tmp_path / "b.py").write_text("y = 2\n")
+    (tmp_path / "notes.txt").write_text("ignored\n")
+    assert watcher.changes(1.0) == {tmp_path / "a.py", tmp_path / "b.py"}
+    (tmp_path / "a.py").unlink()
+    assert watcher.changes(1.0) == {tmp_path / "a.py"}
+
+
+def test_path_filter_agrees_with_walker(tmp_path: Path) -> None:
+    (tmp_path / ".gitignore").write_text("gen/\n*_pb2.py\n!keep_pb2.py\n")
+    (tmp_path / "app").mkdir()
+    (tmp_path / "app" / ".gitignore").write_text("!api_pb2.py\n")
+    rels = ["a.py", "gen/x.py", "api_pb2.py", "keep_pb2.py", "app/api_pb2.py", "build/y.py", "b.txt"]
+    for rel in rels:
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text("x = 1\n")
+    walked = {f.relative_to(tmp_path).as_posix() for f in CodeParser().walk_directory(tmp_path)}
+    path_filter = PathFilter(tmp_path)
+    assert walked == {rel for rel in rels if not path_filter.ignored(rel)}
+    assert walked == {"a.py", "keep_pb2.py", "app/api_pb2.py"}
+
+
+# Modules that cost hundreds of milliseconds and that read-only commands never need.
+_HEAVY_MODULES = ("anthropic", "openai", "numpy", "tree_sitter_language_pack", "asyncio")
+_IMPORT_BUDGET_US = 400_000  # cumulative `import pyramid_cli`; ~80 ms today, >1 s with eager SDKs
+
+
+def _importtime(code: str, cwd: Path) -> dict[str, int]:
+    """Run *code* in a fresh interpreter; return {module: cumulative import µs}."""
+    script_dir = str(Path(__file__).resolve().parent)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {script_dir!r}); {code}"],
+        capture_output=True, text=True, cwd=cwd, timeout=60,
+        env={**__import__("os").environ, "PYRAMID_NO_SERVER": "1"},
+    )
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    times: dict[str, int] = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _self, cumulative, name = line.removeprefix("import time:").split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_read_only_commands_skip_heavy_imports(analyzed: Path) -> None:
+    db = str(analyzed / ".pyramid")
+    for argv in (["list"], ["query", "AuthService"], ["get", "auth.py"]):
+        code = f"import pyramid_cli; pyramid_cli.cli.main({[*argv, '--db-path', db]!r}, standalone_mode=False)"
+        loaded = _importtime(code, analyzed)
+        assert not [m for m in loaded if m.split(".")[0] in _HEAVY_MODULES], argv
+
+
+def test_import_time_budget(tmp_path: Path) -> None:
+    times = _importtime("import pyramid_cli", tmp_path)
+    assert times["pyramid_cli"] < _IMPORT_BUDGET_US, f"import pyramid_cli took {times['pyramid_cli']} µs"
+
+
 def test_list_shows_files(analyzed: Path, runner: CliRunner) -> None:
     result = runner.invoke(
         cli, ["list", "--db-path", str(analyzed / ".pyramid"), "--level", "4"]
@@ -250,6 +1197,149 @@ def test_query_type_filter(analyzed: Path, runner: CliRunner) -> None:
     assert "[function]" in result.output
 
 
+def test_query_match_any(analyzed: Path, runner: CliRunner) -> None:
+    db = str(analyzed / ".pyramid")
+    strict = runner.invoke(cli, ["query", "password zzzunknown", "--db-path", db])
+    loose = runner.invoke(cli, ["query", "password zzzunknown", "--db-path", db, "--match", "any"])
+
+    assert "No results" in strict.output
+    assert "auth.py::hash_password" in loose.output
+
+
+def test_query_rebuilds_missing_search_index(analyzed: Path, runner: CliRunner) -> None:
+    (analyzed / ".pyramid" / "search.db").unlink()
+    result = runner.invoke(cli, ["query", "hash password", "--db-path", str(analyzed / ".pyramid")])
+
+    assert result.exit_code == 0, result.output
+    assert "auth.py::hash_password" in result.output
+    assert (analyzed / ".pyramid" / "search.db").exists()
+
+
+# ─────────────────────────────────────────────
+# Unit: SearchIndex
+# ─────────────────────────────────────────────
+
+
+def test_tokenize_splits_identifiers() -> None:
+    assert tokenize("parseHTTPResponse2 load_config_file") == [
+        "parse", "http", "response", "load", "config", "file",
+    ]
+    assert tokenize("the auth of a user") == ["auth", "user"]
+
+
+def test_search_index_ranks_name_above_summary(tmp_path: Path) -> None:
+    search = SearchIndex(tmp_path)
+    search.add("a", {"path": "src/util.py", "element_type": "function", "name": "helper",
+                     "levels": {"16": "formats a retry delay for the session token"}})
+    search.add("b", {"path": "src/session.py", "element_type": "function", "name": "refreshToken",
+                     "levels": {"16": "refreshes credentials"}})
+    search.add("c", {"path": "src/other.py", "element_type": "class", "name": "Unrelated",
+                     "levels": {"16": "nothing relevant"}})
+    search.commit()
+
+    assert [sha for sha, _ in search.search("token")] == ["b", "a"]
+    assert [sha for sha, _ in search.search("session token", match="all")] == ["b", "a"]
+    assert {sha for sha, _ in search.search("refresh unrelated", match="any")} == {"b", "c"}
+    assert search.search("token", element_type="class") == []
+
+
+def test_search_index_prefix_and_remove(tmp_path: Path) -> None:
+    search = SearchIndex(tmp_path)
+    search.add("a", {"path": "auth.py", "element_type": "file", "name": "auth.py",
+                     "levels": {"4": "authentication helpers"}})
+    search.add("b", {"path": "db.py", "element_type": "file", "name": "db.py", "levels": {}})
+    assert [sha for sha, _ in search.search("authent")] == ["a"]
+
+    search.remove("a")
+    search.commit()
+    assert search.search("authent") == []
+    assert search.count() == 1
+
+
+def test_vector_index_conceptual_match(tmp_path: Path) -> None:
+    pytest.importorskip("numpy")
+    vectors = VectorIndex(tmp_path)
+    vectors.add("a", {"path": "src/session.py", "element_type": "function", "name": "check",
+                      "levels": {"16": "validates the user login before opening a session"}})
+    vectors.add("b", {"path": "src/render.py", "element_type": "function", "name": "draw",
+                      "levels": {"16": "draws widgets onto the html canvas"}})
+    vectors.close()
+
+    results = VectorIndex(tmp_path).search("authentication")
+    assert results and results[0][0] == "a"
+    assert all(sha != "b" for sha, _ in results)
+    assert VectorIndex(tmp_path).search("authentication", element_type="class") == []
+
+
+def test_vector_index_incremental_remove(tmp_path: Path) -> None:
+    pytest.importorskip("numpy")
+    vectors = VectorIndex(tmp_path)
+    for i in range(4):
+        vectors.add(f"sha{i}", {"path": f"m{i}.py", "element_type": "file", "name": f"m{i}.py",
+                                "levels": {"4": "database migration helpers"}})
+    vectors.close()
+
+    reopened = VectorIndex(tmp_path)
+    reopened.remove("sha0")
+    reopened.remove("sha1")
+    reopened.close()  # half the rows are dead -> compacted
+
+    final = VectorIndex(tmp_path)
+    assert final.count() == 2
+    assert {sha for sha, _ in final.search("sql schema")} == {"sha2", "sha3"}
+    assert (tmp_path / "vectors.f32").stat().st_size == 2 * 512 * 4
+
+
+def test_vector_index_recovers_from_interrupted_writes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    pytest.importorskip("numpy")
+    data = {"path": "m.py", "element_type": "file", "name": "m.py", "levels": {"4": "database migration helpers"}}
+    vectors = VectorIndex(tmp_path)
+    for i in range(4):
+        vectors.add(f"sha{i}", data)
+    vectors.close()
+
+    # An append that died before vectors.json was rewritten.
+    with (tmp_path / "vectors.f32").open("ab") as fh:
+        fh.write(b"\x01" * 512 * 4)
+    with (tmp_path / "vectors.ids").open("ab") as fh:
+        fh.write(b"junk".ljust(65, b"\0"))
+    appended = VectorIndex(tmp_path)
+    appended.add("sha4", data)
+    appended.close()
+    assert {sha for sha, _ in VectorIndex(tmp_path).search("sql schema")} == {f"sha{i}" for i in range(5)}
+
+    # A compaction that died after recording its row count, with one file swapped.
+    compacting = VectorIndex(tmp_path)
+    for i in range(3):
+        compacting.remove(f"sha{i}")
+    replace = pyramid_cli.os.replace
+
+    def crash_before_ids(src: object, dst: object) -> None:
+        if str(dst).endswith("vectors.ids"):
+            raise OSError("crash")
+        replace(src, dst)
+
+    monkeypatch.setattr(pyramid_cli.os, "replace", crash_before_ids)
+    with pytest.raises(OSError):
+        compacting.close()
+    monkeypatch.undo()
+
+    final = VectorIndex(tmp_path)
+    assert final.count() == 2
+    assert {sha for sha, _ in final.search("sql schema")} == {"sha3", "sha4"}
+    assert (tmp_path / "vectors.f32").stat().st_size == 2 * 512 * 4
+    assert not (tmp_path / "vectors.ids.tmp").exists()
+
+
+def test_query_semantic(analyzed: Path, runner: CliRunner) -> None:
+    pytest.importorskip("numpy")
+    result = runner.invoke(
+        cli, ["query", "password hashing", "--semantic", "--db-path", str(analyzed / ".pyramid")]
+    )
+    assert result.exit_code == 0, result.output
+    assert "auth.py::hash_password" in result.output
+
+
 # ─────────────────────────────────────────────
 # get
 # ─────────────────────────────────────────────
@@ -313,6 +1403,358 @@ def test_storage_load_missing_data(tmp_path: Path) -> None:
     assert storage.load_data("doesnotexist") is None
 
 
+def _record(name: str) -> dict[str, object]:
+    return {"path": "m.py", "element_type": "function", "name": name, "code": "pass",
+            "start_line": 1, "end_line": 1, "levels": {"4": f"{name} summary"}}
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite", "pack"])
+def test_storage_path_index_prefix_and_order(tmp_path: Path, backend: str) -> None:
+    storage = open_storage(tmp_path / ".pyramid", backend)
+    storage.init()
+    elements = {
+        "e1": ("src/auth/login.py", "function", "verify"),
+        "e2": ("src/auth/login.py", "file", "login.py"),
+        "e3": ("src/authz.py", "file", "authz.py"),
+        "e4": ("src/auth/Tokens.py", "file", "Tokens.py"),
+        "e5": ("src/auth/login.py", "class", "Login"),
+        "e6": ("lib/util.py", "file", "util.py"),
+    }
+    for sha, (path, etype, name) in elements.items():
+        storage.put_element(sha, {"path": path, "element_type": etype, "name": name,
+                                  "code": "", "levels": {"4": name}})
+    storage.commit()
+    storage.close()
+
+    reopened = open_storage(tmp_path / ".pyramid", backend)
+    assert sorted(sha for sha, _entry in reopened.find_by_path("SRC/auth/")) == ["e1", "e2", "e4", "e5"]
+    if backend != "sqlite":
+        assert reopened._index is None  # answered from paths.idx without loading index.json
+    assert [sha for sha, _entry in reopened.iter_sorted()] == ["e6", "e2", "e5", "e1", "e4", "e3"]
+    assert [sha for sha, _entry in reopened.iter_sorted("file")] == ["e6", "e2", "e4", "e3"]
+
+    # Uncommitted writes are seen too (the path index follows put/delete).
+    reopened.put_element("e7", {"path": "src/auth/a.py", "element_type": "file", "name": "a.py",
+                                "code": "", "levels": {}})
+    reopened.delete_element("e4")
+    assert [sha for sha, _entry in reopened.find_by_path("src/auth/")][0] == "e7"
+    assert "e4" not in [sha for sha, _entry in reopened.find_by_path("src/auth/")]
+    reopened.close()
+
+
+def test_storage_recovers_from_journal_after_crash(tmp_path: Path) -> None:
+    db = tmp_path / ".pyramid"
+    storage = StorageManager(db)
+    storage.init()
+    storage.put_element("aaa", _record("a"))
+    storage.put_element("bbb", _record("b"))
+    # Crash: no commit, so index.json never heard of them; a torn line follows.
+    with (db / "journal.jsonl").open("a") as journal:
+        journal.write('{"sha": "ccc", "ent')
+    assert json.loads((db / "index.json").read_text()) == {}
+
+    reopened = StorageManager(db)
+    assert reopened.recover() == 2
+    assert reopened.get_entry("bbb")["levels"]["4"] == "b summary"  # type: ignore[index]
+    assert set(json.loads((db / "index.json").read_text())) == {"aaa", "bbb"}
+    assert not (db / "journal.jsonl").exists()
+
+
+def test_storage_adopts_orphaned_data_files(tmp_path: Path) -> None:
+    db = tmp_path / ".pyramid"
+    storage = StorageManager(db)
+    storage.init()
+    storage.put_element("aaa", _record("a"))
+    storage.commit()
+    # Killed between writing the data file and journalling it.
+    (db / "journal.jsonl").touch()
+    storage.save_data("ddd", _record("d"))
+    (db / "data" / "eee.json.123.tmp").write_text("{")
+
+    reopened = StorageManager(db)
+    assert reopened.recover() == 1
+    assert reopened.count() == 2
+    assert not list((db / "data").glob("*.tmp"))
+
+
+def test_storage_compacts_periodically(tmp_path: Path) -> None:
+    db = tmp_path / ".pyramid"
+    storage = StorageManager(db)
+    storage.init()
+    storage.COMPACT_EVERY = 2
+    storage.put_element("aaa", _record("a"))
+    assert (db / "journal.jsonl").exists()
+    storage.put_element("bbb", _record("b"))
+    assert not (db / "journal.jsonl").exists()
+    assert set(json.loads((db / "index.json").read_text())) == {"aaa", "bbb"}
+
+
+def test_passive_storage_follows_writer(tmp_path: Path) -> None:
+    db = tmp_path / ".pyramid"
+    writer = StorageManager(db)
+    writer.init()
+    writer.put_element("aaa", _record("a"))
+    reader = StorageManager(db)
+    reader.passive = True
+    assert reader.count() == 1
+    assert (db / "journal.jsonl").exists()  # a live writer's journal is left alone
+
+    writer.put_element("bbb", _record("b"))
+    assert reader.refresh()
+    assert reader.has_entry("bbb")
+    writer.delete_element("aaa")
+    writer.commit()  # compaction rewrites index.json
+    assert reader.refresh()
+    assert reader.count() == 1 and not reader.has_entry("aaa")
+    assert not reader.refresh()
+
+
+def test_sqlite_storage_roundtrip(tmp_path: Path) -> None:
+    storage = SQLiteStorage(tmp_path / ".pyramid")
+    storage.init()
+
+    data = {
+        "path": "src/Foo.py",
+        "element_type": "function",
+        "name": "foo",
+        "start_line": 3,
+        "end_line": 4,
+        "code": "def foo(): pass",
+        "levels": {"4": "a", "32": "b"},
+    }
+    storage.put_element("abc123", data)
+    storage.commit()
+
+    assert storage.load_data("abc123") == data
+    assert storage.get_entry("abc123")["levels"] == {"4": "a"}
+    assert [sha for sha, _ in storage.find_by_path("SRC\\foo")] == ["abc123"]
+    assert list(storage.iter_entries("class")) == []
+    assert storage.load_data("doesnotexist") is None
+    storage.close()
+
+
+def test_pack_storage_repacks_and_recovers(tmp_path: Path) -> None:
+    db = tmp_path / ".pyramid"
+    storage = PackStorage(db)
+    storage.init()
+    for i in range(20):
+        storage.put_element(f"k{i}", _record(f"v{i}"))
+    storage.commit()
+    for i in range(10):
+        storage.put_element(f"k{i}", _record(f"w{i}"))  # overwrites leave dead records behind
+    storage.delete_element("k19")
+    storage.commit()
+    assert sorted(p.name for p in (db / "pack").iterdir()) == [
+        "elements.idx", "elements.lock", "elements.pack"
+    ]
+    assert not (db / "data").exists()
+    size = (db / "pack" / "elements.pack").stat().st_size
+    assert storage.repack() > 0
+    assert (db / "pack" / "elements.pack").stat().st_size < size
+    assert storage.load_data("k3")["name"] == "w3"  # type: ignore[index]
+    assert storage.load_data("k15")["name"] == "v15"  # type: ignore[index]
+    assert storage.load_data("k19") is None
+
+    # Killed after appending a record but before journalling it, mid-way
+    # through the next record.
+    storage.save_data("k20", _record("v20"))
+    storage.close()
+    (db / "journal.jsonl").touch()
+    with (db / "pack" / "elements.pack").open("ab") as pack:
+        pack.write(b"\x40\x00\x00")
+    reopened = PackStorage(db)
+    assert reopened.recover() == 1
+    assert reopened.count() == 20
+    reopened.put_element("k21", _record("v21"))  # written past the torn bytes, not behind them
+    reopened.commit()
+    reopened.close()
+    final = open_storage(db, "pack")
+    assert final.load_data("k21")["name"] == "v21"  # type: ignore[index]
+    assert final.load_data("k20")["name"] == "v20"  # type: ignore[index]
+
+
+def test_pack_storage_two_writers(tmp_path: Path) -> None:
+    db = tmp_path / ".pyramid"
+    a = PackStorage(db)
+    a.init()
+    b = PackStorage(db)
+    a.save_data("k1", _record("a"))
+    b.save_data("k2", _record("b"))
+    b.commit()
+    a.save_data("k3", _record("c"))  # appended after b's record, not over it
+    assert a.load_data("k3")["name"] == "c"  # type: ignore[index]
+    a.commit()  # merges the index b wrote
+    b.save_data("k4", _record("d"))
+    b.repack()
+    a.save_data("k5", _record("e"))  # a notices the new pack
+    a.commit()
+    a.close()
+    b.close()
+    final = PackStorage(db)
+    assert [final.load_data(f"k{i}")["name"] for i in range(1, 6)] == list("abcde")  # type: ignore[index]
+
+
+def test_pack_backend_commands(tmp_path: Path, runner: CliRunner) -> None:
+    db = str(tmp_path / ".pyramid")
+    runner.invoke(cli, ["init", "--db-path", db, "--backend", "pack"])
+    (tmp_path / "auth.py").write_text("class AuthService:\n    def login(self):\n        return 1\n")
+    (tmp_path / "old.py").write_text("def gone():\n    pass\n")
+    result = runner.invoke(cli, ["analyze", str(tmp_path), "--db-path", db, "--no-llm", "--no-gc"])
+    assert result.exit_code == 0, result.output
+    assert isinstance(open_storage(Path(db)), PackStorage)
+    got = runner.invoke(cli, ["get", "auth.py", "--db-path", db, "--show-code"])
+    assert got.exit_code == 0 and "def login" in got.output
+
+    (tmp_path / "old.py").unlink()
+    runner.invoke(cli, ["analyze", str(tmp_path), "--db-path", db, "--no-llm", "--no-gc"])
+    result = runner.invoke(cli, ["gc", "--db-path", db])
+    assert result.exit_code == 0, result.output
+    assert "Removed 2 stale element(s)" in result.output
+    assert "Repacked element data" in result.output
+    listed = runner.invoke(cli, ["list", "--db-path", db, "--type", "all"])
+    assert "auth.py::AuthService" in listed.output and "gone" not in listed.output
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite", "pack"])
+def test_code_refs_read_working_tree_with_compressed_fallback(
+    tmp_path: Path, runner: CliRunner, backend: str
+) -> None:
+    db = tmp_path / ".pyramid"
+    runner.invoke(cli, ["init", "--db-path", str(db), "--backend", backend, "--code-refs"])
+    src = tmp_path / "auth.py"
+    src.write_text("def login():\n    return 1\n")
+    result = runner.invoke(cli, ["analyze", str(tmp_path), "--db-path", str(db), "--no-llm", "--no-gc"])
+    assert result.exit_code == 0, result.output
+
+    def login() -> dict[str, object]:
+        storage = open_storage(db)
+        [(_key, data)] = [
+            (key, storage.load_data(key)) for key, entry in storage.find_by_path("auth.py")
+            if entry["name"] == "login"
+        ]
+        storage.close()
+        return data  # type: ignore[return-value]
+
+    data = login()
+    assert "code" not in data and data["code_ref"]["sha"]  # type: ignore[index]
+    got = runner.invoke(cli, ["get", "auth.py", "--db-path", str(db), "--show-code"])
+    assert got.exit_code == 0 and "def login" in got.output
+
+    # Edited but not re-analyzed: the stored compressed copy still answers.
+    src.write_text("def logout():\n    return 0\n")
+    got = runner.invoke(cli, ["get", "auth.py", "--db-path", str(db), "--show-code"])
+    assert got.exit_code == 0 and "return 1" in got.output and "logout" not in got.output
+    assert "source changed" not in got.output
+
+    # Lines inserted above an unchanged function: its reference follows it.
+    src.write_text("import os\n\n\ndef login():\n    return 1\n")
+    runner.invoke(cli, ["analyze", str(tmp_path), "--db-path", str(db), "--no-llm", "--no-gc"])
+    data = login()
+    assert data["start_line"] == 4
+    assert data["code_ref"]["start"] == len("import os\n\n\n")  # type: ignore[index]
+    got = runner.invoke(cli, ["get", "auth.py", "--db-path", str(db), "--show-code"])
+    assert "def login():\n    return 1" in got.output
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_code_refs_exact_for_crlf_and_edited_files(tmp_path: Path, runner: CliRunner, newline: str) -> None:
+    db = str(tmp_path / ".pyramid")
+    runner.invoke(cli, ["init", "--db-path", db, "--code-refs"])
+    src = tmp_path / "a.py"
+    body = "import os\n\ndef alpha():\n    return 1\n\ndef beta():\n    return 2\n"
+    src.write_bytes(body.replace("\n", newline).encode())
+    runner.invoke(cli, ["analyze", str(tmp_path), "--db-path", db, "--no-llm", "--no-gc"])
+
+    got = runner.invoke(cli, ["get", "a.py", "--db-path", db, "--show-code"])
+    assert got.exit_code == 0, got.output
+    assert "source changed" not in got.output
+    assert "def alpha():\n    return 1" in got.output and "def beta():\n    return 2" in got.output
+
+    # One line added on top, not re-analyzed: served from the compressed copy.
+    src.write_bytes(("# header\n" + body).replace("\n", newline).encode())
+    got = runner.invoke(cli, ["get", "a.py", "--db-path", db, "--show-code"])
+    assert "source changed" not in got.output
+    assert "def alpha():\n    return 1" in got.output and "# header" not in got.output
+
+
+# ─────────────────────────────────────────────
+# sqlite backend
+# ─────────────────────────────────────────────
+
+
+def test_init_sqlite_backend(tmp_path: Path, runner: CliRunner) -> None:
+    db = tmp_path / ".pyramid"
+    result = runner.invoke(cli, ["init", "--db-path", str(db), "--backend", "sqlite"])
+
+    assert result.exit_code == 0, result.output
+    assert (db / "pyramid.db").exists()
+    assert json.loads((db / "config.json").read_text())["backend"] == "sqlite"
+    assert isinstance(open_storage(db), SQLiteStorage)
+
+
+def test_sqlite_backend_commands(tmp_path: Path, runner: CliRunner) -> None:
+    db = str(tmp_path / ".pyramid")
+    runner.invoke(cli, ["init", "--db-path", db, "--backend", "sqlite"])
+    (tmp_path / "auth.py").write_text("class AuthService:\n    def login(self):\n        return 1\n")
+    result = runner.invoke(cli, ["analyze", str(tmp_path), "--db-path", db, "--no-llm"])
+    assert result.exit_code == 0, result.output
+    assert not (tmp_path / ".pyramid" / "index.json").exists()
+
+    listed = runner.invoke(cli, ["list", "--db-path", db, "--type", "all"])
+    assert "auth.py::AuthService" in listed.output
+    found = runner.invoke(cli, ["query", "AuthService", "--db-path", db, "--level", "4"])
+    assert "AuthService" in found.output
+    got = runner.invoke(cli, ["get", "auth.py", "--db-path", db, "--show-code"])
+    assert got.exit_code == 0
+    assert "def login" in got.output
+
+
+def test_sqlite_interrupted_analyze_keeps_finished_summaries(
+    tmp_path: Path, runner: CliRunner, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    db = tmp_path / ".pyramid"
+    runner.invoke(cli, ["init", "--db-path", str(db), "--backend", "sqlite"])
+    for i in range(4):
+        (tmp_path / f"m{i}.py").write_text(f"def f{i}():\n    return {i}\n")
+    monkeypatch.setattr(SQLiteStorage, "COMMIT_INTERVAL", 3600.0)
+    add = pyramid_cli.SearchIndex.add
+    stored: list[str] = []
+
+    def interrupt_after_three(self: pyramid_cli.SearchIndex, sha: str, data: dict[str, object]) -> None:
+        stored.append(sha)
+        if len(stored) == 3:
+            raise KeyboardInterrupt
+        add(self, sha, data)
+
+    monkeypatch.setattr(pyramid_cli.SearchIndex, "add", interrupt_after_three)
+    result = runner.invoke(cli, ["analyze", str(tmp_path), "--db-path", str(db), "--no-llm", "--workers", "1"])
+    assert result.exit_code != 0
+    assert open_storage(db).count() == 3
+
+
+def test_sqlite_commits_on_interval(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(SQLiteStorage, "COMMIT_INTERVAL", 0.0)
+    writer = open_storage(tmp_path / ".pyramid", "sqlite")
+    writer.init()
+    writer.put_element("k1", _record("a"))
+    assert open_storage(tmp_path / ".pyramid").count() == 1  # visible before commit()
+
+
+def test_migrate_json_to_sqlite(analyzed: Path, runner: CliRunner) -> None:
+    db = analyzed / ".pyramid"
+    before = json.loads((db / "index.json").read_text())
+
+    result = runner.invoke(cli, ["migrate", "--to", "sqlite", "--db-path", str(db)])
+    assert result.exit_code == 0, result.output
+    assert f"Migrated {len(before)} elements" in result.output
+
+    storage = open_storage(db)
+    assert isinstance(storage, SQLiteStorage)
+    assert dict(storage.iter_entries()) == before
+    for sha in before:
+        assert storage.load_data(sha)["code"]
+
+
 # ─────────────────────────────────────────────
 # Unit: CodeParser
 # ─────────────────────────────────────────────
@@ -370,6 +1812,61 @@ def test_parser_walk_ignores_dot_pyramid(tmp_path: Path) -> None:
     assert "index.py" not in paths
 
 
+def test_parser_walk_gitignore_semantics(tmp_path: Path) -> None:
+    (tmp_path / ".gitignore").write_text("gen/\n*_pb2.py\n!keep_pb2.py\n/top.py\n")
+    (tmp_path / ".pyramidignore").write_text("vendor/**\n")
+    for rel in (
+        "top.py", "app/top.py", "gen/x.py", "app/gen/y.py", "api_pb2.py",
+        "keep_pb2.py", "vendor/lib/z.py", "app/sub/ok.py", "app/sub/skip.py",
+    ):
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text("x = 1\n")
+    # A nested .gitignore applies below its directory and overrides the root.
+    (tmp_path / "app" / "sub" / ".gitignore").write_text("skip.py\n!api_pb2.py\n")
+    (tmp_path / "app" / "sub" / "api_pb2.py").write_text("x = 1\n")
+
+    files = CodeParser().walk_directory(tmp_path, tmp_path / ".pyramidignore")
+    rels = sorted(f.relative_to(tmp_path).as_posix() for f in files)
+    assert rels == ["app/sub/api_pb2.py", "app/sub/ok.py", "app/top.py", "keep_pb2.py"]
+
+
+def test_git_tree_matches_walk_for_tracked_ignored_files(tmp_path: Path) -> None:
+    if shutil.which("git") is None:
+        pytest.skip("git not installed")
+    (tmp_path / ".gitignore").write_text("vendor/\n*_pb2.py\n")
+    (tmp_path / ".pyramidignore").write_text("scratch.py\n")
+    for rel in ("main.py", "vendor/lib.py", "api_pb2.py", "gen/out.py", "scratch.py", "new.py", "vendor/new.py"):
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text("x = 1\n")
+    (tmp_path / "gen" / ".gitignore").write_text("out.py\n")
+    _git(tmp_path, "init", "-q")
+    _git(tmp_path, "add", "-f", "main.py", "vendor/lib.py", "api_pb2.py", "gen/out.py", "scratch.py")
+    _git(tmp_path, "commit", "-q", "-m", "init")
+
+    walked = CodeParser().walk_directory(tmp_path, tmp_path / ".pyramidignore")
+    tree = pyramid_cli.git_tree(tmp_path, ignore_file=tmp_path / ".pyramidignore")
+    assert tree is not None
+    assert sorted(tree.files) == sorted(f.relative_to(tmp_path).as_posix() for f in walked) == ["main.py", "new.py"]
+
+
+def test_parser_walk_prunes_ignored_dirs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    (tmp_path / ".gitignore").write_text("cache/\n")
+    for rel in ("main.py", "node_modules/pkg/index.js", "cache/deep/a.py"):
+        (tmp_path / rel).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / rel).write_text("x = 1\n")
+    opened: list[str] = []
+    real_scandir = pyramid_cli.os.scandir
+
+    def scandir(path: str):  # type: ignore[no-untyped-def]
+        opened.append(Path(path).relative_to(tmp_path).as_posix())
+        return real_scandir(path)
+
+    monkeypatch.setattr(pyramid_cli.os, "scandir", scandir)
+    files = CodeParser().walk_directory(tmp_path)
+    assert [f.name for f in files] == ["main.py"]
+    assert opened == ["."]
+
+
 # ─────────────────────────────────────────────
 # Unit: Summarizer
 # ─────────────────────────────────────────────
@@ -393,6 +1890,61 @@ def test_summarizer_no_llm_returns_stubs() -> None:
     }
 
 
+def test_summarizer_reuses_clients(monkeypatch: pytest.MonkeyPatch) -> None:
+    pytest.importorskip("anthropic")
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test-key")
+    summarizer = Summarizer()
+    assert summarizer._client("anthropic") is summarizer._client("anthropic")
+    assert summarizer._client("anthropic-async") is summarizer._client("anthropic-async")
+
+
+class _StatusError(Exception):
+    def __init__(self, status_code: int, retry_after: str | None = None) -> None:
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        headers = {"retry-after": retry_after} if retry_after is not None else {}
+        self.response = type("Response", (), {"headers": headers})()
+
+
+def test_scheduler_retries_and_honours_retry_after() -> None:
+    scheduler = RateLimitScheduler(concurrency=4, base_delay=30.0)
+    outcomes: list[Exception | str] = [_StatusError(429, "0"), _StatusError(500, "0"), "ok"]
+
+    def _fn(_prompt: str) -> str:
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert scheduler.call("anthropic", _fn, "prompt") == "ok"
+    assert scheduler.retries == 2
+    assert scheduler.throttled == 1
+    assert scheduler.limit == 2.5  # halved on the 429, +1/limit after the success
+
+
+def test_scheduler_gives_up_on_non_retryable() -> None:
+    scheduler = RateLimitScheduler()
+    calls = 0
+
+    def _fn(_prompt: str) -> str:
+        nonlocal calls
+        calls += 1
+        raise _StatusError(400)
+
+    with pytest.raises(SummarizationError):
+        scheduler.call("anthropic", _fn, "prompt")
+    assert calls == 1
+    assert scheduler.in_flight == 0
+
+
+def test_scheduler_request_budget() -> None:
+    scheduler = RateLimitScheduler(budgets={"openai": {"rpm": 2}})
+    assert scheduler._try_acquire("openai", 10) == 0.0
+    assert scheduler._try_acquire("openai", 10) == 0.0
+    assert scheduler._try_acquire("openai", 10) > 1.0  # third request must wait ~30s
+    assert scheduler._try_acquire("anthropic", 10) == 0.0  # budgets are per provider
+
+
 def test_summarizer_detect_provider_no_llm() -> None:
     summarizer = Summarizer(no_llm=True)
     assert summarizer._detect_provider() == "stub"
@@ -408,3 +1960,56 @@ def test_summarizer_parse_json_with_surrounding_text() -> None:
     raw = 'Here is your answer:\n{"4": "code summary text", "8": "longer code summary text here now"}'
     result = Summarizer._parse_summaries(raw, [4, 8])
     assert "4" in result
+
+
+@pytest.mark.parametrize("raw", [
+    "Sorry, I can't summarize that.",
+    '{"4": "code summary text"}',  # a level missing
+    '{"4": "a summary far longer than the four words it was asked for", "8": "x"}',
+])
+def test_summarizer_parse_rejects_malformed_responses(raw: str) -> None:
+    with pytest.raises(SummarizationError):
+        Summarizer._parse_summaries(raw, [4, 8])
+
+
+# ─────────────────────────────────────────────
+# Benchmark harness
+# ─────────────────────────────────────────────
+
+
+def test_bench_smoke_run_and_compare(tmp_path: Path, runner: CliRunner) -> None:
+    pytest.importorskip("anthropic")
+    import bench_pyramid_cli
+
+    repo_a, repo_b = tmp_path / "a", tmp_path / "b"
+    bench_pyramid_cli.generate_repo(repo_a, 6, ("python", "javascript", "go"), depth=2, fanout=2)
+    bench_pyramid_cli.generate_repo(repo_b, 6, ("python", "javascript", "go"), depth=2, fanout=2)
+    files_a = sorted(p.relative_to(repo_a) for p in repo_a.rglob("*.*"))
+    assert [p.read_bytes() for p in sorted(repo_a.rglob("*.*"))] == [
+        p.read_bytes() for p in sorted(repo_b.rglob("*.*"))
+    ]
+    assert {p.suffix for p in files_a} == {".py", ".js", ".go"}
+    assert all(len(p.parts) == 3 for p in files_a)
+
+    base = tmp_path / "base.json"
+    args = [
+        "--sizes", "20", "--repeat", "1", "--latency", "0", "--jitter", "0",
+        "--error-rate", "0.2", "--analyze-args", "--concurrency 4 --batch-tokens 2000",
+    ]
+    result = runner.invoke(bench_pyramid_cli.main, [*args, "--output", str(base)])
+    assert result.exit_code == 0, result.output
+    report = json.loads(base.read_text())
+    rows = {row["scenario"]: row for row in report["results"]}
+    assert set(rows) == set(bench_pyramid_cli.SCENARIOS)
+    assert rows["cold_analyze"]["elements"] >= 20  # two files, each a class and eight functions
+    assert rows["cold_analyze"]["requests"] > 0
+    assert rows["noop_analyze"]["requests"] == 0
+    assert report["settings"]["error_rate"] == 0.2
+
+    result = runner.invoke(
+        bench_pyramid_cli.main,
+        [*args, "--scenarios", "list", "--output", str(tmp_path / "head.json"),
+         "--compare", str(base), "--fail-above", "1000"],
+    )
+    assert result.exit_code == 0, result.output
+    assert re.search(r"^list\s+20\s.*×", result.output, re.MULTILINE)